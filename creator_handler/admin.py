@@ -1,6 +1,22 @@
 from django.contrib import admin
-from .models import StageSettings
+from .models import StageSettings, Job, Newsletter, OutboxMessage
 
 @admin.register(StageSettings)
 class AdminStageSetting(admin.ModelAdmin):
     list_display = ("stage", )
+
+
+@admin.register(Job)
+class AdminJob(admin.ModelAdmin):
+    list_display = ("key", "kind", "status", "progress", "attempts", "updated_at")
+
+
+@admin.register(Newsletter)
+class AdminNewsletter(admin.ModelAdmin):
+    list_display = ("subject", "event", "created_at")
+
+
+@admin.register(OutboxMessage)
+class AdminOutboxMessage(admin.ModelAdmin):
+    list_display = ("recipient", "newsletter", "status", "attempts", "sent_at")
+    list_filter = ("status", )
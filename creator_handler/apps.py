@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CreatorHandlerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'creator_handler'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from distributedEvents.sqlite import configure_connection
+        from creator_handler import signals  # noqa: F401 - подключение обработчиков сигналов
+
+        connection_created.connect(configure_connection, dispatch_uid="sqlite_pragmas")
@@ -0,0 +1,161 @@
+from contextlib import ExitStack
+from datetime import datetime
+from random import Random
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from django.contrib.auth.models import User as DjangoUser
+from django.db import connections, transaction
+
+from creator_handler.models import StageSettings
+from event_handler.models import Event, Stage
+from user_handler.models import PersonalData, User
+
+NAMES = ["Иван", "Мария", "Пётр", "Анна", "Алексей", "Ольга", "Дмитрий", "Елена", "Сергей", "Наталья"]
+SURNAMES = ["Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов", "Новиков"]
+REGIONS = 89
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Перцентиль с линейной интерполяцией между соседними значениями
+    :param values: Значения (в любом порядке)
+    :param percent: Перцентиль от 0 до 100
+    :return: Значение перцентиля (0, если значений нет)
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class QueryCounter:
+    """
+    Обёртка выполнения запросов, считающая их количество
+    В отличие от CaptureQueriesContext не ограничена размером журнала запросов
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(action: Callable, runs: int = 20, warmup: int = 2, rollback: bool = True) -> dict:
+    """
+    Выполнить action несколько раз и собрать время и количество SQL-запросов
+    Запросы считаются по всем базам, включая реплику для чтения
+    :param action: Функция без параметров
+    :param runs: Количество замеров
+    :param warmup: Количество запусков до замеров (прогрев кэшей)
+    :param rollback: Откатывать изменения в базе после каждого запуска
+    :return: Словарь с перцентилями времени в мс и количеством запросов
+    """
+    timings = []
+    queries = []
+    for run in range(warmup + runs):
+        with transaction.atomic():
+            counter = QueryCounter()
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                started = perf_counter()
+                action()
+                elapsed = (perf_counter() - started) * 1000
+            if rollback:
+                transaction.set_rollback(True)
+        if run >= warmup:
+            timings.append(elapsed)
+            queries.append(counter.count)
+    return {
+        'runs': runs,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3) if timings else 0,
+        'max_ms': round(max(timings), 3) if timings else 0,
+        'queries': int(percentile(queries, 50)),
+        'queries_max': max(queries) if queries else 0,
+    }
+
+
+def make_report(results: Dict[str, dict], meta: dict = None) -> dict:
+    """
+    Собрать отчёт для сохранения в json
+    :param results: Замеры по названиям сценариев
+    :param meta: Описание окружения и набора данных
+    """
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'meta': meta or {},
+        'views': results,
+    }
+
+
+def compare_reports(baseline: dict, current: dict) -> List[dict]:
+    """
+    Сравнить два отчёта по сценариям, которые есть в обоих
+    :return: Список строк сравнения: name, p50 до и после, изменение в процентах, запросы до и после
+    """
+    rows = []
+    for name, new in current['views'].items():
+        old = baseline['views'].get(name)
+        if old is None:
+            continue
+        change = (new['p50_ms'] - old['p50_ms']) * 100 / old['p50_ms'] if old['p50_ms'] else 0
+        rows.append({'name': name, 'p50_before': old['p50_ms'], 'p50_after': new['p50_ms'],
+                     'change_percent': round(change, 1), 'queries_before': old['queries'],
+                     'queries_after': new['queries']})
+    return rows
+
+
+def create_users(count: int, prefix: str, suffix: str = "user", batch_size: int = 5000, rng: Random = None) -> list:
+    """
+    Создать синтетических пользователей вместе с DjangoUser и PersonalData через bulk_create
+    Имена пользователей - <prefix>_<suffix><номер>, почта - <имя>@example.com, пароль непригоден для входа
+    :return: Список User
+    """
+    rng = rng or Random(0)
+    offset = DjangoUser.objects.filter(username__startswith=f"{prefix}_").count()
+    users = []
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        usernames = [f"{prefix}_{suffix}{offset + start + index}" for index in range(size)]
+        # Пароль "!" - непригодный для входа, как у set_unusable_password
+        django_users = DjangoUser.objects.bulk_create(
+            DjangoUser(username=username, email=f"{username}@example.com", password="!") for username in usernames
+        )
+        personal_data = PersonalData.objects.bulk_create(
+            PersonalData(name=rng.choice(NAMES), surname=rng.choice(SURNAMES), region=rng.randint(1, REGIONS))
+            for _ in range(size)
+        )
+        users.extend(User.objects.bulk_create(
+            User(user=django_user, personal_data=data) for django_user, data in zip(django_users, personal_data)
+        ))
+    return users
+
+
+def create_stage_tree(event: Event, size: int, fanout: int = 4) -> List[Stage]:
+    """
+    Создать синтетическое дерево этапов через bulk_create: финал, у каждого этапа до fanout предшествующих
+    Дерево этапов мероприятия (StageTreeNode) не пересчитывается
+    :param event: Мероприятие
+    :param size: Количество этапов
+    :param fanout: Количество предшествующих этапов у каждого этапа
+    :return: Этапы по уровням: первым идёт финал
+    """
+    settings = StageSettings.objects.bulk_create(StageSettings() for _ in range(size))
+    stages = [Stage.objects.create(name="Финал", parent=event, settings=settings[0])]
+    level = stages
+    while len(stages) < size:
+        level = Stage.objects.bulk_create(
+            Stage(name=str(len(stages) + index), parent=event, settings=settings[len(stages) + index],
+                  next_stage=level[index // fanout])
+            for index in range(min(len(level) * fanout, size - len(stages)))
+        )
+        stages.extend(level)
+    return stages
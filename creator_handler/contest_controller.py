@@ -1,49 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from os import environ
+import atexit
+import logging
+import threading
 from distributedEvents.settings import BASE_DIR
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv(BASE_DIR / '.env')
 
+logger = logging.getLogger(__name__)
+
 config = {
-    "baseUrl": "https://api.contest.yandex.net/api/public/v2",
+    "baseUrl": environ.get("YANDEX_CONTEST_URL", "https://api.contest.yandex.net/api/public/v2"),
+
+    "headers": {"Authorization": f"OAuth {environ.get('YANDEX_TOKEN', '')}"},
 
-    "headers": {"Authorization": f"OAuth {environ['YANDEX_TOKEN']}"}
+    # Таймаут одного запроса в секундах
+    "timeout": float(environ.get("YANDEX_CONTEST_TIMEOUT", 10)),
+    # Количество повторов при 429/5xx и сетевых ошибках, пауза между ними растёт как backoff * 2^n
+    "retries": int(environ.get("YANDEX_CONTEST_RETRIES", 3)),
+    "backoff": float(environ.get("YANDEX_CONTEST_BACKOFF", 0.5)),
+    # Максимальное число одновременных запросов при регистрации участников
+    "maxWorkers": int(environ.get("YANDEX_CONTEST_WORKERS", 8)),
 }
 
 
+class ContestError(Exception):
+    """
+    Яндекс.Контест не ответил или вернул ошибку
+    """
+
+
+class ContestClient:
+    """
+    Класс **ContestClient**
+
+    Клиент API Яндекс.Контеста: keep-alive соединения, повторы с экспоненциальной паузой и таймаут на каждый запрос.
+    requests.Session не потокобезопасна, поэтому у каждого потока своя сессия. Участников регистрирует пул потоков,
+    общий для всех вызовов, так что сессий не больше max_workers + 1; close() закрывает пул и все сессии
+
+    :param base_url: Адрес API
+    :param headers: Заголовки запросов (авторизация)
+    :param timeout: Таймаут одного запроса в секундах
+    :param retries: Количество повторов при 429/5xx и сетевых ошибках
+    :param backoff: Множитель паузы между повторами
+    :param max_workers: Максимальное число одновременных запросов
+
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url: str, headers: dict, timeout: float = 10, retries: int = 3, backoff: float = 0.5,
+                 max_workers: int = 8):
+        self.base_url = base_url
+        self.headers = headers
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=self.RETRY_STATUSES,
+                           allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []
+        self._executor = None
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Сессия текущего потока, создаётся при первом запросе из него
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=self.retry)
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Пул потоков для регистрации участников, создаётся при первой регистрации
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="yandex-contest")
+            return self._executor
+
+    def close(self) -> None:
+        """
+        Остановить пул потоков и закрыть сессии всех потоков
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        self._local = threading.local()
+
+    def _request(self, method: str, path: str, **kwargs):
+        try:
+            return self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            logger.warning("Yandex.Contest request %s %s failed: %s", method, path, e)
+            return None
+
+    def _get_rows(self, path: str):
+        result = self._request("GET", path)
+        if result is None:
+            raise ContestError(f"Yandex.Contest request GET {path} failed")
+        if not result.ok:
+            logger.warning("Yandex.Contest request GET %s failed: HTTP %s", path, result.status_code)
+            raise ContestError(f"Yandex.Contest request GET {path} failed: HTTP {result.status_code}")
+        return result.json().get("rows")
+
+    def have_access(self, contest_id) -> bool:
+        result = self._request("GET", f"/contests/{contest_id}")
+        return result is not None and result.ok
+
+    def get_standings(self, contest_id):
+        return self._get_rows(f"/contests/{contest_id}/standings")
+
+    def get_participants(self, contest_id):
+        return self._get_rows(f"/contests/{contest_id}/standings")
+
+    def register_participant(self, contest_id, login) -> bool:
+        addition = self._request("POST", f"/contests/{contest_id}/participants", data={"login": login})
+        return addition is not None and addition.ok
+
+    def register_participants(self, contest_id, login_list):
+        """
+        Зарегистрировать участников в контесте, не более max_workers запросов одновременно
+        :param contest_id: id контеста
+        :param login_list: Логины участников
+        :return: Список успешно зарегистрированных логинов
+        """
+        login_list = list(login_list)
+        if not contest_id:
+            logger.warning("No contest to register %s participants in", len(login_list))
+            return []
+        results = self.executor.map(lambda login: self.register_participant(contest_id, login), login_list)
+        added = [login for login, ok in zip(login_list, results) if ok]
+        logger.info("Added %s of %s logins to contest %s", len(added), len(login_list), contest_id)
+        return added
+
+
+_client = None
+
+
+def get_client() -> ContestClient:
+    """
+    Общий клиент Яндекс.Контеста, создаётся при первом обращении
+    """
+    global _client
+    if _client is None:
+        _client = ContestClient(config["baseUrl"], config["headers"], timeout=config["timeout"],
+                                retries=config["retries"], backoff=config["backoff"],
+                                max_workers=config["maxWorkers"])
+        atexit.register(_client.close)
+    return _client
+
+
 def have_access(contest_id) -> bool:
-    result = requests.get(config["baseUrl"] + f"/contests/{contest_id}", headers=config["headers"])
-    return result.ok
+    return get_client().have_access(contest_id)
 
 
 def get_standings(contest_id):
-    result = requests.get(config["baseUrl"] + f"/contests/{contest_id}/standings", headers=config["headers"])
-    if not result.ok:
-        print("REQUEST ERROR")
-        return []
-    result = result.json()
-    return result.get("rows")
+    return get_client().get_standings(contest_id)
 
 
 def get_participants(contest_id):
-    result = requests.get(config["baseUrl"] + f"/contests/{contest_id}/standings", headers=config["headers"])
-    print(result)
-    if not result.ok:
-        print("REQUEST ERROR")
-        return []
-    result = result.json()
-    return result.get("rows")
+    return get_client().get_participants(contest_id)
 
 
 def register_participants(contest_id, login_list):
-    if not contest_id:
-        print("No contest!")
-        return
-    for login in login_list:
-        addition = requests.post((config["baseUrl"] + f"/contests/{contest_id}/participants"),
-                                 headers=config["headers"],
-                                 data={"login": login})
-        if addition.ok:
-            print("Added login", login)
-
+    return get_client().register_participants(contest_id, login_list)
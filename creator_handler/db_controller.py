@@ -1,22 +1,28 @@
-from event_handler.models import Event, Stage, StageStaff, StageParticipants, Venue
+from event_handler.models import Event, Stage, StageStaff, StageParticipants, Venue, StageTreeNode
 from creator_handler.models import StageSettings
 from user_handler.models import DjangoUser, User
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from collections import deque
 from enum import Enum
 from typing import Union, List, Tuple, Set
 
 from event_handler.db_controller import get_user_by_django_user, get_stages_by_event, get_event_by_id, \
     get_event_by_stage, get_stage_by_id
 
+from creator_handler.permissions import get_event_permissions
+from event_handler.leaderboard import invalidate_leaderboard_on_commit
+from event_handler.summary import defer_event_summaries, refresh_event_summary
+from distributedEvents.versions import defer_version_bumps
 import creator_handler.contest_controller as contest
 
 
 def get_participants_by_event(event: Event):
-    stages = get_stages_by_event(event)
-    stage_ids = [stage.id for stage in stages]
-    stage_participants = StageParticipants.objects.filter(stage__in=stage_ids)
-    return stage_participants
+    return StageParticipants.objects.filter(stage__parent=event)
 
 
 def get_staff_by_event(event: Event):
@@ -30,14 +36,109 @@ class SettingsSet(Enum):
     MANAGE_MAILING_LIST = 3
 
 
+VENUES_PER_PAGE = 50  # Количество площадок на одной странице списка
+
+# Параметр сортировки списка площадок -> поле
+VENUE_SORT_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'address': 'address',
+    'region': 'region',
+    'maximum': 'participants_maximum',
+    'registered': 'registered',
+    'stage': 'parental_stage__name',
+}
+
+
 def get_venues_by_event(event_id: int):
-    return Venue.objects.filter(parental_event_id=event_id)
+    """
+    Площадки всех этапов мероприятия одним запросом
+    :param event_id: id мероприятия
+    :return: QuerySet площадок
+    """
+    return Venue.objects.filter(parental_stage__parent=event_id)
 
 
 def get_venues_by_stage_id(stage_id: int):
     return Venue.objects.filter(parental_stage_id=stage_id)
 
 
+# Площадка без ограничения вместимости или со свободными местами
+VENUE_HAS_SEATS = Q(participants_maximum__isnull=True) | Q(participants_count__lt=F('participants_maximum'))
+
+# Заявки с этими статусами занимают место на площадке
+SEAT_STATUSES = [StageParticipants.Status.AWAITED, StageParticipants.Status.ACCEPTED]
+
+
+def get_free_venues_by_stage_id(stage_id: int):
+    return get_venues_by_stage_id(stage_id).filter(VENUE_HAS_SEATS)
+
+
+def get_venues_page(event_id: int, sort: str = "name", page=1, per_page: int = VENUES_PER_PAGE):
+    """
+    Страница списка площадок мероприятия вместе с этапом и количеством зарегистрированных участников
+    (аннотация registered)
+    :param event_id: id мероприятия
+    :param sort: Ключ из VENUE_SORT_FIELDS, "-" в начале - по убыванию; неизвестный ключ - сортировка по названию
+    :param page: Номер страницы, некорректный номер заменяется ближайшей существующей страницей
+    :param per_page: Количество площадок на странице
+    :return: django.core.paginator.Page
+    """
+    descending = sort.startswith("-")
+    field = VENUE_SORT_FIELDS.get(sort.lstrip("-"), 'name')
+    venues = get_venues_by_event(event_id).select_related('parental_stage') \
+        .annotate(registered=count_venue_participants()) \
+        .order_by(f"-{field}" if descending else field, 'id')
+    return Paginator(venues, per_page).get_page(page)
+
+
+def count_venue_participants():
+    """
+    Подзапрос количества заявок, занимающих место на площадке (для Venue.objects.annotate/update)
+    """
+    seats = StageParticipants.objects.filter(venue=OuterRef('pk'), status__in=SEAT_STATUSES).order_by() \
+        .values('venue').annotate(count=Count('id')).values('count')
+    return Coalesce(Subquery(seats), 0)
+
+
+def recount_venue_participants(venues) -> int:
+    """
+    Пересчитать счётчики занятых мест площадок одним UPDATE
+    :param venues: QuerySet площадок
+    :return: Количество обновлённых площадок
+    """
+    return venues.update(participants_count=count_venue_participants())
+
+
+def reconcile_venue_counters(event_id: int = None) -> int:
+    """
+    Исправить счётчики занятых мест, разошедшиеся с заявками
+    :param event_id: id мероприятия (по умолчанию все площадки)
+    :return: Количество исправленных площадок
+    """
+    venues = Venue.objects.all() if event_id is None else Venue.objects.filter(parental_stage__parent=event_id)
+    with transaction.atomic():
+        drifted = venues.annotate(actual=count_venue_participants()).exclude(participants_count=F('actual'))
+        fixed = drifted.count()
+        if fixed:
+            recount_venue_participants(Venue.objects.filter(id__in=drifted.values('id')))
+    return fixed
+
+
+def update_participations_status(participations, status: int) -> int:
+    """
+    Изменить статус заявок и пересчитать места на их площадках в одной транзакции
+    :param participations: QuerySet заявок, не отфильтрованный по статусу
+    :param status: Новый статус из StageParticipants.Status
+    :return: Количество изменённых заявок
+    """
+    with transaction.atomic():
+        updated = participations.update(status=status)
+        if updated:
+            recount_venue_participants(Venue.objects.filter(id__in=participations.values('venue')))
+    return updated
+
+
 def get_venue_by_id(venue_id: int):
     return Venue.objects.get(id=venue_id)
 
@@ -54,21 +155,34 @@ def get_venue_by_id_dict(venue_id: int):
 
 
 def user_have_access(django_user: DjangoUser, event_id: int, setting=-1) -> bool:
-    user = get_user_by_django_user(django_user)
-    # print(user)
-    try:
-        stage = get_stages_by_event(get_event_by_id(event_id)).filter(next_stage__isnull=True).first()
-        staff = StageStaff.objects.get(user=user, stage=stage)
-        setting_rule = 0
-        if setting == SettingsSet.EDIT_VENUES:
-            setting_rule = stage.settings.who_can_edit_venues
-        elif setting == SettingsSet.ACCEPT_APPLICATIONS:
-            setting_rule = stage.settings.who_can_accept_applications
-        elif setting == SettingsSet.MANAGE_MAILING_LIST:
-            setting_rule = stage.settings.who_can_manage_mailing_list
-        return staff.status == StageStaff.Status.ACCEPTED and staff.role >= setting_rule
-    except ObjectDoesNotExist:
+    """
+    Проверить, может ли пользователь управлять мероприятием
+    Ответ запоминается на объекте django_user до конца запроса
+    :param django_user: Пользователь, сделавший запрос
+    :param event_id: id мероприятия
+    :param setting: Проверяемое действие из SettingsSet (-1 - любой принятый модератор)
+    """
+    access_cache = getattr(django_user, '_access_cache', None)
+    if access_cache is None:
+        access_cache = django_user._access_cache = {}
+    key = (int(event_id), setting)
+    if key not in access_cache:
+        access_cache[key] = _user_have_access(django_user, event_id, setting)
+    return access_cache[key]
+
+
+def _user_have_access(django_user: DjangoUser, event_id: int, setting=-1) -> bool:
+    permissions = get_event_permissions(django_user, event_id)
+    if permissions is None:
         return False
+    setting_rule = 0
+    if setting == SettingsSet.EDIT_VENUES:
+        setting_rule = permissions.who_can_edit_venues
+    elif setting == SettingsSet.ACCEPT_APPLICATIONS:
+        setting_rule = permissions.who_can_accept_applications
+    elif setting == SettingsSet.MANAGE_MAILING_LIST:
+        setting_rule = permissions.who_can_manage_mailing_list
+    return permissions.status == StageStaff.Status.ACCEPTED and permissions.role >= setting_rule
 
 
 def create_venue(name: str, address: str, region: int, participants_maximum: int, contacts: str, stage_id: int) -> None:
@@ -99,30 +213,59 @@ def edit_venue(name: str, address: str, region: int, participants_maximum: int,
 
 
 def is_venue_attached_to_event(event_id: int, venue_id: int) -> bool:
+    return get_venues_by_event(event_id).filter(id=venue_id).exists()
+
+
+class RegistrationResult(Enum):
+    REGISTERED = 1
+    ALREADY_REGISTERED = 2
+    CLOSED = 3
+    WRONG_VENUE = 4
+    VENUE_FULL = 5
+
+
+def take_venue_seat(venue_id: int, event_id: int) -> RegistrationResult:
+    """
+    Занять место на площадке мероприятия одним условным UPDATE: счётчик растёт,
+    только если площадка не заполнена, поэтому одновременные регистрации не превышают participants_maximum
+    :param venue_id: id площадки
+    :param event_id: id мероприятия, к которому должна относиться площадка
+    :return: REGISTERED, VENUE_FULL или WRONG_VENUE
+    """
+    venues = Venue.objects.filter(id=venue_id, parental_stage__parent=event_id)
+    if venues.filter(VENUE_HAS_SEATS).update(participants_count=F('participants_count') + 1):
+        return RegistrationResult.REGISTERED
+    return RegistrationResult.VENUE_FULL if venues.exists() else RegistrationResult.WRONG_VENUE
+
+
+def register_on_stage(stage: Stage, venue_id: int, user: User) -> RegistrationResult:
+    """
+    Зарегистрировать пользователя на этап
+    Заявка вставляется без предварительной проверки: повторную регистрацию отсекает уникальное
+    ограничение (stage, user), место на площадке занимается в той же транзакции
+    :param stage: Этап
+    :param venue_id: id площадки
+    :param user: Пользователь
+    :return: Результат регистрации
+    """
+    if stage.status != Stage.Status.WAITING or not stage.settings.can_register:
+        return RegistrationResult.CLOSED
+    if venue_id is None:
+        return RegistrationResult.WRONG_VENUE
+    # Пользователь может быть ленивым объектом (request.domain_user): его чтение внутри транзакции
+    # делает её читающей, и в режиме WAL SQLite отклоняет запись сразу, не дожидаясь освобождения базы
+    user_id = user.id
     try:
-        venue = get_venue_by_id(venue_id)
-        event_stages = get_stages_by_event(get_event_by_id(event_id))
-        # print(event_stages, "//", venue, "//",venue.parental_stage, "//", event_id)
-        is_attached = False
-        for stage in event_stages:
-            if stage == venue.parental_stage:
-                is_attached = True
-                break
-        return is_attached
-    except ObjectDoesNotExist:
-        return False
-
-
-def register_on_stage(stage_id: int, venue_id: int, user: User):
-    stage = get_stage_by_id(stage_id)
-    venue = get_venue_by_id(venue_id)
-    if not is_venue_attached_to_event(get_event_by_stage(stage).id, venue_id):
-        raise ValueError
-    participation = StageParticipants.objects.get_or_create(stage=stage, user=user)[0]
-    participation.role = StageParticipants.Roles.PARTICIPANT
-    participation.status = StageParticipants.Status.ACCEPTED
-    participation.venue = venue
-    participation.save()
+        with transaction.atomic():
+            StageParticipants.objects.create(stage=stage, user_id=user_id, venue_id=venue_id,
+                                             role=StageParticipants.Roles.PARTICIPANT,
+                                             status=StageParticipants.Status.ACCEPTED)
+            result = take_venue_seat(venue_id, stage.parent_id)
+            if result != RegistrationResult.REGISTERED:
+                transaction.set_rollback(True)
+            return result
+    except IntegrityError:
+        return RegistrationResult.ALREADY_REGISTERED
 
 
 def make_record_event(name, description):
@@ -132,31 +275,143 @@ def make_record_event(name, description):
 
 def make_record_stage(name, event, preview="Пустое превью", time_start=None,
                       time_end=None, description="пустое описание", next_stage=None):
-    stage = Stage.objects.create(
-        name=name,
-        parent=event,
-        preview=preview,
-        time_start=time_start,
-        time_end=time_end,
-        description=description,
-        settings=StageSettings.objects.create(),
-        next_stage=next_stage,
-    )
+    with transaction.atomic():
+        stage = Stage.objects.create(
+            name=name,
+            parent=event,
+            preview=preview,
+            time_start=time_start,
+            time_end=time_end,
+            description=description,
+            settings=StageSettings.objects.create(),
+            next_stage=next_stage,
+        )
+        insert_stage_tree_node(stage)
     return stage
 
 
-def get_stage_subtree(stage: int, to_delete):
-    previous_stages = Stage.objects.filter(next_stage=stage).values_list('id', flat=True)
-    for previous_stage in previous_stages:
-        get_stage_subtree(previous_stage, to_delete)
-    to_delete.append(stage)
+def get_stage_subtree(stage: int) -> List[int]:
+    """
+    Получить этап и все предшествующие ему этапы
+    Пары (id, next_stage_id) мероприятия загружаются одним запросом, дерево обходится в ширину в памяти
+    :param stage: id корня поддерева
+    :return: Список id этапов поддерева (пустой, если этапа нет)
+    """
+    children = {}
+    stage_ids = set()
+    for stage_id, next_stage_id in Stage.objects.filter(parent__stage=stage).values_list('id', 'next_stage'):
+        children.setdefault(next_stage_id, []).append(stage_id)
+        stage_ids.add(stage_id)
+    if stage not in stage_ids:
+        return []
+
+    subtree = [stage]
+    queue = deque(subtree)
+    while queue:
+        for previous_stage in children.get(queue.popleft(), []):
+            subtree.append(previous_stage)
+            queue.append(previous_stage)
+    return subtree
 
 
 def delete_stage_recursive(stage: int):
-    to_delete = []
-    get_stage_subtree(stage, to_delete)
-    # print(to_delete)
-    Stage.objects.filter(id__in=to_delete).delete()
+    """
+    Удалить этап вместе со всеми предшествующими ему этапами и их настройками
+    :param stage: id этапа
+    """
+    with transaction.atomic(), defer_event_summaries(), defer_version_bumps():
+        event_id = Stage.objects.filter(id=stage).values_list('parent', flat=True).first()
+        node = StageTreeNode.objects.filter(stage=stage).first() if is_stage_tree_complete(event_id) else None
+        to_delete = get_stage_subtree(stage)
+        # Границы поддерева берутся из самого дерева до удаления: узлы удалятся каскадно вместе с этапами
+        size = get_stage_tree_range_size(node) if node is not None else None
+        settings_ids = list(Stage.objects.filter(id__in=to_delete, settings__isnull=False)
+                            .values_list('settings', flat=True))
+        Stage.objects.filter(id__in=to_delete).delete()
+        StageSettings.objects.filter(id__in=settings_ids).delete()
+        if node is not None and size == len(to_delete):
+            remove_stage_tree_range(node, size)
+        elif event_id is not None:
+            rebuild_stage_tree(event_id)
+
+
+def is_stage_tree_complete(event_id: int) -> bool:
+    """
+    Есть ли в дереве этапов узел для каждого этапа мероприятия
+    Этапы, созданные не через make_record_stage (админ-панель, фикстуры), попадают в дерево только при пересчёте
+    """
+    return StageTreeNode.objects.filter(event=event_id).count() == Stage.objects.filter(parent=event_id).count()
+
+
+def get_stage_tree_range_size(node: StageTreeNode) -> int:
+    """
+    Количество узлов в поддереве узла: поддерево заканчивается перед первым следующим узлом
+    с глубиной не больше, чем у node
+    """
+    nodes = StageTreeNode.objects.filter(event=node.event_id)
+    end = nodes.filter(position__gt=node.position, depth__lte=node.depth).aggregate(Min('position'))['position__min']
+    if end is None:
+        end = nodes.aggregate(Max('position'))['position__max'] + 1
+    return end - node.position
+
+
+def rebuild_stage_tree(event_id: int) -> None:
+    """
+    Полностью пересчитать дерево этапов мероприятия
+    Дочерние этапы идут от новых к старым, как и при добавлении через make_record_stage
+    :param event_id: id мероприятия
+    """
+    children = {}
+    roots = []
+    for stage_id, next_stage_id in Stage.objects.filter(parent=event_id).order_by('-id') \
+            .values_list('id', 'next_stage'):
+        if next_stage_id is None:
+            roots.append(stage_id)
+        else:
+            children.setdefault(next_stage_id, []).append(stage_id)
+
+    nodes = []
+    stack = [(root, 0) for root in roots]
+    while stack:
+        stage_id, depth = stack.pop()
+        nodes.append(StageTreeNode(event_id=event_id, stage_id=stage_id, position=len(nodes), depth=depth))
+        stack.extend((child, depth + 1) for child in reversed(children.get(stage_id, [])))
+
+    with transaction.atomic():
+        StageTreeNode.objects.filter(event=event_id).delete()
+        StageTreeNode.objects.bulk_create(nodes)
+
+
+def insert_stage_tree_node(stage: Stage) -> None:
+    """
+    Добавить только что созданный этап в дерево этапов мероприятия
+    :param stage: Новый этап
+    """
+    if stage.next_stage_id is None:
+        last_position = StageTreeNode.objects.filter(event=stage.parent_id).aggregate(Max('position'))
+        position = 0 if last_position['position__max'] is None else last_position['position__max'] + 1
+        StageTreeNode.objects.create(event_id=stage.parent_id, stage=stage, position=position, depth=0)
+        return
+    parent_node = StageTreeNode.objects.filter(stage=stage.next_stage_id).first()
+    if parent_node is None:
+        rebuild_stage_tree(stage.parent_id)
+        return
+    StageTreeNode.objects.filter(event=stage.parent_id, position__gt=parent_node.position) \
+        .update(position=F('position') + 1)
+    StageTreeNode.objects.create(event_id=stage.parent_id, stage=stage,
+                                 position=parent_node.position + 1, depth=parent_node.depth + 1)
+
+
+def remove_stage_tree_range(node: StageTreeNode, size: int) -> None:
+    """
+    Сдвинуть дерево этапов после удаления поддерева
+    :param node: Узел корня удалённого поддерева
+    :param size: Количество этапов в поддереве
+    """
+    StageTreeNode.objects.filter(event=node.event_id, position__gte=node.position,
+                                 position__lt=node.position + size).delete()
+    StageTreeNode.objects.filter(event=node.event_id, position__gte=node.position + size) \
+        .update(position=F('position') - size)
 
 
 def create_staff(user, stage, role, status=Stage.Status.WAITING):
@@ -169,7 +424,8 @@ def create_staff(user, stage, role, status=Stage.Status.WAITING):
 def reject_participant(user: User, event_id: int):
     try:
         stage = get_stages_by_event(get_event_by_id(event_id)).first()
-        StageParticipants.objects.filter(user=user, stage=stage).update(status=StageParticipants.Status.REJECTED)
+        update_participations_status(StageParticipants.objects.filter(user=user, stage=stage),
+                                     StageParticipants.Status.REJECTED)
         return True
     except ObjectDoesNotExist:
         return False
@@ -178,7 +434,8 @@ def reject_participant(user: User, event_id: int):
 def accept_participant(user: User, event_id: int):
     try:
         stage = get_stages_by_event(get_event_by_id(event_id)).first()
-        StageParticipants.objects.filter(user=user, stage=stage).update(status=StageParticipants.Status.ACCEPTED)
+        update_participations_status(StageParticipants.objects.filter(user=user, stage=stage),
+                                     StageParticipants.Status.ACCEPTED)
         return True
     except ObjectDoesNotExist:
         return False
@@ -187,44 +444,53 @@ def accept_participant(user: User, event_id: int):
 def ban_participant(user: User, event_id: int):
     try:
         stage = get_stages_by_event(get_event_by_id(event_id)).first()
-        StageParticipants.objects.filter(user=user, stage=stage).update(status=StageParticipants.Status.BANNED)
+        update_participations_status(StageParticipants.objects.filter(user=user, stage=stage),
+                                     StageParticipants.Status.BANNED)
         return True
     except ObjectDoesNotExist:
         return False
 
 
+def set_participants_status(user_ids: List[int], event_id: int, status: int) -> dict:
+    """
+    Изменить статус заявок нескольких пользователей одним UPDATE
+    Как и accept_participant, работает с заявками на первый этап мероприятия
+    :param user_ids: id пользователей (User из user_handler)
+    :param event_id: id мероприятия
+    :param status: Новый статус из StageParticipants.Status
+    :return: Словарь id пользователя -> "updated" или "not_found"
+    """
+    stage = get_stages_by_event(event_id).first()
+    participations = StageParticipants.objects.filter(stage=stage, user__in=user_ids)
+    found = set(participations.values_list('user', flat=True))
+    if found:
+        update_participations_status(participations, status)
+    return {user_id: "updated" if user_id in found else "not_found" for user_id in user_ids}
+
+
 def get_event_partcipants(event_id: int):
     stage = get_stages_by_event(get_event_by_id(event_id)).first()
     return StageParticipants.objects.filter(stage=stage)
 
 
 def get_formatted_stages(event_id: int):
-    stages = get_stages_by_event(get_event_by_id(event_id))
-    answer = []
-    adjacency_list = {}
-    final = -1
-    fictive_stage = Stage(id=-1, name="fictive")
-    stages_by_id = {-1: fictive_stage}
-    for stage in stages:
-        adjacency_list.setdefault(stage.id, []).append(fictive_stage.id)
-    for stage in stages:
-        stages_by_id[stage.id] = stage
-        if stage.next_stage is not None:
-            adjacency_list.setdefault(stage.next_stage.id, []).append(stage.id)
-        else:
-            final = stage.id
-    if final == -1:
+    """
+    Получить этапы мероприятия в порядке обхода дерева от финального этапа
+    Дочерние этапы идут от новых к старым (до хранения дерева они шли по названию)
+    Если узлов в дереве меньше или больше, чем этапов, дерево пересчитывается
+    :param event_id: id мероприятия
+    :return: Список пар: этап, глубина этапа в дереве
+    """
+    stages_count = Stage.objects.filter(parent=event_id).order_by().values('parent') \
+        .annotate(count=Count('id')).values('count')
+    nodes = list(StageTreeNode.objects.filter(event=event_id).select_related('stage')
+                 .annotate(stages_count=Subquery(stages_count)))
+    if not nodes or nodes[0].stages_count != len(nodes):
+        rebuild_stage_tree(event_id)
+        nodes = list(StageTreeNode.objects.filter(event=event_id).select_related('stage'))
+    if not nodes:
         raise ValueError
-    for previous_stages in adjacency_list:
-        adjacency_list[previous_stages].reverse()
-    euler_bypass(final, adjacency_list, 0, answer, stages_by_id)
-    return answer
-
-
-def euler_bypass(stage_id: int, adjacency_list, depth: int, answer, stages_by_id):
-    answer.append((stages_by_id[stage_id], depth))
-    for previous_stage in adjacency_list.setdefault(stage_id, []):
-        euler_bypass(previous_stage, adjacency_list, depth + 1, answer, stages_by_id)
+    return [(node.stage, node.depth) for node in nodes]
 
 
 def update_stage(stage_id: int, name, description, contacts, can_register):
@@ -239,77 +505,146 @@ def update_stage(stage_id: int, name, description, contacts, can_register):
 
 def change_role_of_participation(yandex_contest_ids: Union[
     List, str]) -> None:
-    StageParticipants.objects.filter(yandex_contest_id__in=yandex_contest_ids, status=200).update(
-        role=StageParticipants.Roles.AWARDEE)
+    participations = StageParticipants.objects.filter(yandex_contest_id__in=yandex_contest_ids, status=200)
+    stage_ids = set(participations.values_list('stage', flat=True))
+    participations.update(role=StageParticipants.Roles.AWARDEE)
+    # QuerySet.update не отправляет post_save
+    for stage_id in stage_ids:
+        invalidate_leaderboard_on_commit(stage_id)
 
 
-def transfer_participants_to_next_stage(stage_id: int, venue_id: int = -1) -> None:
-    stage = get_stage_by_id(stage_id)
-    next_stage = stage.next_stage
+def get_stage_awardees(stage: Stage):
+    """
+    Получить принятых участников этапа, прошедших на следующий этап
+    :param stage: Этап
+    :return: QuerySet призёров и победителей этапа
+    """
+    return StageParticipants.objects.filter(stage=stage, status=StageParticipants.Status.ACCEPTED,
+                                            role__in=[StageParticipants.Roles.AWARDEE,
+                                                      StageParticipants.Roles.WINNER])
 
-    if venue_id == -1:
-        venues = Venue.objects.filter(parental_stage_id=next_stage.id)
-
-        if len(venues) == 0:
-            create_venue("Площадка для Яндекс.Контеста", "Яндекс.Контест", None, None, None, next_stage.id)
-            venues = Venue.objects.filter(parental_stage_id=next_stage.id)
-
-        venue_id = venues[0].id
-
-    awardees = StageParticipants.objects.filter(stage=stage, status=200, role__in=[StageParticipants.Roles.AWARDEE,
-                                                                                   StageParticipants.Roles.WINNER])
-    for awardee in awardees:
-        register_on_stage(next_stage.id, venue_id, awardee.user)
 
+def transfer_participants_to_next_stage(stage_id: int, venue_id: int = -1) -> None:
+    """
+    Перевести призёров и победителей этапа на следующий этап
+    Уже существующие участия обновляются одним UPDATE, новые создаются через bulk_create
+    :param stage_id: id завершаемого этапа
+    :param venue_id: id площадки следующего этапа (-1 - первая площадка этапа, создаётся при отсутствии)
+    """
+    stage = Stage.objects.select_related('next_stage').get(id=stage_id)
+    next_stage = stage.next_stage
 
-def init_participants_id(stage):
+    with transaction.atomic():
+        if venue_id == -1:
+            venue = Venue.objects.filter(parental_stage_id=next_stage.id).first()
+            if venue is None:
+                venue = Venue.objects.create(name="Площадка для Яндекс.Контеста", address="Яндекс.Контест",
+                                             parental_stage=next_stage)
+            venue_id = venue.id
+        elif not Venue.objects.filter(id=venue_id, parental_stage__parent=stage.parent_id).exists():
+            raise ValueError
+
+        awardees = get_stage_awardees(stage).values('user')
+        transferred = StageParticipants.objects.filter(stage=next_stage, user__in=awardees)
+        existing = dict(transferred.values_list('user', 'venue'))
+        transferred.update(role=StageParticipants.Roles.PARTICIPANT, status=StageParticipants.Status.ACCEPTED,
+                           venue=venue_id)
+        StageParticipants.objects.bulk_create(
+            [StageParticipants(stage=next_stage, user_id=user_id, venue_id=venue_id,
+                               role=StageParticipants.Roles.PARTICIPANT, status=StageParticipants.Status.ACCEPTED)
+             for user_id in awardees.values_list('user', flat=True) if user_id not in existing],
+            ignore_conflicts=True,
+        )
+        # Места освобождаются на прежних площадках переведённых участников и занимаются на новой
+        recount_venue_participants(Venue.objects.filter(id__in={venue_id, *existing.values()} - {None}))
+        # bulk_create не отправляет post_save, счётчик заявок в сводке пересчитывается явно
+        refresh_event_summary(stage.parent_id)
+        invalidate_leaderboard_on_commit(next_stage.id)
+
+
+def init_participants_id(stage, contest_participants=None):
+    """
+    Сопоставить участников этапа с участниками контеста по email и сохранить их id в Яндекс.Контесте
+    :param stage: Этап
+    :param contest_participants: Участники контеста (по умолчанию запрашиваются у Яндекс.Контеста)
+    :return: Список участников этапа с заполненным yandex_contest_id
+    """
     if not stage.settings.contest_id:
-        return
-    participants = StageParticipants.objects.filter(stage=stage)
+        return []
+    if contest_participants is None:
+        contest_participants = contest.get_participants(stage.settings.contest_id)
+    participants = list(StageParticipants.objects.filter(stage=stage).select_related('user__user'))
     email_to_participant = dict()
     for participant in participants:
         email_to_participant[participant.user.user.email] = participant
-    contest_participants = contest.get_participants(stage.settings.contest_id)
+    updated = []
     for participant in contest_participants:
         participant = participant['participantInfo']
         try:
-            email_to_participant[participant["login"]].yandex_contest_id = participant["id"]
-            email_to_participant[participant["login"]].save()
+            email_to_participant[participant["login"]].yandex_contest_id = str(participant["id"])
+            updated.append(email_to_participant[participant["login"]])
         except Exception as e:
             print(e, f"User: {participant['login']}")
+    StageParticipants.objects.bulk_update(updated, ['yandex_contest_id'])
+    return participants
 
 
-def end_stage(stage, end_score):
-    if not stage.settings.contest_id:
-        print("No contest")
-        return
-    init_participants_id(stage)
-    contest_id = stage.settings.contest_id
-    score_board = contest.get_standings(contest_id)
-
-    participants = StageParticipants.objects.filter(stage=stage)
+def apply_stage_scores(participants, score_board, end_score) -> None:
+    """
+    Проставить участникам баллы из таблицы результатов контеста
+    :param participants: Участники этапа с заполненным yandex_contest_id
+    :param score_board: Строки таблицы результатов Яндекс.Контеста
+    :param end_score: Проходной балл: набравшие не меньше становятся призёрами
+    """
     id_to_paticipants = dict()
     for participant in participants:
         id_to_paticipants[participant.yandex_contest_id] = participant
+    updated = []
     for score in score_board:
         info = score['participantInfo']
         score = score['score']
         try:
-            id_to_paticipants[str(info['id'])].score = int(score)
+            participant = id_to_paticipants[str(info['id'])]
+            participant.score = int(score)
             if (int(score)) >= end_score:
-                id_to_paticipants[str(info['id'])].role = StageParticipants.Roles.AWARDEE
-            id_to_paticipants[str(info['id'])].save()
+                participant.role = StageParticipants.Roles.AWARDEE
+            updated.append(participant)
         except Exception as e:
             print(e, info)
+    StageParticipants.objects.bulk_update(updated, ['score', 'role'])
+    # bulk_update не отправляет post_save, поэтому рейтинг сбрасывается явно
+    for stage_id in {participant.stage_id for participant in updated}:
+        invalidate_leaderboard_on_commit(stage_id)
+
+
+def end_stage(stage, end_score, progress=None):
+    """
+    Завершить этап: забрать результаты из Яндекс.Контеста, проставить баллы
+    и перевести прошедших участников на следующий этап
+    Запросы к Яндекс.Контесту выполняются до транзакции, изменения в базе - одной транзакцией
+    :param stage: Этап
+    :param end_score: Проходной балл
+    :param progress: Функция progress(процент, сообщение) для отчёта о ходе выполнения
+    :raises ValueError: У этапа не указан контест
+    """
+    progress = progress or (lambda percent, message: None)
+    if not stage.settings.contest_id:
+        raise ValueError(f"У этапа {stage.id} не указан контест Яндекс.Контеста")
+    contest_id = stage.settings.contest_id
+    contest_participants = contest.get_participants(contest_id)
+    score_board = contest.get_standings(contest_id)
+    progress(30, "Результаты получены из Яндекс.Контеста")
+
+    with transaction.atomic():
+        participants = init_participants_id(stage, contest_participants)
+        apply_stage_scores(participants, score_board, end_score)
+        progress(60, "Баллы проставлены")
+        if stage.next_stage:
+            transfer_participants_to_next_stage(stage.id)
+            progress(80, "Участники переведены на следующий этап")
 
     if not stage.next_stage:
         return
-    transfer_participants_to_next_stage(stage.id)
-    awardees = StageParticipants.objects.filter(stage=stage,
-                                                status=200, role__in=[StageParticipants.Roles.AWARDEE,
-                                                                      StageParticipants.Roles.WINNER])
-
-    login_list = list()
-    for awardee in awardees:
-        login_list.append(awardee.user.user.email)
+    login_list = list(get_stage_awardees(stage).values_list('user__user__email', flat=True))
     contest.register_participants(stage.next_stage.settings.contest_id, login_list)
+    progress(100, "Участники зарегистрированы в Яндекс.Контесте")
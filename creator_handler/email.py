@@ -1,16 +1,211 @@
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.query import QuerySet
 from django.forms.widgets import Textarea
 from django.forms.widgets import TextInput
+from django.utils import timezone
+from datetime import timedelta
+from smtplib import SMTPException, SMTPRecipientsRefused
+from time import monotonic, sleep
+from typing import Iterable, List
 
-from user_handler.models import User
+from creator_handler.models import Newsletter, OutboxMessage
 
+FROM_EMAIL = 'distrib.events@gmail.com'
+OUTBOX_BATCH_SIZE = 100  # Сколько писем из исходящих загружается за один запрос
 
-def send_message(participants, text: str, subject: str = "Уведомление"):
-    participant: User
-    for participant in participants:
-        send_mail(
-            str(subject),
-            str(text),
-            'distrib.events@gmail.com',
-            [participant.user.user.email],
+
+def get_recipient_emails(participants) -> List[str]:
+    """
+    Получить адреса участников без повторов и пустых значений
+    :param participants: QuerySet или список StageParticipants
+    :return: Список адресов в порядке первого появления
+    """
+    if isinstance(participants, QuerySet):
+        emails = participants.values_list('user__user__email', flat=True)
+    else:
+        emails = [participant.user.user.email for participant in participants]
+    unique_emails = dict()
+    for email in emails:
+        if email:
+            unique_emails.setdefault(email.strip().lower(), email.strip())
+    return list(unique_emails.values())
+
+
+def send_bulk(emails: Iterable[str], text: str, subject: str = "Уведомление", batch_size: int = None,
+              connection=None) -> int:
+    """
+    Отправить письмо каждому адресату отдельно через одно SMTP-соединение
+    :param emails: Адреса получателей
+    :param batch_size: Сколько писем передавать в соединение за раз (по умолчанию settings.MAIL_BATCH_SIZE)
+    :param connection: Соединение вызывающего кода (по умолчанию открывается и закрывается новое)
+    :return: Количество отправленных писем
+    """
+    batch_size = batch_size or getattr(settings, 'MAIL_BATCH_SIZE', 50)
+    emails = list(emails)
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection()
+        connection.open()
+    sent = 0
+    try:
+        for start in range(0, len(emails), batch_size):
+            messages = [EmailMessage(str(subject), str(text), FROM_EMAIL, [email])
+                        for email in emails[start:start + batch_size]]
+            sent += connection.send_messages(messages) or 0
+    finally:
+        if own_connection:
+            connection.close()
+    return sent
+
+
+def send_message(participants, text: str, subject: str = "Уведомление", batch_size: int = None) -> int:
+    return send_bulk(get_recipient_emails(participants), text, subject, batch_size)
+
+
+def create_newsletter(event, participants, text: str, subject: str = "Уведомление") -> Newsletter:
+    """
+    Сохранить рассылку и по письму на каждого получателя в исходящие
+    :param event: Мероприятие
+    :param participants: Участники мероприятия (QuerySet или список StageParticipants)
+    :return: Рассылка
+    """
+    with transaction.atomic():
+        newsletter = Newsletter.objects.create(event=event, subject=subject, text=text)
+        OutboxMessage.objects.bulk_create(
+            OutboxMessage(newsletter=newsletter, recipient=email) for email in get_recipient_emails(participants)
         )
+    return newsletter
+
+
+def drain_outbox(newsletter_id: int = None, rate: float = None, max_attempts: int = None, limit: int = None,
+                 retry_delay: float = 5, progress=None) -> dict:
+    """
+    Отправить ожидающие письма из исходящих
+    Перед отправкой письмо переводится в SENDING условным UPDATE, поэтому несколько обработчиков
+    не отправят одно письмо дважды. Статус письма сохраняется сразу после отправки, поэтому прерванную
+    отправку можно продолжить с того же места. Временные ошибки SMTP повторяются до max_attempts раз,
+    адрес, отклонённый сервером, сразу помечается как FAILED
+    :param newsletter_id: Отправлять только письма этой рассылки (None - все)
+    :param rate: Не больше rate писем в секунду (по умолчанию settings.NEWSLETTER_RATE)
+    :param max_attempts: Количество попыток (по умолчанию settings.NEWSLETTER_MAX_ATTEMPTS)
+    :param limit: Отправить не больше limit писем
+    :param retry_delay: Пауза перед повторной отправкой писем с временной ошибкой, с
+    :param progress: Функция progress(отправлено, всего) для отчёта о ходе отправки
+    :return: Словарь со счётчиками sent, failed, pending
+    """
+    rate = rate or getattr(settings, 'NEWSLETTER_RATE', 1)
+    max_attempts = max_attempts or getattr(settings, 'NEWSLETTER_MAX_ATTEMPTS', 5)
+    requeue_stale_outbox(timedelta(seconds=getattr(settings, 'NEWSLETTER_STALE_AFTER', 600)))
+    messages = OutboxMessage.objects.filter(status=OutboxMessage.Status.PENDING)
+    if newsletter_id is not None:
+        messages = messages.filter(newsletter=newsletter_id)
+    total = messages.count()
+
+    counters = {'sent': 0, 'failed': 0}
+    next_slot = monotonic()
+    connection = get_connection()
+    try:
+        while True:
+            has_retries = False
+            for message in _iter_outbox(messages):
+                if limit is not None and counters['sent'] + counters['failed'] >= limit:
+                    break
+                if not _claim_outbox_message(message):
+                    continue
+                delay = next_slot - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                next_slot = max(next_slot, monotonic()) + 1 / rate
+
+                status = _send_outbox_message(connection, message, max_attempts)
+                if status == OutboxMessage.Status.SENT:
+                    counters['sent'] += 1
+                elif status == OutboxMessage.Status.FAILED:
+                    counters['failed'] += 1
+                else:
+                    has_retries = True
+                if progress is not None and (counters['sent'] + counters['failed']) % OUTBOX_BATCH_SIZE == 0:
+                    progress(counters['sent'], total)
+            else:
+                if has_retries:
+                    sleep(retry_delay)
+                    continue
+            break
+    finally:
+        connection.close()
+    if progress is not None:
+        progress(counters['sent'], total)
+    counters['pending'] = messages.count()
+    return counters
+
+
+def _iter_outbox(messages):
+    """
+    Обойти письма из исходящих порциями по OUTBOX_BATCH_SIZE в порядке id
+    """
+    last_id = 0
+    while True:
+        batch = list(messages.filter(id__gt=last_id).select_related('newsletter').order_by('id')[:OUTBOX_BATCH_SIZE])
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+
+
+def _claim_outbox_message(message: OutboxMessage) -> bool:
+    """
+    Взять письмо в отправку: False, если его уже забрал другой обработчик
+    """
+    return OutboxMessage.objects.filter(id=message.id, status=OutboxMessage.Status.PENDING) \
+        .update(status=OutboxMessage.Status.SENDING, claimed_at=timezone.now()) == 1
+
+
+def requeue_stale_outbox(timeout: timedelta) -> int:
+    """
+    Вернуть в ожидающие письма, которые находятся в отправке дольше timeout (например, если обработчик
+    был остановлен). Письмо, отправленное перед остановкой, может уйти повторно
+    :return: Количество возвращённых писем
+    """
+    return OutboxMessage.objects.filter(status=OutboxMessage.Status.SENDING,
+                                        claimed_at__lt=timezone.now() - timeout) \
+        .update(status=OutboxMessage.Status.PENDING)
+
+
+def get_newsletter_counters(newsletter_id: int) -> dict:
+    """
+    Количество писем рассылки по статусам
+    :return: Словарь со счётчиками sent, failed, pending, sending и total
+    """
+    counters = {'sent': 0, 'failed': 0, 'pending': 0, 'sending': 0}
+    names = {OutboxMessage.Status.SENT: 'sent', OutboxMessage.Status.FAILED: 'failed',
+             OutboxMessage.Status.SENDING: 'sending'}
+    for status, count in OutboxMessage.objects.filter(newsletter=newsletter_id).order_by().values('status') \
+            .annotate(count=Count('id')).values_list('status', 'count'):
+        counters[names.get(status, 'pending')] += count
+    counters['total'] = sum(counters.values())
+    return counters
+
+
+def _send_outbox_message(connection, message: OutboxMessage, max_attempts: int) -> int:
+    """
+    Отправить одно письмо из исходящих и сохранить результат
+    :return: Новый статус письма
+    """
+    newsletter = message.newsletter
+    try:
+        connection.send_messages([EmailMessage(str(newsletter.subject), str(newsletter.text), FROM_EMAIL,
+                                               [message.recipient])])
+    except (SMTPException, OSError) as e:
+        permanent = isinstance(e, SMTPRecipientsRefused) or message.attempts + 1 >= max_attempts
+        status = OutboxMessage.Status.FAILED if permanent else OutboxMessage.Status.PENDING
+        OutboxMessage.objects.filter(id=message.id).update(status=status, attempts=F('attempts') + 1,
+                                                           last_error=str(e))
+        # После ошибки соединение могло закрыться: следующее письмо откроет новое
+        connection.close()
+        return status
+    OutboxMessage.objects.filter(id=message.id).update(status=OutboxMessage.Status.SENT,
+                                                       attempts=F('attempts') + 1, sent_at=timezone.now())
+    return OutboxMessage.Status.SENT
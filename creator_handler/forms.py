@@ -1,5 +1,9 @@
 from django import forms
 from event_handler.models import StageStaff
+from user_handler.regions.regions_dict import DATA_REGIONS
+
+REGION_NAMES = dict(DATA_REGIONS)
+REGION_CODES = {name.lower(): code for code, name in DATA_REGIONS}
 
 
 class StaffForm(forms.ModelForm):
@@ -37,6 +41,28 @@ class VenueForm(forms.Form):
     contacts = forms.CharField(label='Контакты', required=False, max_length=100, widget=forms.Textarea)
 
 
+class VenueImportForm(VenueForm):
+    """
+    Класс **VenueImportForm**
+
+    Проверка одной строки импорта площадок: поля как у VenueForm,
+    регион задаётся кодом или названием из user_handler/regions/regions_dict.py
+
+    """
+
+    region = forms.CharField(label='Регион', required=False)
+
+    def clean_region(self):
+        region = self.cleaned_data['region'].strip()
+        if not region:
+            return None
+        if region.isdigit() and int(region) in REGION_NAMES:
+            return int(region)
+        if region.lower() in REGION_CODES:
+            return REGION_CODES[region.lower()]
+        raise forms.ValidationError(f"Неизвестный регион: {region}")
+
+
 class EmailForm(forms.Form):
     """
         Форма для массовой отправки email
@@ -0,0 +1,174 @@
+from datetime import timedelta
+from typing import Callable, Dict, Optional
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from creator_handler.models import Job
+from creator_handler import email
+import creator_handler.db_controller as c_db
+
+logger = logging.getLogger(__name__)
+
+HANDLERS: Dict[str, Callable] = {}  # Обработчики задач по их типу
+
+
+def job_handler(kind: str):
+    """
+    Зарегистрировать обработчик задач типа kind
+    Обработчик получает задачу и параметры из payload и должен быть идемпотентным:
+    задачу с тем же ключом можно запустить повторно
+    """
+    def decorator(handler: Callable) -> Callable:
+        HANDLERS[kind] = handler
+        return handler
+    return decorator
+
+
+def enqueue(kind: str, key: str, payload: dict = None) -> Job:
+    """
+    Поставить задачу в очередь
+    Если задача с таким ключом ждёт или выполняется, возвращается она же,
+    завершённая задача ставится в очередь повторно
+    :param kind: Тип задачи
+    :param key: Ключ задачи
+    :param payload: Параметры обработчика
+    :return: Задача
+    """
+    payload = payload or {}
+    with transaction.atomic():
+        job, created = Job.objects.select_for_update().get_or_create(key=key,
+                                                                     defaults={'kind': kind, 'payload': payload})
+        if not created and job.status in (Job.Status.DONE, Job.Status.FAILED):
+            job.kind = kind
+            job.payload = payload
+            job.status = Job.Status.WAITING
+            job.progress = 0
+            job.message = ""
+            job.run_after = None
+            job.save()
+    return job
+
+
+def report_progress(job: Job, progress: int, message: str = "") -> None:
+    """
+    Сохранить прогресс выполнения задачи
+    :param job: Задача
+    :param progress: Прогресс в процентах
+    :param message: Сообщение для пользователя
+    """
+    job.progress = max(0, min(100, int(progress)))
+    job.message = message
+    Job.objects.filter(id=job.id).update(progress=job.progress, message=message, updated_at=timezone.now())
+
+
+def claim_next_job() -> Optional[Job]:
+    """
+    Забрать из очереди самую старую ожидающую задачу, время запуска которой наступило
+    Задача переводится в RUNNING условным UPDATE, поэтому два обработчика не возьмут одну задачу
+    :return: Задача или None, если очередь пуста
+    """
+    while True:
+        job = Job.objects.filter(Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()),
+                                 status=Job.Status.WAITING).order_by('created_at', 'id').first()
+        if job is None:
+            return None
+        claimed = Job.objects.filter(id=job.id, status=Job.Status.WAITING) \
+            .update(status=Job.Status.RUNNING, attempts=F('attempts') + 1, updated_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def continue_later(job: Job, delay: timedelta = None) -> None:
+    """
+    Вернуть выполняемую задачу в конец очереди, чтобы продолжить её после других задач
+    (обработчик сделал часть работы и завершается)
+    :param job: Задача в статусе RUNNING
+    :param delay: Запустить задачу не раньше, чем через delay (None - как только дойдёт очередь)
+    """
+    now = timezone.now()
+    Job.objects.filter(id=job.id).update(status=Job.Status.WAITING, created_at=now, updated_at=now,
+                                         run_after=now + delay if delay is not None else None)
+
+
+def run_job(job: Job) -> None:
+    """
+    Выполнить задачу и сохранить результат
+    :param job: Задача в статусе RUNNING
+    """
+    handler = HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+        handler(job, **job.payload)
+    except Exception as e:
+        logger.exception("Job %s failed", job.key)
+        Job.objects.filter(id=job.id).update(status=Job.Status.FAILED, message=str(e), updated_at=timezone.now())
+        return
+    Job.objects.filter(id=job.id, status=Job.Status.RUNNING) \
+        .update(status=Job.Status.DONE, progress=100, updated_at=timezone.now())
+
+
+def run_pending_jobs(limit: int = None) -> int:
+    """
+    Выполнить ожидающие задачи
+    :param limit: Максимальное количество задач (None - пока очередь не опустеет)
+    :return: Количество выполненных задач
+    """
+    done = 0
+    while limit is None or done < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        done += 1
+    return done
+
+
+def requeue_stale_jobs(timeout: timedelta) -> int:
+    """
+    Вернуть в очередь задачи, которые выполняются дольше timeout без отчёта о прогрессе
+    (например, если обработчик был остановлен)
+    :return: Количество возвращённых задач
+    """
+    return Job.objects.filter(status=Job.Status.RUNNING, updated_at__lt=timezone.now() - timeout) \
+        .update(status=Job.Status.WAITING, updated_at=timezone.now())
+
+
+def enqueue_end_stage(stage_id: int, event_id: int, end_score: int = 1) -> Job:
+    return enqueue("end_stage", f"end_stage:{stage_id}",
+                   {'stage_id': stage_id, 'event_id': event_id, 'end_score': end_score})
+
+
+@job_handler("end_stage")
+def end_stage_job(job: Job, stage_id: int, end_score: int, **kwargs) -> None:
+    stage = c_db.get_stage_by_id(stage_id)
+    c_db.end_stage(stage, end_score, progress=lambda progress, message: report_progress(job, progress, message))
+
+
+def enqueue_newsletter(event_id: int, subject: str, text: str) -> Job:
+    event = c_db.get_event_by_id(event_id)
+    newsletter = email.create_newsletter(event, c_db.get_participants_by_event(event), text, subject)
+    return enqueue("newsletter", f"newsletter:{newsletter.id}", {'newsletter_id': newsletter.id, 'event_id': event_id})
+
+
+@job_handler("newsletter")
+def newsletter_job(job: Job, newsletter_id: int, **kwargs) -> None:
+    # Одна порция писем за запуск: при NEWSLETTER_RATE = 1 вся рассылка заняла бы обработчик на часы
+    email.drain_outbox(newsletter_id, limit=getattr(settings, 'NEWSLETTER_JOB_BATCH', 60))
+    counters = email.get_newsletter_counters(newsletter_id)
+    done = counters['sent'] + counters['failed']
+    message = f"Отправлено писем: {counters['sent']} из {counters['total']}"
+    if counters['failed']:
+        message += f", не доставлено: {counters['failed']}"
+    report_progress(job, 100 * done // counters['total'] if counters['total'] else 100, message)
+    if counters['pending']:
+        continue_later(job)
+    elif counters['sending']:
+        # Оставшиеся письма отправляет другой обработчик или они зависли и вернутся в ожидающие
+        # через NEWSLETTER_STALE_AFTER: проверить позже, а не запускать задачу снова сразу
+        continue_later(job, timedelta(seconds=getattr(settings, 'NEWSLETTER_JOB_RETRY_AFTER', 60)))
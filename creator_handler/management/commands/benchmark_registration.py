@@ -0,0 +1,220 @@
+import json
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth.models import User as DjangoUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection, connections, transaction
+from django.db.models import Max, Sum
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from creator_handler import benchmark
+from creator_handler.models import StageSettings
+from distributedEvents.sqlite import BASELINE_PRAGMAS, get_current_pragmas
+from event_handler.models import Event, Stage, StageParticipants, Venue
+from user_handler.models import PersonalData
+import creator_handler.db_controller as c_db
+
+
+@contextmanager
+def baseline_profile():
+    """
+    Настройки SQLite и соединений до оптимизации: журнал DELETE, synchronous FULL, новое соединение на каждый запрос
+    """
+    connection.close()
+    database = connections.settings[DEFAULT_DB_ALIAS]
+    conn_max_age = database['CONN_MAX_AGE']
+    database['CONN_MAX_AGE'] = 0
+    try:
+        with override_settings(SQLITE_PRAGMAS=BASELINE_PRAGMAS):
+            yield
+    finally:
+        database['CONN_MAX_AGE'] = conn_max_age
+        # Следующее соединение снова выполнит PRAGMA из settings.SQLITE_PRAGMAS
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Одновременная регистрация многих пользователей на этап (SQLite)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8, help="Количество одновременных клиентов (потоков)")
+        parser.add_argument("--users", type=int, default=1000, help="Количество регистрирующихся пользователей")
+        parser.add_argument("--venues", type=int, default=10, help="Количество площадок этапа")
+        parser.add_argument("--capacity", type=int, default=80, help="Вместимость каждой площадки")
+        parser.add_argument("--repeat", type=int, default=2,
+                            help="Сколько раз каждый пользователь отправляет форму (повторы проверяют защиту от дублей)")
+        parser.add_argument("--mode", choices=["view", "db"], default="view",
+                            help="view - POST через тестовый клиент, db - прямой вызов register_on_stage")
+        parser.add_argument("--output", help="Сохранить отчёт в json-файл")
+        parser.add_argument("--keep", action="store_true", help="Не удалять созданные данные")
+        parser.add_argument("--compare-baseline", action="store_true",
+                            help="Сначала замерить с настройками SQLite по умолчанию и без постоянных соединений, "
+                                 "затем с текущими настройками, и сравнить")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Замер рассчитан на SQLite")
+        if connection.is_in_memory_db():
+            raise CommandError("Нужна база в файле: в памяти потоки не видят общих данных")
+
+        profiles = [("baseline", baseline_profile), ("tuned", nullcontext)] if options["compare_baseline"] \
+            else [("current", nullcontext)]
+        reports = {}
+        for name, profile in profiles:
+            with profile():
+                reports[name] = self.measure(options)
+            self.stdout.write(f"[{name}]")
+            for key, value in reports[name].items():
+                self.stdout.write(f"{key}: {value}")
+
+        if options["compare_baseline"]:
+            before, after = reports["baseline"], reports["tuned"]
+            for key in ('requests_per_second', 'p50_ms', 'p99_ms'):
+                self.stdout.write(f"{key}: {before[key]} -> {after[key]}")
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(reports, file, ensure_ascii=False, indent=2)
+        if not all(report['check']['ok'] for report in reports.values()):
+            raise CommandError("Нарушены ограничения регистрации")
+
+    def measure(self, options: dict) -> dict:
+        pragmas = get_current_pragmas(connection)
+        stage, users = self.prepare(options)
+        try:
+            report = self.run(stage, users, options)
+            report['check'] = self.verify(stage, report, options["capacity"])
+        finally:
+            if not options["keep"]:
+                self.cleanup(stage, users)
+        report['pragmas'] = pragmas
+        report['conn_max_age'] = connection.settings_dict['CONN_MAX_AGE']
+        return report
+
+    def prepare(self, options: dict):
+        with transaction.atomic():
+            event = Event.objects.create(name="Нагрузочная регистрация")
+            stage = c_db.make_record_stage("Отбор", event)
+            stage.settings.can_register = True
+            stage.settings.save()
+            Venue.objects.bulk_create(
+                Venue(name=f"Площадка {index + 1}", address="ул. Тестовая", participants_maximum=options["capacity"],
+                      parental_stage=stage)
+                for index in range(options["venues"])
+            )
+            users = benchmark.create_users(options["users"], f"registration{event.id}")
+        return Stage.objects.select_related('settings').get(id=stage.id), users
+
+    def run(self, stage: Stage, users: list, options: dict) -> dict:
+        venue_ids = list(Venue.objects.filter(parental_stage=stage).values_list('id', flat=True))
+        clients = max(1, options["clients"])
+        chunks = [users[index::clients] for index in range(clients)]
+        barrier = threading.Barrier(clients + 1)
+        timings = []
+        outcomes = Counter()
+        lock = threading.Lock()
+
+        def worker(chunk):
+            local_timings = []
+            local_outcomes = Counter()
+            try:
+                requests = self.make_requests(chunk, stage, options["mode"])
+                barrier.wait()
+                for attempt in range(options["repeat"]):
+                    for index, request in enumerate(requests):
+                        started = perf_counter()
+                        # Как обработчик запросов: закрыть соединение, если оно устарело по CONN_MAX_AGE
+                        # (тестовый клиент этого не делает)
+                        close_old_connections()
+                        try:
+                            outcome = request(venue_ids[(index + attempt) % len(venue_ids)])
+                        except Exception as e:
+                            outcome = type(e).__name__
+                        close_old_connections()
+                        local_timings.append((perf_counter() - started) * 1000)
+                        local_outcomes[outcome] += 1
+            finally:
+                connection.close()
+                with lock:
+                    timings.extend(local_timings)
+                    outcomes.update(local_outcomes)
+
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            started = perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = perf_counter() - started
+
+        return {
+            'mode': options["mode"],
+            'clients': clients,
+            'requests': len(timings),
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(timings) / elapsed, 1) if elapsed else 0,
+            'p50_ms': round(benchmark.percentile(timings, 50), 3),
+            'p90_ms': round(benchmark.percentile(timings, 90), 3),
+            'p99_ms': round(benchmark.percentile(timings, 99), 3),
+            'outcomes': dict(outcomes),
+        }
+
+    @staticmethod
+    def make_requests(users: list, stage: Stage, mode: str) -> list:
+        """
+        Подготовить по функции регистрации на каждого пользователя: функция получает id площадки
+        и возвращает название результата
+        """
+        if mode == "db":
+            return [lambda venue_id, user=user: c_db.register_on_stage(stage, venue_id, user).name for user in users]
+
+        url = reverse("current_stage_registration", kwargs={'stage_id': stage.id})
+        success_url = reverse("all_events")
+        client = Client(raise_request_exception=False)
+        cookies = []
+        for user in users:
+            # Без cookie force_login создаёт новую сессию, а не заменяет пользователя в прошлой
+            client.cookies.pop(settings.SESSION_COOKIE_NAME, None)
+            client.force_login(user.user)
+            cookies.append(client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+        def request(venue_id, session):
+            client.cookies[settings.SESSION_COOKIE_NAME] = session
+            response = client.post(url, {'venue_id': venue_id})
+            if response.status_code == 302 and response.url == success_url:
+                return "REGISTERED"
+            return f"HTTP {response.status_code}" + (f" {response.url}" if response.status_code == 302 else "")
+
+        return [lambda venue_id, session=session: request(venue_id, session) for session in cookies]
+
+    @staticmethod
+    def verify(stage: Stage, report: dict, capacity: int) -> dict:
+        participants = StageParticipants.objects.filter(stage=stage)
+        venues = Venue.objects.filter(parental_stage=stage).aggregate(total=Sum('participants_count'),
+                                                                      fullest=Max('participants_count'))
+        registered = participants.count()
+        check = {
+            'participants': registered,
+            'registered_responses': report['outcomes'].get("REGISTERED", 0),
+            'seats_taken': venues['total'] or 0,
+            'fullest_venue': venues['fullest'] or 0,
+        }
+        check['ok'] = registered == check['registered_responses'] == check['seats_taken'] and \
+            check['fullest_venue'] <= capacity
+        return check
+
+    @staticmethod
+    def cleanup(stage: Stage, users: list):
+        with transaction.atomic():
+            settings_id = stage.settings_id
+            Event.objects.filter(id=stage.parent_id).delete()
+            StageSettings.objects.filter(id=settings_id).delete()
+            personal_data = [user.personal_data_id for user in users]
+            DjangoUser.objects.filter(id__in=[user.user_id for user in users]).delete()
+            PersonalData.objects.filter(id__in=personal_data).delete()
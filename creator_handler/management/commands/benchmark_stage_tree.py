@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from creator_handler import benchmark
+from event_handler.models import Event
+import creator_handler.db_controller as c_db
+
+
+class Command(BaseCommand):
+    help = "Замерить обход и удаление ветки синтетического дерева этапов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=10000, help="Количество этапов в дереве")
+        parser.add_argument("--fanout", type=int, default=4, help="Количество предшествующих этапов у каждого этапа")
+        parser.add_argument("--runs", type=int, default=5, help="Количество замеров каждого сценария")
+        parser.add_argument("--warmup", type=int, default=1, help="Количество запусков до замеров")
+
+    def handle(self, *args, **options):
+        if options["size"] < 2 or options["fanout"] < 1:
+            raise CommandError("Нужно хотя бы два этапа и один предшествующий этап у каждого")
+        # Дерево создаётся в транзакции и откатывается после замеров
+        with transaction.atomic():
+            event = Event.objects.create(name="Синтетическое дерево этапов")
+            stages = benchmark.create_stage_tree(event, options["size"], options["fanout"])
+            c_db.rebuild_stage_tree(event.id)
+            branch = stages[1]
+            branch_size = len(c_db.get_stage_subtree(branch.id))
+
+            results = {
+                f"get_stage_subtree ({len(stages)})":
+                    benchmark.measure(lambda: c_db.get_stage_subtree(stages[0].id), options["runs"],
+                                      options["warmup"]),
+                f"delete_stage_recursive ({branch_size})":
+                    benchmark.measure(lambda: c_db.delete_stage_recursive(branch.id), options["runs"],
+                                      options["warmup"]),
+            }
+            transaction.set_rollback(True)
+
+        for name, result in results.items():
+            self.stdout.write(f"{name:<36} p50 {result['p50_ms']:>9.1f} мс  p90 {result['p90_ms']:>9.1f} мс  "
+                              f"запросов {result['queries']}")
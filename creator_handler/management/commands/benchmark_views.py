@@ -0,0 +1,147 @@
+import json
+from random import Random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from creator_handler import benchmark
+from event_handler.models import Event, Stage, StageParticipants, StageStaff, Venue
+import creator_handler.db_controller as c_db
+
+
+def get_scenarios(event: Event, final_stage: Stage, stage: Stage) -> list:
+    """
+    Сценарии нагрузки: страницы из distributedEvents/urls.py и завершение этапа
+    :param event: Мероприятие
+    :param final_stage: Финальный этап мероприятия
+    :param stage: Отборочный этап с наибольшим количеством участников
+    :return: Список (название, метод, адрес, кто выполняет запрос: "participant" или "staff")
+    """
+    return [
+        ("all_events", "get", reverse("all_events"), "participant"),
+        ("participant_event_list", "get", reverse("participant_event_list"), "participant"),
+        ("staff_event_list", "get", reverse("staff_event_list"), "staff"),
+        ("cur_event", "get", reverse("cur_event", kwargs={'event_id': event.id}), "participant"),
+        ("current_stage_registration", "get",
+         reverse("current_stage_registration", kwargs={'stage_id': stage.id}), "participant"),
+        ("all_participants", "get",
+         reverse("all_participants", kwargs={'event_id': event.id, 'stage_id': final_stage.id}), "participant"),
+        ("participants_list", "get", reverse("participants_list", kwargs={'event_id': event.id}), "staff"),
+        ("stages_list", "get", reverse("stages_list", kwargs={'event_id': event.id}), "staff"),
+        ("venues_list", "get", reverse("test", kwargs={'event_id': event.id}), "staff"),
+        ("end_stage", "post", reverse("end_stage", kwargs={'event_id': event.id, 'stage_id': stage.id}), "staff"),
+    ]
+
+
+def make_contest_results(stage: Stage, seed: int = 0):
+    """
+    Участники и таблица результатов контеста в формате Яндекс.Контеста для всех участников этапа
+    """
+    rng = Random(seed)
+    emails = StageParticipants.objects.filter(stage=stage).values_list('user__user__email', flat=True)
+    infos = [{'id': index + 1, 'login': email} for index, email in enumerate(emails)]
+    score_board = [{'participantInfo': info, 'score': rng.randint(0, 100)} for info in infos]
+    return [{'participantInfo': info} for info in infos], score_board
+
+
+class Command(BaseCommand):
+    help = "Замерить время ответа и количество SQL-запросов основных страниц на текущей базе"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--event", type=int, help="id мероприятия (по умолчанию с наибольшим числом заявок)")
+        parser.add_argument("--runs", type=int, default=20, help="Количество замеров каждого сценария")
+        parser.add_argument("--warmup", type=int, default=2, help="Количество запусков до замеров")
+        parser.add_argument("--only", nargs="*", help="Запустить только эти сценарии")
+        parser.add_argument("--output", help="Сохранить отчёт в json-файл")
+        parser.add_argument("--compare", help="Сравнить с сохранённым отчётом")
+        parser.add_argument("--max-regression", type=float,
+                            help="Завершиться с ошибкой, если p50 какого-то сценария вырос больше чем на столько %%")
+
+    def handle(self, *args, **options):
+        event = self.get_event(options["event"])
+        stages = Stage.objects.filter(parent=event)
+        final_stage = stages.filter(next_stage__isnull=True).order_by('id').first()
+        stage = stages.annotate(participants=Count('stageparticipants')).order_by('-participants', 'id').first()
+        staff = StageStaff.objects.filter(stage=final_stage, status=StageStaff.Status.ACCEPTED) \
+            .select_related('user__user').first()
+        participant = StageParticipants.objects.filter(stage=stage).select_related('user__user').first()
+        if staff is None or participant is None:
+            raise CommandError(f"У мероприятия {event.id} нет модератора финала или участников")
+        clients = {'staff': Client(), 'participant': Client()}
+        clients['staff'].force_login(staff.user.user)
+        clients['participant'].force_login(participant.user.user)
+
+        results = {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name, method, path, role in get_scenarios(event, final_stage, stage):
+                if options["only"] and name not in options["only"]:
+                    continue
+                responses = []
+                request = getattr(clients[role], method)
+                result = benchmark.measure(lambda: responses.append(request(path).status_code),
+                                           options["runs"], options["warmup"])
+                results[name] = {'path': path, 'status': responses[-1], **result}
+                self.write_result(name, results[name])
+
+        if not options["only"] or "end_stage_db" in options["only"]:
+            contest_participants, score_board = make_contest_results(stage)
+
+            def end_stage_db():
+                participants = c_db.init_participants_id(stage, contest_participants)
+                c_db.apply_stage_scores(participants, score_board, 80)
+                if stage.next_stage_id:
+                    c_db.transfer_participants_to_next_stage(stage.id)
+
+            results["end_stage_db"] = {'path': None, 'status': None,
+                                       **benchmark.measure(end_stage_db, options["runs"], options["warmup"])}
+            self.write_result("end_stage_db", results["end_stage_db"])
+
+        report = benchmark.make_report(results, {
+            'event': event.id,
+            'stage': stage.id,
+            'events': Event.objects.count(),
+            'stages': Stage.objects.count(),
+            'venues': Venue.objects.count(),
+            'participants': StageParticipants.objects.count(),
+        })
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Отчёт сохранён в {options['output']}")
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                self.write_comparison(benchmark.compare_reports(json.load(file), report), options["max_regression"])
+
+    @staticmethod
+    def get_event(event_id: int = None) -> Event:
+        if event_id is not None:
+            try:
+                return Event.objects.get(id=event_id)
+            except Event.DoesNotExist:
+                raise CommandError(f"Мероприятие {event_id} не найдено")
+        busiest = StageParticipants.objects.values('stage__parent').annotate(count=Count('id')) \
+            .order_by('-count').first()
+        if busiest is None:
+            raise CommandError("В базе нет заявок, сначала запустите generate_dataset")
+        return Event.objects.get(id=busiest['stage__parent'])
+
+    def write_result(self, name: str, result: dict):
+        status = f" [{result['status']}]" if result['status'] else ""
+        self.stdout.write(f"{name:<28}{status} p50 {result['p50_ms']:>9.1f} мс  p90 {result['p90_ms']:>9.1f} мс  "
+                          f"p99 {result['p99_ms']:>9.1f} мс  запросов {result['queries']}")
+
+    def write_comparison(self, rows: list, max_regression: float = None):
+        regressions = []
+        for row in rows:
+            line = f"{row['name']:<28} p50 {row['p50_before']:>9.1f} -> {row['p50_after']:>9.1f} мс " \
+                   f"({row['change_percent']:+.1f}%)  запросов {row['queries_before']} -> {row['queries_after']}"
+            if max_regression is not None and row['change_percent'] > max_regression:
+                regressions.append(row['name'])
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"Замедлились больше чем на {max_regression}%: {', '.join(regressions)}")
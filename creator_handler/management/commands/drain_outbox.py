@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from creator_handler.email import drain_outbox
+
+
+class Command(BaseCommand):
+    help = "Отправить ожидающие письма рассылок с ограничением скорости"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--newsletter", type=int, default=None, help="id рассылки (по умолчанию все)")
+        parser.add_argument("--rate", type=float, default=None,
+                            help="Писем в секунду (по умолчанию settings.NEWSLETTER_RATE)")
+        parser.add_argument("--max-attempts", type=int, default=None,
+                            help="Попыток на письмо (по умолчанию settings.NEWSLETTER_MAX_ATTEMPTS)")
+        parser.add_argument("--limit", type=int, default=None, help="Отправить не больше указанного числа писем")
+
+    def handle(self, *args, **options):
+        counters = drain_outbox(options["newsletter"], rate=options["rate"], max_attempts=options["max_attempts"],
+                                limit=options["limit"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Отправлено: {counters['sent']}, не доставлено: {counters['failed']}, ожидают: {counters['pending']}"
+        ))
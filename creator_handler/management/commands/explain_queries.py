@@ -0,0 +1,104 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+
+from event_handler.models import Stage, StageParticipants
+import creator_handler.db_controller as c_db
+import creator_handler.permissions as permissions
+import event_handler.db_controller as e_db
+import event_handler.leaderboard as leaderboard
+
+
+def get_core_queries(stage: Stage, participant: StageParticipants) -> list:
+    """
+    Основные запросы db_controller, для которых проверяется план выполнения
+    :param stage: Этап, на котором выполняются запросы
+    :param participant: Участник этапа
+    :return: Список пар (название, функция без параметров)
+    """
+    event = stage.parent
+    user = participant.user
+    django_user = user.user
+    return [
+        ("Каталог мероприятий", lambda: e_db.get_events_catalogue(django_user)),
+        ("Открытые этапы мероприятия", lambda: list(e_db.get_open_stages_by_event(event))),
+        ("Таблица результатов этапа", lambda: e_db.get_results_page(stage.id)),
+        ("Рейтинг этапа", lambda: leaderboard.compute_leaderboard_page(stage.id)),
+        ("Возможность регистрации на этап", lambda: e_db.can_user_register_on_stage(user, stage)),
+        ("Участие пользователя в этапе", lambda: e_db.check_user_participate_in_stage(django_user, stage)),
+        ("Права модератора", lambda: permissions.load_event_permissions(django_user, event.id)),
+        ("Участники мероприятия", lambda: list(c_db.get_event_partcipants(event.id))),
+        ("Площадки этапа", lambda: list(c_db.get_venues_by_stage_id(stage.id))),
+        ("Призёры этапа", lambda: list(c_db.get_stage_awardees(stage))),
+        ("Поддерево этапа", lambda: c_db.get_stage_subtree(stage.id)),
+        ("Смена роли по id в Яндекс.Контесте",
+         lambda: c_db.change_role_of_participation([participant.yandex_contest_id or "0"])),
+    ]
+
+
+def is_full_scan(plan_line: str) -> bool:
+    """
+    Строка плана SQLite означает полный просмотр таблицы без индекса
+    """
+    return " SCAN " in f" {plan_line} " and "USING" not in plan_line
+
+
+class Command(BaseCommand):
+    help = "Показать EXPLAIN QUERY PLAN основных запросов db_controller и отметить полные просмотры таблиц"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stage", type=int, help="id этапа (по умолчанию этап с наибольшим числом участников)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("EXPLAIN QUERY PLAN поддерживается только для SQLite")
+        stage = self.get_stage(options["stage"])
+        participant = StageParticipants.objects.filter(stage=stage).select_related('user__user').first()
+        if participant is None:
+            raise CommandError(f"На этапе {stage.id} нет участников")
+
+        scans = 0
+        for name, query in get_core_queries(stage, participant):
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for sql in self.capture(query):
+                self.stdout.write(f"  {sql}")
+                for plan_line in self.explain(sql):
+                    if is_full_scan(plan_line):
+                        scans += 1
+                        self.stdout.write(self.style.WARNING(f"    {plan_line}"))
+                    else:
+                        self.stdout.write(f"    {plan_line}")
+        summary = f"Полных просмотров таблиц: {scans}"
+        self.stdout.write(self.style.WARNING(summary) if scans else self.style.SUCCESS(summary))
+
+    @staticmethod
+    def get_stage(stage_id: int = None) -> Stage:
+        if stage_id is not None:
+            try:
+                return Stage.objects.select_related('parent', 'settings').get(id=stage_id)
+            except Stage.DoesNotExist:
+                raise CommandError(f"Этап {stage_id} не найден")
+        participant = StageParticipants.objects.values('stage').annotate(count=Count('id')) \
+            .order_by('-count').first()
+        if participant is None:
+            raise CommandError("В базе нет участников этапов")
+        return Stage.objects.select_related('parent', 'settings').get(id=participant['stage'])
+
+    @staticmethod
+    def capture(query) -> list:
+        """
+        Выполнить запрос в транзакции, которая затем откатывается, и вернуть выполненные SQL-запросы
+        """
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                query()
+            transaction.set_rollback(True)
+        return [item['sql'] for item in queries.captured_queries
+                if item['sql'].lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT"))]
+
+    @staticmethod
+    def explain(sql: str) -> list:
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return [row[-1] for row in cursor.fetchall()]
@@ -0,0 +1,135 @@
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from creator_handler.benchmark import REGIONS, create_users
+from creator_handler.db_controller import rebuild_stage_tree, reconcile_venue_counters
+from creator_handler.models import StageSettings
+from event_handler.models import Event, Stage, Venue, StageParticipants, StageStaff
+from event_handler.summary import rebuild_event_summaries
+
+
+class Command(BaseCommand):
+    help = "Сгенерировать синтетический набор данных для нагрузочного тестирования"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=3, help="Количество мероприятий")
+        parser.add_argument("--depth", type=int, default=3, help="Глубина дерева этапов (у финала 0)")
+        parser.add_argument("--branching", type=int, default=3, help="Количество предшествующих этапов у каждого")
+        parser.add_argument("--venues", type=int, default=1000, help="Количество площадок на мероприятие")
+        parser.add_argument("--participants", type=int, default=100000,
+                            help="Количество заявок на отборочные этапы по всем мероприятиям")
+        parser.add_argument("--prefix", default="bench", help="Префикс имён пользователей и мероприятий")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Размер пачки bulk_create")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["events"] < 1 or options["depth"] < 0 or options["branching"] < 1:
+            raise CommandError("Нужно хотя бы одно мероприятие и один этап")
+        self.rng = Random(options["seed"])
+        self.prefix = options["prefix"]
+        self.batch_size = options["batch_size"]
+        started = perf_counter()
+
+        per_event = max(1, options["participants"] // options["events"])
+        with transaction.atomic():
+            admin = create_users(1, self.prefix, "admin", self.batch_size, self.rng)[0]
+            users = create_users(per_event, self.prefix, "user", self.batch_size, self.rng)
+        self.stdout.write(f"Пользователей: {len(users) + 1}")
+
+        for number in range(options["events"]):
+            with transaction.atomic():
+                event = Event.objects.create(name=f"{self.prefix} {number + 1}",
+                                             description="Синтетическое мероприятие")
+                levels = self.create_stages(event, options["depth"], options["branching"])
+                StageStaff.objects.create(user=admin, stage=levels[0][0], role=StageStaff.Roles.PROVIDER,
+                                          status=StageStaff.Status.ACCEPTED)
+                stages = [stage for level in levels for stage in level]
+                venues = self.create_venues(stages, options["venues"])
+                participants = self.create_participants(levels[-1], venues, users)
+                rebuild_stage_tree(event.id)
+                # Заявки созданы через bulk_create в обход счётчиков мест
+                reconcile_venue_counters(event.id)
+                rebuild_event_summaries([event.id])
+            self.stdout.write(f"Мероприятие {event.id}: этапов {len(stages)}, площадок {options['venues']}, "
+                              f"заявок {participants}")
+        self.stdout.write(self.style.SUCCESS(f"Готово за {perf_counter() - started:.1f} с, "
+                                             f"модератор: {admin.user.username}"))
+
+    def create_stages(self, event: Event, depth: int, branching: int) -> list:
+        """
+        Создать полное дерево этапов: у финала branching предшествующих этапов, у каждого из них столько же и т.д.
+        :return: Этапы по уровням, от финального к отборочным
+        """
+        size = sum(branching ** level for level in range(depth + 1))
+        settings = StageSettings.objects.bulk_create(
+            StageSettings(contest_id=f"{self.prefix}-{event.id}-{index}") for index in range(size)
+        )
+        levels = [[Stage.objects.create(name="Финал", parent=event, settings=settings[0])]]
+        created = 1
+        for level in range(1, depth + 1):
+            parents = levels[-1]
+            stages = []
+            for start in range(0, len(parents) * branching, self.batch_size):
+                stages.extend(Stage.objects.bulk_create(
+                    Stage(name=f"Этап {level}.{index + 1}", parent=event,
+                          settings=settings[created + index], next_stage=parents[index // branching])
+                    for index in range(start, min(start + self.batch_size, len(parents) * branching))
+                ))
+            created += len(stages)
+            levels.append(stages)
+        # Регистрация открыта на отборочных этапах
+        StageSettings.objects.filter(stage__in=levels[-1]).update(can_register=True)
+        return levels
+
+    def create_venues(self, stages: list, count: int) -> dict:
+        """
+        Распределить площадки по этапам
+        :return: Словарь id этапа -> список id площадок
+        """
+        venues = []
+        for start in range(0, count, self.batch_size):
+            venues.extend(Venue.objects.bulk_create(
+                Venue(name=f"Площадка {index + 1}", address=f"ул. Тестовая, {index + 1}",
+                      region=self.rng.randint(1, REGIONS), participants_maximum=self.rng.randint(50, 500),
+                      parental_stage=stages[index % len(stages)])
+                for index in range(start, min(start + self.batch_size, count))
+            ))
+        stage_venues = {}
+        for venue in venues:
+            stage_venues.setdefault(venue.parental_stage_id, []).append(venue.id)
+        return stage_venues
+
+    def create_participants(self, stages: list, venues: dict, users: list) -> int:
+        """
+        Распределить пользователей по отборочным этапам, часть прошедших перевести на следующий этап
+        :return: Количество созданных заявок
+        """
+        statuses = [StageParticipants.Status.ACCEPTED] * 7 + [StageParticipants.Status.AWAITED] * 2 + \
+                   [StageParticipants.Status.REJECTED]
+        users = list(users)
+        self.rng.shuffle(users)
+        created = 0
+        for start in range(0, len(users), self.batch_size):
+            batch = []
+            for index in range(start, min(start + self.batch_size, len(users))):
+                stage = stages[index % len(stages)]
+                status = self.rng.choice(statuses)
+                score = self.rng.randint(0, 100) if status == StageParticipants.Status.ACCEPTED else 0
+                awardee = score >= 80
+                batch.append(StageParticipants(
+                    stage=stage, user=users[index], venue_id=self.rng.choice(venues.get(stage.id, [None])),
+                    status=status, score=score, yandex_contest_id=str(index + 1),
+                    role=StageParticipants.Roles.AWARDEE if awardee else StageParticipants.Roles.PARTICIPANT,
+                ))
+                if awardee and stage.next_stage_id:
+                    batch.append(StageParticipants(
+                        stage_id=stage.next_stage_id, user=users[index],
+                        venue_id=self.rng.choice(venues.get(stage.next_stage_id, [None])),
+                        status=StageParticipants.Status.ACCEPTED,
+                    ))
+            StageParticipants.objects.bulk_create(batch)
+            created += len(batch)
+        return created
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from event_handler.summary import rebuild_event_summaries
+
+
+class Command(BaseCommand):
+    help = "Пересчитать сводки мероприятий для списков мероприятий (например, после загрузки фикстур)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("event_ids", nargs="*", type=int, help="id мероприятий (по умолчанию все)")
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild_event_summaries(options["event_ids"] or None)
+        self.stdout.write(self.style.SUCCESS(f"Сводки мероприятий пересчитаны: {rebuilt}"))
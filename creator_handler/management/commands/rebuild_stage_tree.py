@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from event_handler.models import Event
+from creator_handler.db_controller import rebuild_stage_tree
+
+
+class Command(BaseCommand):
+    help = "Пересчитать деревья этапов мероприятий (например, после загрузки фикстур)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("event_ids", nargs="*", type=int, help="id мероприятий (по умолчанию все)")
+
+    def handle(self, *args, **options):
+        event_ids = options["event_ids"] or Event.objects.values_list("id", flat=True)
+        for event_id in event_ids:
+            rebuild_stage_tree(event_id)
+        self.stdout.write(self.style.SUCCESS(f"Деревья этапов пересчитаны: {len(event_ids)}"))
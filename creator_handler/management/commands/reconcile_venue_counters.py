@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from creator_handler.db_controller import reconcile_venue_counters
+
+
+class Command(BaseCommand):
+    help = "Сверить счётчики занятых мест площадок с заявками и исправить расхождения (запускать периодически)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--event", type=int, default=None, help="id мероприятия (по умолчанию все площадки)")
+
+    def handle(self, *args, **options):
+        fixed = reconcile_venue_counters(options["event"])
+        self.stdout.write(self.style.SUCCESS(f"Исправлено счётчиков площадок: {fixed}"))
@@ -0,0 +1,29 @@
+from datetime import timedelta
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from creator_handler import jobs
+
+
+class Command(BaseCommand):
+    help = "Обработчик фоновых задач (завершение этапов и т.п.)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Выполнить ожидающие задачи и завершиться")
+        parser.add_argument("--interval", type=float, default=2, help="Пауза между опросами очереди, с")
+        parser.add_argument("--stale-after", type=int, default=3600,
+                            help="Через сколько секунд без прогресса задача в статусе RUNNING возвращается в очередь")
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(seconds=options["stale_after"])
+        while True:
+            requeued = jobs.requeue_stale_jobs(stale_after)
+            if requeued:
+                self.stdout.write(f"Возвращено в очередь: {requeued}")
+            done = jobs.run_pending_jobs()
+            if done:
+                self.stdout.write(f"Выполнено задач: {done}")
+            if options["once"]:
+                return
+            sleep(options["interval"])
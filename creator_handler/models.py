@@ -54,3 +54,140 @@ class StageSettings(models.Model):
         """
         verbose_name = 'Настройки этапа'
         verbose_name_plural = 'Настройки этапа'
+
+
+class Job(models.Model):
+    """
+    Класс **Job**
+
+    Фоновая задача, которую выполняет команда run_jobs
+
+    :param kind: Тип задачи (имя обработчика)
+    :param key: Ключ задачи: повторная постановка с тем же ключом не создаёт дубликат
+    :param payload: Параметры обработчика
+    :param status: Статус
+    :param progress: Прогресс выполнения в процентах
+    :param message: Последнее сообщение обработчика или текст ошибки
+    :param attempts: Количество запусков
+    :param run_after: Задача не запускается раньше этого времени (None - сразу)
+    :param created_at: Время постановки в очередь
+    :param updated_at: Время последнего изменения
+
+    """
+    class Status(models.IntegerChoices):
+        """
+        Именованные константы, отображающие статус фоновой задачи
+
+        :param WAITING:
+        :param RUNNING:
+        :param DONE:
+        :param FAILED:
+
+        """
+        WAITING = 0
+        RUNNING = 1
+        DONE = 200
+        FAILED = 400
+
+    kind = models.CharField("Тип задачи", max_length=50)
+    key = models.CharField("Ключ задачи", max_length=100, unique=True)
+    payload = models.JSONField("Параметры", default=dict, blank=True)
+    status = models.SmallIntegerField("Статус", choices=Status.choices, default=Status.WAITING)
+    progress = models.PositiveSmallIntegerField("Прогресс, %", default=0)
+    message = models.TextField("Сообщение", default="", blank=True)
+    attempts = models.PositiveIntegerField("Количество запусков", default=0)
+    run_after = models.DateTimeField("Запустить не раньше", null=True, blank=True)
+    created_at = models.DateTimeField("Поставлена в очередь", auto_now_add=True)
+    updated_at = models.DateTimeField("Изменена", auto_now=True)
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        """
+        Настройка отображения в админ-панели
+        """
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+
+class Newsletter(models.Model):
+    """
+    Класс **Newsletter**
+
+    Рассылка участникам мероприятия
+
+    :param event: Мероприятие
+    :param subject: Заголовок письма
+    :param text: Текст письма
+    :param created_at: Время создания
+
+    """
+    event = models.ForeignKey("event_handler.Event", on_delete=models.SET_NULL, null=True)
+    subject = models.CharField("Заголовок", max_length=50, blank=True)
+    text = models.TextField("Текст письма", max_length=1000, blank=True)
+    created_at = models.DateTimeField("Создана", auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.subject} ({self.created_at:%d.%m.%Y %H:%M})"
+
+    class Meta:
+        """
+        Настройка отображения в админ-панели
+        """
+        verbose_name = 'Рассылка'
+        verbose_name_plural = 'Рассылки'
+        ordering = ['-created_at']
+
+
+class OutboxMessage(models.Model):
+    """
+    Класс **OutboxMessage**
+
+    Письмо рассылки одному получателю
+
+    :param newsletter: Рассылка
+    :param recipient: Адрес получателя
+    :param status: Статус отправки
+    :param attempts: Количество попыток отправки
+    :param last_error: Текст последней ошибки
+    :param claimed_at: Время, когда письмо взято в отправку
+    :param sent_at: Время отправки
+
+    """
+    class Status(models.IntegerChoices):
+        """
+        Именованные константы, отображающие статус письма
+
+        :param PENDING:
+        :param SENDING:
+        :param SENT:
+        :param FAILED:
+
+        """
+        PENDING = 0
+        SENDING = 100
+        SENT = 200
+        FAILED = 400
+
+    newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE, related_name="messages")
+    recipient = models.EmailField("Получатель")
+    status = models.SmallIntegerField("Статус", choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField("Количество попыток", default=0)
+    last_error = models.TextField("Последняя ошибка", default="", blank=True)
+    claimed_at = models.DateTimeField("Взято в отправку", null=True, blank=True)
+    sent_at = models.DateTimeField("Отправлено", null=True, blank=True)
+
+    def __str__(self):
+        return self.recipient
+
+    class Meta:
+        """
+        Настройка отображения в админ-панели
+        """
+        verbose_name = 'Письмо рассылки'
+        verbose_name_plural = 'Письма рассылок'
+        constraints = [models.UniqueConstraint(fields=['newsletter', 'recipient'], name='unique_outbox_recipient')]
+        indexes = [models.Index(fields=['status', 'id'])]
@@ -0,0 +1,110 @@
+from collections import namedtuple
+from threading import Lock
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from distributedEvents.versions import bump_version, bump_version_on_commit, get_version
+from creator_handler.models import StageSettings
+from event_handler.models import StageStaff
+from user_handler.models import DjangoUser
+
+PermissionEntry = namedtuple("PermissionEntry", "role status who_can_edit_venues who_can_accept_applications "
+                                                "who_can_manage_mailing_list")
+
+_MISSING = object()
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = Lock()
+
+
+def _version_key(event_id: int) -> str:
+    return f"permissions:version:{event_id}"
+
+
+def get_permissions_version(event_id: int) -> int:
+    """
+    Текущая версия прав мероприятия: при изменении модераторов или настроек этапов она растёт,
+    и записи со старой версией перестают читаться
+    """
+    return get_version(_version_key(event_id))
+
+
+def invalidate_event_permissions(event_id: Optional[int]) -> None:
+    """
+    Сбросить кэш прав всех пользователей на мероприятие
+    :param event_id: id мероприятия
+    """
+    if event_id is None:
+        return
+    bump_version(_version_key(event_id))
+
+
+def invalidate_event_permissions_on_commit(event_id: Optional[int]) -> None:
+    """
+    Сбросить кэш прав на мероприятие после фиксации текущей транзакции: иначе права, прочитанные
+    до фиксации (например, уволенного модератора), успеют закэшироваться по новой версии
+    :param event_id: id мероприятия
+    """
+    if event_id is None:
+        return
+    bump_version_on_commit(_version_key(event_id))
+
+
+def load_event_permissions(django_user: DjangoUser, event_id: int) -> Optional[PermissionEntry]:
+    """
+    Загрузить роль пользователя на финальном этапе мероприятия и пороги доступа одним запросом
+    :return: Права пользователя или None, если он не модератор мероприятия
+    """
+    row = StageStaff.objects.filter(user__user=django_user, stage__parent=event_id,
+                                    stage__next_stage__isnull=True) \
+        .order_by('stage__name', 'stage__id') \
+        .values_list('role', 'status', 'stage__settings__who_can_edit_venues',
+                     'stage__settings__who_can_accept_applications',
+                     'stage__settings__who_can_manage_mailing_list') \
+        .first()
+    if row is None:
+        return None
+    # Этап без настроек: действуют значения по умолчанию, доступ только у организатора
+    return PermissionEntry(*(StageSettings.AccessLevel.PROVIDER if value is None else value for value in row))
+
+
+def get_event_permissions(django_user: DjangoUser, event_id: int) -> Optional[PermissionEntry]:
+    """
+    Права пользователя на мероприятие из кэша (ключ - пользователь, мероприятие и версия прав)
+    :param django_user: Пользователь, сделавший запрос
+    :param event_id: id мероприятия
+    :return: Права пользователя или None, если он не модератор мероприятия
+    """
+    if django_user is None or django_user.pk is None:
+        return None
+    key = f"permissions:{event_id}:{get_permissions_version(event_id)}:{django_user.pk}"
+    entry = cache.get(key, _MISSING)
+    if entry is not _MISSING:
+        _count('hits')
+        return entry
+    _count('misses')
+    entry = load_event_permissions(django_user, event_id)
+    cache.set(key, entry, getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 300))
+    return entry
+
+
+def _count(counter: str) -> None:
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def get_permission_cache_stats() -> dict:
+    """
+    Счётчики попаданий и промахов кэша прав с момента запуска процесса
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0
+    return stats
+
+
+def reset_permission_cache_stats() -> None:
+    with _stats_lock:
+        _stats['hits'] = _stats['misses'] = 0
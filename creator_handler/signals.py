@@ -0,0 +1,47 @@
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from creator_handler.db_controller import rebuild_stage_tree
+from creator_handler.models import StageSettings
+from creator_handler.permissions import invalidate_event_permissions_on_commit
+from event_handler.models import Event, Stage, StageStaff
+from event_handler.signals import deleted_with, get_stage_event_id
+
+
+@receiver([post_save, post_delete], sender=StageStaff)
+def stage_staff_changed(sender, instance, origin=None, **kwargs):
+    # При удалении этапа права мероприятия сбрасывает stage_changed
+    if origin is not None and deleted_with(origin, Stage, Event):
+        return
+    invalidate_event_permissions_on_commit(get_stage_event_id(instance, 'stage'))
+
+
+@receiver([post_save, post_delete], sender=Stage)
+def stage_changed(sender, instance, **kwargs):
+    invalidate_event_permissions_on_commit(instance.parent_id)
+
+
+@receiver(pre_save, sender=Stage)
+def stage_moving(sender, instance, **kwargs):
+    # Смена предшествующего этапа или мероприятия (например, в админ-панели) меняет дерево этапов
+    if instance.pk is None:
+        instance.moved_from = None
+        return
+    old = Stage.objects.filter(pk=instance.pk).values_list('parent', 'next_stage').first()
+    instance.moved_from = old[0] if old is not None and old != (instance.parent_id, instance.next_stage_id) else None
+
+
+@receiver(post_save, sender=Stage)
+def stage_moved(sender, instance, created, **kwargs):
+    moved_from = getattr(instance, 'moved_from', None)
+    if moved_from is None:
+        return
+    rebuild_stage_tree(instance.parent_id)
+    if moved_from != instance.parent_id:
+        rebuild_stage_tree(moved_from)
+
+
+@receiver(post_save, sender=StageSettings)
+def stage_settings_changed(sender, instance, **kwargs):
+    for event_id in Stage.objects.filter(settings=instance).values_list('parent', flat=True):
+        invalidate_event_permissions_on_commit(event_id)
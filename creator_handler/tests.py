@@ -1,3 +1,872 @@
-from django.test import TestCase
+from django.contrib.auth.models import User as DjangoUser
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+from time import perf_counter, sleep
+from unittest.mock import patch
+from urllib.parse import parse_qs
+import json
+import os
+import tempfile
+import threading
 
-# Create your tests here.
+from event_handler.models import Event, Stage, StageTreeNode, StageParticipants, StageStaff, Venue
+from creator_handler.models import StageSettings, Job, OutboxMessage
+from creator_handler import benchmark, jobs, email, permissions
+from user_handler.db_controller import create_user_for_django_user
+from creator_handler import db_controller as c_db
+from creator_handler.contest_controller import ContestClient, ContestError
+
+
+def reference_tree(event_id: int):
+    """
+    Обход дерева этапов напрямую по Stage.next_stage: дочерние этапы от новых к старым
+    """
+    children = {}
+    for stage_id, next_stage_id in Stage.objects.filter(parent=event_id).order_by('-id') \
+            .values_list('id', 'next_stage'):
+        children.setdefault(next_stage_id, []).append(stage_id)
+    answer = []
+
+    def walk(stage_id, depth):
+        answer.append((stage_id, depth))
+        for child in children.get(stage_id, []):
+            walk(child, depth + 1)
+
+    for root in reversed(children.get(None, [])):
+        walk(root, 0)
+    return answer
+
+
+class StageTreeTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.regional = [c_db.make_record_stage(f"Региональный {index}", self.event, next_stage=self.final)
+                         for index in range(3)]
+        self.district = [c_db.make_record_stage(f"Районный {index}", self.event, next_stage=regional)
+                         for index, regional in enumerate(self.regional * 2)]
+
+    def formatted(self):
+        return [(stage.id, depth) for stage, depth in c_db.get_formatted_stages(self.event.id)]
+
+    def test_incremental_tree_matches_reference(self):
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+        self.assertEqual(self.formatted()[0], (self.final.id, 0))
+
+    def test_read_is_single_query(self):
+        with self.assertNumQueries(1):
+            c_db.get_formatted_stages(self.event.id)
+
+    def test_delete_subtree_keeps_tree_consistent(self):
+        settings_id = self.regional[1].settings_id
+        c_db.delete_stage_recursive(self.regional[1].id)
+        self.assertFalse(StageSettings.objects.filter(id=settings_id).exists())
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+        self.assertEqual(len(self.formatted()), 1 + 2 + 4)
+        c_db.make_record_stage("Новый этап", self.event, next_stage=self.regional[0])
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+
+    def test_rebuild_missing_tree(self):
+        StageTreeNode.objects.filter(event=self.event).delete()
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+
+    def test_stage_created_outside_controller_is_listed(self):
+        Stage.objects.create(name="Из админки", parent=self.event, next_stage=self.regional[2])
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+
+    def test_delete_with_missing_nodes_keeps_neighbours(self):
+        extra = Stage.objects.create(name="Из админки", parent=self.event, next_stage=self.regional[1])
+        c_db.delete_stage_recursive(self.regional[1].id)
+        self.assertFalse(Stage.objects.filter(id=extra.id).exists())
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+        self.assertEqual(len(self.formatted()), 1 + 2 + 4)
+
+    def test_moving_stage_rebuilds_tree(self):
+        stage = self.district[0]
+        stage.next_stage = self.regional[2]
+        stage.save()
+        self.assertEqual(self.formatted(), reference_tree(self.event.id))
+
+    def test_deep_tree_without_recursion(self):
+        event = Event.objects.create(name="Глубокое")
+        stage = None
+        for index in range(3000):
+            stage = Stage.objects.create(name=str(index), parent=event, next_stage=stage, settings=None)
+        c_db.rebuild_stage_tree(event.id)
+        formatted = c_db.get_formatted_stages(event.id)
+        self.assertEqual(len(formatted), 3000)
+        self.assertEqual(formatted[-1], (stage, 2999))
+
+
+class StageSubtreeTestCase(TestCase):
+    """
+    Синтетическое дерево этапов: замер на 10 000 этапах - команда benchmark_stage_tree
+    """
+    size = 300
+
+    def setUp(self):
+        self.event = Event.objects.create(name="Синтетическое")
+        self.stages = benchmark.create_stage_tree(self.event, self.size)
+        c_db.rebuild_stage_tree(self.event.id)
+
+    def test_subtree_collection_is_single_query(self):
+        with self.assertNumQueries(1):
+            subtree = c_db.get_stage_subtree(self.stages[0].id)
+        self.assertEqual(len(subtree), self.size)
+
+    def test_delete_branch(self):
+        branch = self.stages[1]
+        branch_size = len(c_db.get_stage_subtree(branch.id))
+        c_db.delete_stage_recursive(branch.id)
+        self.assertEqual(Stage.objects.filter(parent=self.event).count(), self.size - branch_size)
+        self.assertEqual(StageSettings.objects.count(), self.size - branch_size)
+        self.assertEqual(StageTreeNode.objects.filter(event=self.event).count(), self.size - branch_size)
+        self.assertEqual([(stage.id, depth) for stage, depth in c_db.get_formatted_stages(self.event.id)],
+                         reference_tree(self.event.id))
+
+    def test_delete_branch_invalidates_once(self):
+        branch = self.stages[1]
+        branch_ids = c_db.get_stage_subtree(branch.id)
+        user = create_user_for_django_user(DjangoUser.objects.create(username="staff"))
+        StageStaff.objects.bulk_create(StageStaff(stage_id=stage_id, user=user) for stage_id in branch_ids)
+        permissions_version = permissions.get_permissions_version(self.event.id)
+        with CaptureQueriesContext(connection) as queries, \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            c_db.delete_stage_recursive(branch.id)
+        # Каскадно удалённые модераторы не ищут свой этап по одному запросу
+        self.assertLess(len(queries), len(branch_ids) // 2)
+        # Права и страница мероприятия сбрасываются по разу на всё поддерево
+        self.assertEqual(len(callbacks), 2)
+        self.assertNotEqual(permissions.get_permissions_version(self.event.id), permissions_version)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command("benchmark_stage_tree", "--size", "50", "--runs", "1", "--warmup", "0", stdout=out)
+        self.assertIn("get_stage_subtree (50)", out.getvalue())
+        self.assertIn("delete_stage_recursive", out.getvalue())
+        # Синтетическое дерево не остаётся в базе
+        self.assertEqual(Stage.objects.exclude(parent=self.event).count(), 0)
+
+
+class EndStageTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.stage = c_db.make_record_stage("Отбор", self.event, next_stage=self.final)
+        StageSettings.objects.filter(id=self.stage.settings_id).update(contest_id="1")
+        StageSettings.objects.filter(id=self.final.settings_id).update(contest_id="2")
+        self.stage.refresh_from_db()
+        Venue.objects.create(name="Финальная площадка", address="Москва", parental_stage=self.final)
+
+    def populate(self, count: int):
+        users = []
+        offset = DjangoUser.objects.count()
+        for index in range(count):
+            django_user = DjangoUser.objects.create(username=f"user{offset + index}",
+                                                    email=f"user{index}@example.com")
+            users.append(create_user_for_django_user(django_user))
+        StageParticipants.objects.bulk_create(
+            StageParticipants(stage=self.stage, user=user, status=StageParticipants.Status.ACCEPTED) for user in users
+        )
+        contest_participants = [{'participantInfo': {'id': index, 'login': f"user{index}@example.com"}}
+                                for index in range(count)]
+        score_board = [{'participantInfo': {'id': index}, 'score': str(index % 10)} for index in range(count)]
+        return contest_participants, score_board
+
+    def end_stage(self, contest_participants, score_board):
+        with patch.object(c_db.contest, 'get_participants', return_value=contest_participants), \
+                patch.object(c_db.contest, 'get_standings', return_value=score_board), \
+                patch.object(c_db.contest, 'register_participants') as register_participants:
+            c_db.end_stage(Stage.objects.get(id=self.stage.id), 5)
+        return register_participants
+
+    def test_scores_and_transfer(self):
+        register_participants = self.end_stage(*self.populate(20))
+        self.assertEqual(StageParticipants.objects.filter(stage=self.stage,
+                                                          role=StageParticipants.Roles.AWARDEE).count(), 10)
+        transferred = StageParticipants.objects.filter(stage=self.final)
+        self.assertEqual(transferred.count(), 10)
+        self.assertEqual(set(transferred.values_list('status', flat=True)), {StageParticipants.Status.ACCEPTED})
+        self.assertEqual(len(register_participants.call_args.args[1]), 10)
+
+        # Повторное завершение этапа не создаёт дубликатов
+        self.end_stage(*self.populate(0))
+        self.assertEqual(StageParticipants.objects.filter(stage=self.final).count(), 10)
+
+    def test_contest_error_stops_stage(self):
+        self.populate(5)
+        with patch.object(c_db.contest, 'get_participants', side_effect=ContestError("HTTP 503")), \
+                self.assertRaises(ContestError):
+            c_db.end_stage(Stage.objects.get(id=self.stage.id), 5)
+        self.assertFalse(StageParticipants.objects.filter(stage=self.final).exists())
+
+    def test_query_count_does_not_grow_with_participants(self):
+        small = self.populate(10)
+        with CaptureQueriesContext(connection) as small_queries:
+            self.end_stage(*small)
+        StageParticipants.objects.all().delete()
+        large = self.populate(60)
+        with CaptureQueriesContext(connection) as large_queries:
+            self.end_stage(*large)
+        self.assertEqual(len(small_queries), len(large_queries))
+
+
+class ContestStubHandler(BaseHTTPRequestHandler):
+    """
+    Заглушка API Яндекс.Контеста: состояние хранится в атрибутах сервера
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None):
+        payload = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.failures > 0:
+            server.failures -= 1
+            return self.reply(503)
+        if server.delay:
+            sleep(server.delay)
+        self.reply(200, {"rows": [{"participantInfo": {"id": 1, "login": "user@example.com"}, "score": "3"}]})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers["Content-Length"])
+        login = parse_qs(self.rfile.read(length).decode())["login"][0]
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        sleep(0.02)
+        with server.lock:
+            server.in_flight -= 1
+            server.registered.append(login)
+        self.reply(201)
+
+
+class ContestClientTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ContestStubHandler)
+        self.server.requests, self.server.failures, self.server.delay = 0, 0, 0
+        self.server.lock = threading.Lock()
+        self.server.in_flight, self.server.max_in_flight, self.server.registered = 0, 0, []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = ContestClient(f"http://127.0.0.1:{self.server.server_port}", {"Authorization": "OAuth test"},
+                                    timeout=0.5, retries=3, backoff=0.01, max_workers=4)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_standings(self):
+        rows = self.client.get_standings(1)
+        self.assertEqual(rows[0]["participantInfo"]["login"], "user@example.com")
+
+    def test_retries_server_errors(self):
+        self.server.failures = 2
+        self.assertEqual(len(self.client.get_participants(1)), 1)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = 10
+        with self.assertLogs("creator_handler.contest_controller", "WARNING"), self.assertRaises(ContestError):
+            self.client.get_standings(1)
+        self.assertEqual(self.server.requests, 4)
+
+    def test_timeout(self):
+        self.server.delay = 2
+        started = perf_counter()
+        client = ContestClient(self.client.base_url, {}, timeout=0.1, retries=0)
+        with self.assertLogs("creator_handler.contest_controller", "WARNING"), self.assertRaises(ContestError):
+            client.get_standings(1)
+        client.close()
+        self.assertLess(perf_counter() - started, 1)
+
+    def test_bounded_concurrent_registration(self):
+        logins = [f"user{index}@example.com" for index in range(20)]
+        added = self.client.register_participants(1, logins)
+        self.assertEqual(added, logins)
+        self.assertEqual(sorted(self.server.registered), sorted(logins))
+        self.assertLessEqual(self.server.max_in_flight, 4)
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_registration_reuses_threads(self):
+        logins = [f"user{index}@example.com" for index in range(20)]
+        with self.assertLogs("creator_handler.contest_controller", "INFO") as logs:
+            self.client.register_participants(1, logins)
+            self.client.register_participants(1, logins)
+        self.assertIn("Added 20 of 20 logins", logs.output[0])
+        # Сессии создаются только в потоках общего пула, а не заново при каждом вызове
+        self.assertLessEqual(len(self.client._sessions), 4)
+        sessions = list(self.client._sessions)
+        self.client.close()
+        self.assertEqual(self.client._sessions, [])
+        self.assertTrue(all(not session.get_adapter(self.client.base_url).poolmanager.pools for session in sessions))
+
+    def test_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(self.client.session))
+        thread.start()
+        thread.join()
+        self.assertIs(self.client.session, self.client.session)
+        self.assertIsNot(sessions[0], self.client.session)
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.stage = c_db.make_record_stage("Отбор", self.event, next_stage=self.final)
+        self.django_user = DjangoUser.objects.create(username="provider")
+        c_db.create_staff(create_user_for_django_user(self.django_user), self.final, StageStaff.Roles.PROVIDER,
+                          StageStaff.Status.ACCEPTED)
+
+    def test_enqueue_is_idempotent(self):
+        job = jobs.enqueue_end_stage(self.stage.id, self.event.id)
+        self.assertEqual(jobs.enqueue_end_stage(self.stage.id, self.event.id).id, job.id)
+        self.assertEqual(Job.objects.count(), 1)
+
+        Job.objects.filter(id=job.id).update(status=Job.Status.DONE, progress=100)
+        rerun = jobs.enqueue_end_stage(self.stage.id, self.event.id)
+        self.assertEqual(rerun.id, job.id)
+        self.assertEqual((rerun.status, rerun.progress), (Job.Status.WAITING, 0))
+
+    def test_claim_is_exclusive(self):
+        jobs.enqueue_end_stage(self.stage.id, self.event.id)
+        self.assertIsNotNone(jobs.claim_next_job())
+        self.assertIsNone(jobs.claim_next_job())
+
+    def test_commit_stage_enqueues_and_worker_runs(self):
+        self.client.force_login(self.django_user)
+        response = self.client.post(f"/event/{self.event.id}/edit/stages/{self.stage.id}/end")
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], "waiting")
+
+        with patch.object(c_db, 'end_stage') as end_stage:
+            self.assertEqual(jobs.run_pending_jobs(), 1)
+        self.assertEqual(end_stage.call_args.args[0], self.stage)
+        status = self.client.get(status_url).json()
+        self.assertEqual((status['status'], status['progress'], status['attempts']), ("done", 100, 1))
+
+    def test_failed_job_reports_error(self):
+        job = jobs.enqueue_end_stage(self.stage.id, self.event.id)
+        with patch.object(c_db, 'end_stage', side_effect=RuntimeError("contest is down")), \
+                self.assertLogs("creator_handler.jobs", "ERROR") as logs:
+            jobs.run_pending_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), (Job.Status.FAILED, "contest is down"))
+        self.assertIn("RuntimeError: contest is down", logs.output[0])
+
+    def test_stage_without_contest_fails(self):
+        job = jobs.enqueue_end_stage(self.stage.id, self.event.id)
+        with self.assertLogs("creator_handler.jobs", "ERROR"):
+            jobs.run_pending_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertIn("не указан контест", job.message)
+
+
+class NewsletterTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.stage = c_db.make_record_stage("Отбор", self.event, next_stage=self.final)
+        for index in range(7):
+            django_user = DjangoUser.objects.create(username=f"user{index}", email=f"user{index}@example.com")
+            user = create_user_for_django_user(django_user)
+            StageParticipants.objects.create(stage=self.stage, user=user)
+            if index < 3:
+                StageParticipants.objects.create(stage=self.final, user=user)
+        django_user = DjangoUser.objects.create(username="no_email")
+        StageParticipants.objects.create(stage=self.stage, user=create_user_for_django_user(django_user))
+
+    def test_recipients_in_one_query(self):
+        with self.assertNumQueries(1):
+            emails = email.get_recipient_emails(c_db.get_participants_by_event(self.event))
+        self.assertEqual(sorted(emails), [f"user{index}@example.com" for index in range(7)])
+
+    def test_single_connection_in_batches(self):
+        with patch.object(email, 'get_connection', wraps=email.get_connection) as get_connection:
+            sent = email.send_message(c_db.get_participants_by_event(self.event), "Текст", "Тема", batch_size=3)
+        self.assertEqual(sent, 7)
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(sorted(address for message in mail.outbox for address in message.to),
+                         [f"user{index}@example.com" for index in range(7)])
+
+    @override_settings(NEWSLETTER_RATE=1000, NEWSLETTER_JOB_BATCH=3)
+    def test_newsletter_job(self):
+        jobs.enqueue_newsletter(self.event.id, "Тема", "Текст")
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.count(), 7)
+        self.assertEqual(jobs.run_pending_jobs(limit=1), 1)
+        self.assertEqual(len(mail.outbox), 3)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.message), (Job.Status.WAITING, "Отправлено писем: 3 из 7"))
+        self.assertEqual(jobs.run_pending_jobs(), 2)
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(mail.outbox[0].subject, "Тема")
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.message, job.attempts), (Job.Status.DONE, "Отправлено писем: 7 из 7", 3))
+
+
+class FlakyBackend(locmem.EmailBackend):
+    """
+    Почтовый бэкенд, который один раз обрывает соединение на каждом адресе из failing
+    """
+    failing = set()
+    refused = set()
+
+    def send_messages(self, messages):
+        for message in messages:
+            recipient = message.to[0]
+            if recipient in self.refused:
+                raise SMTPRecipientsRefused({recipient: (550, b"No such user")})
+            if recipient in self.failing:
+                self.failing.discard(recipient)
+                raise SMTPServerDisconnected("Connection unexpectedly closed")
+        return super().send_messages(messages)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        stage = c_db.make_record_stage("Финал", self.event)
+        for index in range(10):
+            django_user = DjangoUser.objects.create(username=f"user{index}", email=f"user{index}@example.com")
+            StageParticipants.objects.create(stage=stage, user=create_user_for_django_user(django_user))
+        self.newsletter = email.create_newsletter(self.event, c_db.get_participants_by_event(self.event), "Текст")
+        self.clock = 0.0
+
+    def fake_sleep(self, seconds):
+        self.clock += seconds
+
+    def drain(self, **kwargs):
+        kwargs.setdefault('rate', 1000)
+        with patch.object(email, 'sleep', self.fake_sleep), patch.object(email, 'monotonic', lambda: self.clock):
+            return email.drain_outbox(self.newsletter.id, **kwargs)
+
+    def test_resume_sends_each_message_once(self):
+        self.assertEqual(self.drain(limit=4), {'sent': 4, 'failed': 0, 'pending': 6})
+        self.assertEqual(self.drain(), {'sent': 6, 'failed': 0, 'pending': 0})
+        recipients = sorted(message.to[0] for message in mail.outbox)
+        self.assertEqual(recipients, sorted(f"user{index}@example.com" for index in range(10)))
+
+    def test_claimed_messages_are_skipped(self):
+        claimed = OutboxMessage.objects.order_by('id')[:2]
+        OutboxMessage.objects.filter(id__in=[message.id for message in claimed]) \
+            .update(status=OutboxMessage.Status.SENDING, claimed_at=timezone.now())
+        stale = OutboxMessage.objects.order_by('id')[0]
+        OutboxMessage.objects.filter(id=stale.id).update(claimed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.drain(), {'sent': 9, 'failed': 0, 'pending': 0})
+        self.assertEqual(OutboxMessage.objects.get(status=OutboxMessage.Status.SENDING).id, claimed[1].id)
+        self.assertEqual(email.get_newsletter_counters(self.newsletter.id),
+                         {'sent': 9, 'failed': 0, 'pending': 0, 'sending': 1, 'total': 10})
+
+    @override_settings(NEWSLETTER_JOB_RETRY_AFTER=60)
+    def test_newsletter_job_waits_for_claimed_messages(self):
+        OutboxMessage.objects.filter(id=OutboxMessage.objects.order_by('id')[0].id) \
+            .update(status=OutboxMessage.Status.SENDING, claimed_at=timezone.now())
+        jobs.enqueue("newsletter", "newsletter", {'newsletter_id': self.newsletter.id})
+        with patch.object(email, 'sleep', self.fake_sleep), patch.object(email, 'monotonic', lambda: self.clock):
+            self.assertEqual(jobs.run_pending_jobs(limit=10), 1)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.Status.WAITING, 1))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=30))
+        self.assertEqual(len(mail.outbox), 9)
+
+    def test_rate_limit(self):
+        self.drain(rate=2)
+        self.assertAlmostEqual(self.clock, 4.5)
+
+    @override_settings(EMAIL_BACKEND="creator_handler.tests.FlakyBackend")
+    def test_transient_failures_are_retried(self):
+        FlakyBackend.failing = {"user3@example.com", "user7@example.com"}
+        FlakyBackend.refused = {"user5@example.com"}
+        self.assertEqual(self.drain(retry_delay=0), {'sent': 9, 'failed': 1, 'pending': 0})
+        retried = OutboxMessage.objects.get(recipient="user3@example.com")
+        self.assertEqual((retried.status, retried.attempts), (OutboxMessage.Status.SENT, 2))
+        refused = OutboxMessage.objects.get(recipient="user5@example.com")
+        self.assertEqual((refused.status, refused.attempts), (OutboxMessage.Status.FAILED, 1))
+
+
+class PermissionCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        permissions.reset_permission_cache_stats()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        django_user = DjangoUser.objects.create(username="curator")
+        self.staff = StageStaff.objects.create(user=create_user_for_django_user(django_user), stage=self.final,
+                                               role=StageStaff.Roles.CURATOR, status=StageStaff.Status.ACCEPTED)
+
+    def have_access(self, setting=-1):
+        # Новый объект пользователя на каждый вызов, как в отдельных запросах
+        return c_db.user_have_access(DjangoUser.objects.get(username="curator"), self.event.id, setting)
+
+    def test_hit_needs_no_queries(self):
+        self.assertTrue(self.have_access())
+        django_user = DjangoUser.objects.get(username="curator")
+        with self.assertNumQueries(0):
+            self.assertFalse(c_db.user_have_access(django_user, self.event.id, c_db.SettingsSet.EDIT_VENUES))
+        self.assertEqual(permissions.get_permission_cache_stats()['hits'], 1)
+        self.assertEqual(permissions.get_permission_cache_stats()['misses'], 1)
+
+    def test_settings_change_invalidates(self):
+        self.assertFalse(self.have_access(c_db.SettingsSet.ACCEPT_APPLICATIONS))
+        settings = self.final.settings
+        with self.captureOnCommitCallbacks(execute=True):
+            settings.who_can_accept_applications = StageSettings.AccessLevel.CURATOR
+            settings.save()
+        self.assertTrue(self.have_access(c_db.SettingsSet.ACCEPT_APPLICATIONS))
+
+    def test_staff_change_invalidates(self):
+        self.assertTrue(self.have_access())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff.status = StageStaff.Status.FIRED
+            self.staff.save()
+            # До фиксации транзакции версия прав не меняется
+            self.assertTrue(self.have_access())
+        self.assertFalse(self.have_access())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff.delete()
+        self.assertFalse(self.have_access())
+        self.assertEqual(permissions.get_permission_cache_stats()['misses'], 3)
+
+    def test_non_staff_is_cached_too(self):
+        DjangoUser.objects.create(username="stranger")
+        for _ in range(3):
+            self.assertFalse(c_db.user_have_access(DjangoUser.objects.get(username="stranger"), self.event.id))
+        self.assertEqual(permissions.get_permission_cache_stats(), {'hits': 2, 'misses': 1, 'hit_ratio': 2 / 3})
+
+
+class ModerationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.stage = c_db.make_record_stage("Отбор", self.event)
+        self.moderator = DjangoUser.objects.create(username="moderator")
+        StageStaff.objects.create(user=create_user_for_django_user(self.moderator), stage=self.stage,
+                                  role=StageStaff.Roles.PROVIDER, status=StageStaff.Status.ACCEPTED)
+        self.users = [create_user_for_django_user(DjangoUser.objects.create(username=f"user{i}")) for i in range(5)]
+        StageParticipants.objects.bulk_create(StageParticipants(user=user, stage=self.stage) for user in self.users)
+
+    def moderate(self, data, django_user=None):
+        self.client.force_login(django_user or self.moderator)
+        return self.client.post(f"/event/{self.event.id}/edit/participants/moderate", json.dumps(data),
+                                content_type="application/json", HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+    def test_single_update(self):
+        ids = [user.id for user in self.users]
+        with CaptureQueriesContext(connection) as queries:
+            result = c_db.set_participants_status(ids + [0], self.event.id, StageParticipants.Status.ACCEPTED)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "event_handler_stageparticipants"')
+                             for query in queries), 1)
+        self.assertEqual(result[0], "not_found")
+        self.assertEqual(StageParticipants.objects.filter(status=StageParticipants.Status.ACCEPTED).count(), 5)
+
+    def test_endpoint_reports_each_id(self):
+        response = self.moderate({'ids': [self.users[0].id, self.users[1].id, 0, "x"],
+                                  'status': StageParticipants.Status.BANNED})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'results': {str(self.users[0].id): "updated",
+                                                       str(self.users[1].id): "updated",
+                                                       "0": "not_found", "x": "invalid"},
+                                           'updated': 2})
+        self.assertEqual(StageParticipants.objects.filter(status=StageParticipants.Status.BANNED).count(), 2)
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.moderate({'ids': [self.users[0].id], 'status': 12345}).status_code, 400)
+        self.assertEqual(self.moderate({'ids': list(range(10000)), 'status': 200}).status_code, 400)
+        stranger = DjangoUser.objects.create(username="stranger")
+        self.assertEqual(self.moderate({'ids': [self.users[0].id], 'status': 200}, stranger).status_code, 400)
+        self.assertFalse(StageParticipants.objects.exclude(status=StageParticipants.Status.AWAITED).exists())
+
+
+class RegistrationTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.stage = c_db.make_record_stage("Отбор", self.event)
+        self.stage.settings.can_register = True
+        self.stage.settings.save()
+        self.venue = Venue.objects.create(name="Школа", address="ул. Ленина", participants_maximum=1,
+                                          parental_stage=self.stage)
+        self.users = [create_user_for_django_user(DjangoUser.objects.create(username=f"user{i}")) for i in range(2)]
+
+    def test_results(self):
+        self.assertEqual(c_db.register_on_stage(self.stage, self.venue.id, self.users[0]),
+                         c_db.RegistrationResult.REGISTERED)
+        self.assertEqual(c_db.register_on_stage(self.stage, self.venue.id, self.users[0]),
+                         c_db.RegistrationResult.ALREADY_REGISTERED)
+        self.assertEqual(c_db.register_on_stage(self.stage, self.venue.id, self.users[1]),
+                         c_db.RegistrationResult.VENUE_FULL)
+        other_stage = c_db.make_record_stage("Другой", c_db.make_record_event("Другое", ""))
+        other_venue = Venue.objects.create(name="Чужая", address="", parental_stage=other_stage)
+        self.assertEqual(c_db.register_on_stage(self.stage, other_venue.id, self.users[1]),
+                         c_db.RegistrationResult.WRONG_VENUE)
+        self.assertEqual(StageParticipants.objects.filter(stage=self.stage).count(), 1)
+        self.venue.refresh_from_db()
+        self.assertEqual(self.venue.participants_count, 1)
+
+        self.stage.settings.can_register = False
+        self.assertEqual(c_db.register_on_stage(self.stage, self.venue.id, self.users[1]),
+                         c_db.RegistrationResult.CLOSED)
+
+    def test_view_shows_error(self):
+        self.client.force_login(self.users[0].user)
+        url = f"/stage_registration/{self.stage.id}"
+        self.assertRedirects(self.client.post(url, {'venue_id': self.venue.id}), "/", fetch_redirect_response=False)
+        response = self.client.post(url, {'venue_id': self.venue.id})
+        self.assertContains(response, "Вы уже зарегистрированы на этот этап")
+        self.assertFalse(response.context['can_register'])
+
+    def test_benchmark_needs_file_database(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark_registration", users=1, stdout=StringIO())
+
+
+class VenueCountersTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.stage = c_db.make_record_stage("Отбор", self.event, next_stage=self.final)
+        self.stage.settings.can_register = True
+        self.stage.settings.save()
+        self.venue = Venue.objects.create(name="Школа", address="", participants_maximum=3, parental_stage=self.stage)
+        self.final_venue = Venue.objects.create(name="Финал", address="", parental_stage=self.final)
+        self.users = [create_user_for_django_user(DjangoUser.objects.create(username=f"user{i}")) for i in range(3)]
+        for user in self.users:
+            c_db.register_on_stage(self.stage, self.venue.id, user)
+
+    def counters(self):
+        return list(Venue.objects.order_by('id').values_list('participants_count', flat=True))
+
+    def test_status_changes(self):
+        ids = [user.id for user in self.users[:2]]
+        c_db.set_participants_status(ids, self.event.id, StageParticipants.Status.REJECTED)
+        self.assertEqual(self.counters(), [1, 0])
+        c_db.set_participants_status(ids, self.event.id, StageParticipants.Status.AWAITED)
+        self.assertEqual(self.counters(), [3, 0])
+        c_db.ban_participant(self.users[2], self.event.id)
+        self.assertEqual(self.counters(), [2, 0])
+
+    def test_transfer(self):
+        StageParticipants.objects.filter(user=self.users[0]).update(role=StageParticipants.Roles.AWARDEE)
+        c_db.transfer_participants_to_next_stage(self.stage.id, self.final_venue.id)
+        self.assertEqual(self.counters(), [3, 1])
+
+    def test_reconcile(self):
+        Venue.objects.filter(id=self.venue.id).update(participants_count=10)
+        out = StringIO()
+        call_command("reconcile_venue_counters", event=self.event.id, stdout=out)
+        self.assertIn("1", out.getvalue())
+        self.assertEqual(self.counters(), [3, 0])
+        self.assertEqual(c_db.reconcile_venue_counters(), 0)
+
+    def test_registration_page_hides_full_venues(self):
+        free = Venue.objects.create(name="Гимназия", address="", participants_maximum=5, parental_stage=self.stage)
+        self.client.force_login(DjangoUser.objects.create(username="newcomer"))
+        url = f"/stage_registration/{self.stage.id}"
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(list(response.context['venues_list']), [free])
+        self.assertNotContains(response, "Школа")
+        Venue.objects.create(name="Лицей", address="", parental_stage=self.stage)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertContains(response, "Без ограничений")
+
+
+class VenueListTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.final = c_db.make_record_stage("Финал", self.event)
+        self.stages = [c_db.make_record_stage(f"Отбор {i}", self.event, next_stage=self.final) for i in range(3)]
+        self.venues = [Venue.objects.create(name=f"Площадка {i}", address="", parental_stage=stage)
+                       for i, stage in enumerate([self.final, *self.stages])]
+        other = c_db.make_record_stage("Чужой", c_db.make_record_event("Другое", ""))
+        Venue.objects.create(name="Чужая", address="", parental_stage=other)
+        self.moderator = DjangoUser.objects.create(username="moderator")
+        c_db.create_staff(create_user_for_django_user(self.moderator), self.final, StageStaff.Roles.PROVIDER,
+                          StageStaff.Status.ACCEPTED)
+        users = [create_user_for_django_user(DjangoUser.objects.create(username=f"user{i}")) for i in range(2)]
+        StageParticipants.objects.bulk_create(StageParticipants(stage=self.stages[1], user=user,
+                                                                venue=self.venues[2]) for user in users)
+
+    def test_event_venues(self):
+        self.assertEqual(set(c_db.get_venues_by_event(self.event.id)), set(self.venues))
+        self.assertTrue(c_db.is_venue_attached_to_event(self.event.id, self.venues[3].id))
+        self.assertFalse(c_db.is_venue_attached_to_event(self.event.id, Venue.objects.get(name="Чужая").id))
+
+    def test_sorting_and_pages(self):
+        page = c_db.get_venues_page(self.event.id, "-registered", 1, per_page=3)
+        self.assertEqual([(venue.id, venue.registered) for venue in page][:2], [(self.venues[2].id, 2),
+                                                                                (self.venues[0].id, 0)])
+        self.assertEqual(page.paginator.num_pages, 2)
+        self.assertEqual(list(c_db.get_venues_page(self.event.id, "-stage", "x", per_page=3))[0], self.venues[0])
+
+    def test_view_queries_do_not_depend_on_stages(self):
+        self.client.force_login(self.moderator)
+        url = f"/event/{self.event.id}/edit/venue/?sort=-registered"
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.context['venues_list'][0], self.venues[2])
+        self.assertContains(response, "?sort=registered")
+        expected = len(queries)
+        stage = c_db.make_record_stage("Отбор 4", self.event, next_stage=self.final)
+        Venue.objects.create(name="Новая", address="", parental_stage=stage)
+        self.client.get(url)
+        with self.assertNumQueries(expected):
+            self.client.get(url)
+
+
+class VenueImportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.stage = c_db.make_record_stage("Отбор", self.event)
+        self.moderator = DjangoUser.objects.create(username="moderator")
+        c_db.create_staff(create_user_for_django_user(self.moderator), self.stage, StageStaff.Roles.PROVIDER,
+                          StageStaff.Status.ACCEPTED)
+        self.client.force_login(self.moderator)
+        self.url = f"/event/{self.event.id}/edit/venue/"
+
+    def upload(self, name: str, content: str, stage=None):
+        file = SimpleUploadedFile(name, content.encode("utf-8"))
+        return self.client.post(self.url + "import", {'stage': (stage or self.stage).id, 'file': file})
+
+    def test_csv_import(self):
+        response = self.upload("venues.csv", "name;address;region;participants_maximum;contacts\n"
+                                             "Школа 1;ул. Ленина, 1;Адыгея;30;\n"
+                                             "Школа 2;ул. Мира, 2;1;;+7 900\n")
+        self.assertEqual(response.json(), {'created': 2})
+        self.assertEqual(list(Venue.objects.order_by('name').values_list('region', 'participants_maximum')),
+                         [(3, 30), (1, None)])
+
+    def test_row_errors_cancel_import(self):
+        response = self.upload("venues.json", json.dumps([
+            {'name': "Школа", 'address': "ул. Ленина"},
+            {'name': "", 'address': "ул. Мира", 'region': "Атлантида"},
+            {'name': "Лицей", 'address': "ул. Мира", 'participants_maximum': 0},
+        ]))
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([(error['row'], sorted(error['errors'])) for error in errors],
+                         [(2, ['name', 'region']), (3, ['participants_maximum'])])
+        self.assertFalse(Venue.objects.exists())
+        self.assertEqual(self.upload("venues.xml", "<venues/>").status_code, 400)
+
+    def test_export_round_trip(self):
+        Venue.objects.create(name="Школа", address="ул. Ленина, 1", region=3, participants_maximum=30,
+                             parental_stage=self.stage)
+        response = self.client.get(self.url + "export?format=csv")
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode("utf-8-sig").splitlines()
+        self.assertEqual(lines[0].split(",")[:5], ['id', 'name', 'address', 'region', 'region_name'])
+        self.assertIn("Адыгея", lines[1])
+
+        exported = b"".join(self.client.get(self.url + "export?format=json").streaming_content).decode()
+        other = c_db.make_record_stage("Финал", self.event)
+        self.assertEqual(self.upload("venues.json", exported, other).json(), {'created': 1})
+        self.assertEqual(Venue.objects.filter(parental_stage=other, region=3, participants_maximum=30).count(), 1)
+
+    def test_needs_access(self):
+        self.client.force_login(DjangoUser.objects.create(username="stranger"))
+        self.assertRedirects(self.client.get(self.url + "export"), "/404", fetch_redirect_response=False)
+
+
+class IndexPlanTestCase(TestCase):
+    def setUp(self):
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.stage = c_db.make_record_stage("Отбор", self.event)
+        self.user = create_user_for_django_user(DjangoUser.objects.create(username="participant"))
+        StageParticipants.objects.create(stage=self.stage, user=self.user, yandex_contest_id="17")
+
+    def test_participation_is_unique(self):
+        with self.assertRaises(IntegrityError):
+            StageParticipants.objects.create(stage=self.stage, user=self.user)
+
+    def test_explain_queries(self):
+        out = StringIO()
+        call_command("explain_queries", stage=self.stage.id, stdout=out)
+        self.assertIn("Участие пользователя в этапе", out.getvalue())
+        self.assertIn("SEARCH", out.getvalue())
+        self.assertEqual(StageParticipants.objects.get(user=self.user).role, StageParticipants.Roles.PARTICIPANT)
+
+
+class DatasetBenchmarkTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        call_command("generate_dataset", events=2, depth=2, branching=2, venues=10, participants=40,
+                     stdout=StringIO())
+
+    def test_dataset_shape(self):
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(Stage.objects.count(), 2 * 7)
+        self.assertEqual(Venue.objects.count(), 2 * 10)
+        self.assertEqual(StageParticipants.objects.filter(stage__next_stage__next_stage__isnull=False).count(), 40)
+        event = Event.objects.first()
+        self.assertEqual([(stage.id, depth) for stage, depth in c_db.get_formatted_stages(event.id)],
+                         reference_tree(event.id))
+
+    def test_report_and_comparison(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, "baseline.json")
+            call_command("benchmark_views", runs=2, warmup=0, output=baseline, stdout=StringIO())
+            with open(baseline) as file:
+                report = json.load(file)
+            self.assertEqual(report['views']['all_events']['status'], 200)
+            self.assertEqual(report['views']['end_stage']['status'], 202)
+            self.assertGreater(report['views']['participants_list']['queries'], 0)
+            self.assertEqual(Job.objects.count(), 0)
+
+            out = StringIO()
+            call_command("benchmark_views", runs=1, warmup=0, only=["all_events"], compare=baseline, stdout=out)
+            self.assertIn("all_events", out.getvalue())
+            report['views']['all_events']['p50_ms'] = 0.001
+            with open(baseline, "w") as file:
+                json.dump(report, file)
+            with self.assertRaises(CommandError):
+                call_command("benchmark_views", runs=1, warmup=0, only=["all_events"], compare=baseline,
+                             max_regression=10, stdout=StringIO())
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(benchmark.percentile([0, 10], 90), 9)
+        self.assertEqual(benchmark.percentile([], 50), 0)
+
+
+class BenchmarkMeasureTestCase(TestCase):
+    databases = {'default', 'replica'}
+
+    def test_counts_queries_on_all_databases(self):
+        def action():
+            list(Event.objects.all())
+            list(Event.objects.using('replica').all())
+
+        self.assertEqual(benchmark.measure(action, runs=2, warmup=0)['queries'], 2)
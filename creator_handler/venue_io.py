@@ -0,0 +1,143 @@
+"""
+Импорт и экспорт площадок этапа в форматах CSV и JSON
+"""
+import csv
+import io
+import json
+from itertools import chain
+from typing import Iterable, Iterator, List, Tuple
+
+from django.db import transaction
+
+from creator_handler.forms import VenueImportForm, REGION_NAMES
+from event_handler.models import Stage, Venue
+from event_handler.page_cache import invalidate_event_page
+
+IMPORT_FIELDS = ['name', 'address', 'region', 'participants_maximum', 'contacts']
+EXPORT_FIELDS = ['id', 'name', 'address', 'region', 'region_name', 'participants_maximum', 'participants_count',
+                 'contacts', 'stage_id']
+EXPORT_VALUES = ['id', 'name', 'address', 'region', 'participants_maximum', 'participants_count', 'contacts',
+                 'parental_stage_id']
+IMPORT_BATCH_SIZE = 500  # Сколько площадок вставляется одним bulk_create
+MAX_IMPORT_ERRORS = 100  # Сколько ошибок строк возвращается в ответе
+EXPORT_CHUNK_SIZE = 1000  # Сколько площадок читается из базы за раз при выгрузке
+
+FORMATS = ("csv", "json")
+
+
+def read_csv_rows(file) -> Iterator[Tuple[int, dict]]:
+    """
+    Построчно прочитать CSV с заголовком (разделитель "," или ";", кодировка UTF-8, в том числе с BOM)
+    :param file: Бинарный файл, например загруженный через форму
+    :return: Генератор пар: номер строки в файле, словарь значений
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        header = text.readline()
+        delimiter = ";" if header.count(";") > header.count(",") else ","
+        reader = csv.DictReader(chain([header], text), delimiter=delimiter)
+        for row in reader:
+            yield reader.line_num, row
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise ValueError(f"Некорректный CSV: {e}")
+
+
+def read_json_rows(file) -> Iterator[Tuple[int, dict]]:
+    """
+    Прочитать JSON: список объектов с полями площадки
+    :return: Генератор пар: номер объекта (с 1), словарь значений
+    """
+    try:
+        rows = json.load(file)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Некорректный JSON: {e}")
+    if not isinstance(rows, list):
+        raise ValueError("Ожидается список площадок")
+    for number, row in enumerate(rows, start=1):
+        yield number, row if isinstance(row, dict) else {}
+
+
+def read_venue_rows(file, file_format: str) -> Iterator[Tuple[int, dict]]:
+    if file_format == "csv":
+        return read_csv_rows(file)
+    if file_format == "json":
+        return read_json_rows(file)
+    raise ValueError(f"Неизвестный формат: {file_format}")
+
+
+def import_venues(stage: Stage, rows: Iterable[Tuple[int, dict]], batch_size: int = IMPORT_BATCH_SIZE) \
+        -> Tuple[int, List[dict]]:
+    """
+    Проверить строки как форму площадки и создать площадки этапа через bulk_create в одной транзакции
+    Если хотя бы одна строка некорректна, ничего не создаётся
+    :param stage: Этап, к которому относятся площадки
+    :param rows: Пары: номер строки, словарь значений (см. read_venue_rows)
+    :param batch_size: Размер пачки bulk_create
+    :return: Пара: количество созданных площадок, ошибки строк [{'row': номер, 'errors': {поле: [сообщения]}}]
+    """
+    created = 0
+    errors = []
+    batch = []
+    with transaction.atomic():
+        for number, row in rows:
+            form = VenueImportForm({field: row.get(field) for field in IMPORT_FIELDS})
+            if not form.is_valid():
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({'row': number, 'errors': {field: list(messages)
+                                                             for field, messages in form.errors.items()}})
+                continue
+            if errors:
+                # Строки всё равно будут отменены, дальше только проверяем
+                continue
+            batch.append(Venue(parental_stage=stage, **form.cleaned_data))
+            if len(batch) >= batch_size:
+                created += len(Venue.objects.bulk_create(batch))
+                batch = []
+        if errors:
+            transaction.set_rollback(True)
+            return 0, errors
+        created += len(Venue.objects.bulk_create(batch))
+    # bulk_create не отправляет post_save, поэтому страница мероприятия сбрасывается явно
+    invalidate_event_page(stage.parent_id)
+    return created, errors
+
+
+class Echo:
+    """
+    Псевдо-файл для csv.writer: возвращает записанную строку вместо её сохранения
+    """
+
+    def write(self, value):
+        return value
+
+
+def venue_export_row(venue: dict) -> dict:
+    """
+    Строка выгрузки из значений площадки: добавляется название региона, parental_stage_id становится stage_id
+    """
+    venue['region_name'] = REGION_NAMES.get(venue['region'], "")
+    venue['stage_id'] = venue.pop('parental_stage_id')
+    return venue
+
+
+def export_venues(venues, file_format: str) -> Iterator[str]:
+    """
+    Выгрузить площадки по частям, не загружая весь список в память
+    :param venues: QuerySet площадок
+    :param file_format: "csv" или "json"
+    :return: Генератор фрагментов файла
+    """
+    values = venues.order_by('id').values(*EXPORT_VALUES).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if file_format == "csv":
+        writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS)
+        # BOM, чтобы Excel открыл файл в UTF-8
+        yield "\ufeff" + writer.writeheader()
+        for venue in values:
+            yield writer.writerow(venue_export_row(venue))
+    elif file_format == "json":
+        yield "["
+        for number, venue in enumerate(values):
+            yield ("," if number else "") + json.dumps(venue_export_row(venue), ensure_ascii=False)
+        yield "]"
+    else:
+        raise ValueError(f"Неизвестный формат: {file_format}")
@@ -1,10 +1,12 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 
 from creator_handler.db_controller import *
-from . import email
+from . import jobs
+from . import venue_io
 from .forms import VenueForm, StaffForm, EmailForm
+from .models import Job
 from event_handler.views import error404
 
 from json import load as json_load
@@ -138,6 +140,50 @@ def ban_participant(request, event_id: int):
     return JsonResponse({}, status=400)
 
 
+MODERATION_BATCH_LIMIT = 5000  # Максимальное количество заявок в одном запросе массовой модерации
+
+
+@login_required(login_url="login")
+def moderate_participants(request, event_id: int):
+    """
+    Массовое изменение статуса заявок
+
+    Тело запроса - json вида {"ids": [id пользователей], "status": статус из StageParticipants.Status}
+
+    :return: json с результатом по каждому id: updated, not_found или invalid
+    """
+    if request.method != "POST" or not is_ajax(request):
+        return JsonResponse({}, status=400)
+    if not c_db.user_have_access(request.user, event_id, c_db.SettingsSet.ACCEPT_APPLICATIONS):
+        return JsonResponse({"errors": "Not enough rights"}, status=400)
+    try:
+        data = json_load(request)
+        status = int(data["status"])
+        raw_ids = list(data["ids"])
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({"errors": "Invalid request"}, status=400)
+    if status not in StageParticipants.Status.values:
+        return JsonResponse({"errors": "Unknown status"}, status=400)
+    if len(raw_ids) > MODERATION_BATCH_LIMIT:
+        return JsonResponse({"errors": f"Too many ids, limit is {MODERATION_BATCH_LIMIT}"}, status=400)
+
+    results = {}
+    user_ids = []
+    for raw_id in raw_ids:
+        try:
+            user_ids.append(int(raw_id))
+        except (ValueError, TypeError):
+            results[str(raw_id)] = "invalid"
+    try:
+        outcomes = c_db.set_participants_status(user_ids, event_id, status)
+    except Exception as e:
+        print(e)  # - Заменить на логгирование
+        return JsonResponse({"errors": "Undefined server error"}, status=400)
+    results.update({str(user_id): outcome for user_id, outcome in outcomes.items()})
+    return JsonResponse({"results": results,
+                         "updated": sum(outcome == "updated" for outcome in outcomes.values())}, status=200)
+
+
 #
 #
 # @login_required
@@ -218,25 +264,112 @@ def add_staff(request):
     return render(request, 'creator_handler/add_staff.html', {'form': form})
 
 
+VENUE_COLUMNS = [
+    ("id Площадки", 'id'),
+    ("Название", 'name'),
+    ("Адрес", 'address'),
+    ("Регион", 'region'),
+    ("Вместимость", 'maximum'),
+    ("Занято мест", 'registered'),
+    ("Этап", 'stage'),
+]
+
+
 def venues_list(request, event_id: int):
+    """
+    Список площадок всех этапов мероприятия: постранично, с сортировкой по столбцам
+
+    :param request: объект с деталями запроса, ?sort=<столбец> или ?sort=-<столбец>, ?page=<номер>
+    :type request: :class: 'django.http.HttpRequest'
+    :param event_id: id мероприятия
+    :type event_id: :class: 'int'
+    :return: html страница
+    """
     if not c_db.user_have_access(request.user, event_id):
         return redirect('/404')
-    all_stages = c_db.get_stages_by_event(c_db.get_event_by_id(event_id))
-    #print(all_stages)
-    venues_list = []
-    for stage in all_stages:
-        venues_from_stage  = c_db.get_venues_by_stage_id(stage.id).values_list()
-        venues_list.extend(venues_from_stage)
-    #print(venues_list)
-    event = get_event_by_id(event_id)
+    sort = request.GET.get('sort', 'name')
+    if sort.lstrip('-') not in c_db.VENUE_SORT_FIELDS:
+        sort = 'name'
+    page = c_db.get_venues_page(event_id, sort, request.GET.get('page'))
+    columns = [{'title': title, 'sort': f"-{key}" if sort == key else key, 'active': sort.lstrip('-') == key}
+               for title, key in VENUE_COLUMNS]
     context = {
-        "venues_list": venues_list,
+        "venues_list": page,
+        "columns": columns,
+        "sort": sort,
         "navigation_buttons": NAVIGATE_BUTTONS,
-        "event": event,
+        "event": get_event_by_id(event_id),
     }
     return render(request, 'creator_handler/venues_list.html', context)
 
 
+@login_required(login_url="login")
+def import_venues(request, event_id: int):
+    """
+    Загрузка площадок этапа из файла CSV или JSON
+
+    :param request: объект с деталями запроса, POST: stage - id этапа, file - файл, format - csv или json
+    (по умолчанию по расширению файла)
+    :type request: :class: 'django.http.HttpRequest'
+    :param event_id: id мероприятия
+    :type event_id: :class: 'int'
+    :return: html страница с формой загрузки или json: количество созданных площадок либо ошибки строк
+    """
+    if not c_db.user_have_access(request.user, event_id, c_db.SettingsSet.EDIT_VENUES):
+        return redirect("/404")
+    stages = get_stages_by_event(event_id)
+    if request.method != "POST":
+        context = {
+            "stages": stages,
+            "formats": venue_io.FORMATS,
+            "fields": venue_io.IMPORT_FIELDS,
+        }
+        return render(request, 'creator_handler/import_venues.html', context)
+
+    file = request.FILES.get('file')
+    if file is None:
+        return JsonResponse({"errors": "Файл не выбран"}, status=400)
+    file_format = request.POST.get('format') or file.name.rsplit(".", 1)[-1].lower()
+    if file_format not in venue_io.FORMATS:
+        return JsonResponse({"errors": "Поддерживаются только CSV и JSON"}, status=400)
+    stage_id = request.POST.get('stage', "")
+    stage = stages.filter(id=stage_id).first() if stage_id.isdigit() else None
+    if stage is None:
+        return JsonResponse({"errors": "Этап не найден"}, status=400)
+    try:
+        created, errors = venue_io.import_venues(stage, venue_io.read_venue_rows(file, file_format))
+    except ValueError as e:
+        return JsonResponse({"errors": str(e)}, status=400)
+    if errors:
+        return JsonResponse({"errors": errors}, status=400)
+    return JsonResponse({"created": created}, status=200)
+
+
+@login_required(login_url="login")
+def export_venues(request, event_id: int):
+    """
+    Выгрузка площадок мероприятия потоком, без загрузки всего списка в память
+
+    :param request: объект с деталями запроса, ?format=csv|json, ?stage=<id этапа> - только площадки этапа
+    :type request: :class: 'django.http.HttpRequest'
+    :param event_id: id мероприятия
+    :type event_id: :class: 'int'
+    :return: файл площадок
+    """
+    if not c_db.user_have_access(request.user, event_id, c_db.SettingsSet.EDIT_VENUES):
+        return redirect("/404")
+    file_format = request.GET.get('format', "csv")
+    if file_format not in venue_io.FORMATS:
+        return JsonResponse({"errors": "Поддерживаются только CSV и JSON"}, status=400)
+    venues = c_db.get_venues_by_event(event_id)
+    if request.GET.get('stage', "").isdigit():
+        venues = venues.filter(parental_stage=request.GET['stage'])
+    content_type = "text/csv; charset=utf-8" if file_format == "csv" else "application/json"
+    response = StreamingHttpResponse(venue_io.export_venues(venues, file_format), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="venues_{event_id}.{file_format}"'
+    return response
+
+
 @login_required(login_url="login")
 def delete_venue(request, event_id: int):
     if request.method == "POST" and is_ajax(request):
@@ -319,7 +452,7 @@ def make_newsletter(request, event_id: int):
         if form.is_valid():
             subject = form.cleaned_data['subject']
             text = form.cleaned_data['text']
-            email.send_message(c_db.get_participants_by_event(get_event_by_id(event_id)), text, subject)
+            jobs.enqueue_newsletter(event_id, subject, text)
             return redirect(f'/events/edit/{event_id}/participants/')
     form = EmailForm()
     return render(request, 'creator_handler/create_newsletter.html', {"form": form})
@@ -392,14 +525,41 @@ def edit_stage(request, event_id: int):
 
 @login_required(login_url="login")
 def commit_stage(request, event_id, stage_id):
+    """
+    Поставить в очередь завершение этапа
+
+    Этап завершается командой run_jobs, ход выполнения можно узнать по адресу status_url
+
+    :return: 202 и данные задачи
+    """
     stage = get_stage_by_id(stage_id)
     if not user_have_access(request.user, event_id) or event_id != get_event_by_stage(stage).id:
         return error404(request)
     # if request.method != "POST":
     #     return JsonResponse({}, status=403)
     try:
-        end_stage(stage, 1)
-        return JsonResponse({}, status=200)
+        job = jobs.enqueue_end_stage(stage.id, event_id, 1)
+        return JsonResponse({'job_id': job.id,
+                             'status_url': f'/event/{event_id}/edit/jobs/{job.id}'}, status=202)
     except Exception as e:
         print(e)
-        return JsonResponse({'errors': "something went wrong"}, status=500)
\ No newline at end of file
+        return JsonResponse({'errors': "something went wrong"}, status=500)
+
+
+@login_required(login_url="login")
+def job_status(request, event_id: int, job_id: int):
+    """
+    Статус фоновой задачи мероприятия
+
+    :return: json со статусом, прогрессом и сообщением задачи
+    """
+    if not user_have_access(request.user, event_id):
+        return JsonResponse({"errors": "Not enough rights"}, status=400)
+    job = Job.objects.filter(id=job_id, payload__event_id=event_id).first()
+    if job is None:
+        return JsonResponse({"errors": "There is no such job"}, status=404)
+    return JsonResponse({'job_id': job.id,
+                         'status': Job.Status(job.status).name.lower(),
+                         'progress': job.progress,
+                         'message': job.message,
+                         'attempts': job.attempts})
@@ -0,0 +1,210 @@
+"""
+Замеры запросов: количество SQL-запросов, время в базе, время рендеринга шаблонов и общее время
+для каждого запроса с разбивкой по имени URL
+"""
+import json
+import logging
+import threading
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import JsonResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+from creator_handler.benchmark import percentile
+
+logger = logging.getLogger("distributedEvents.requests")
+
+current_metrics: ContextVar = ContextVar("current_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+    Класс **RequestMetrics**
+
+    Замеры одного запроса. SQL группируется по тексту запроса без параметров,
+    поэтому память не растёт с количеством одинаковых запросов (N+1)
+
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+        self.total_ms = 0.0
+        self.statements = {}  # SQL -> [количество, время в мс]
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Обёртка выполнения SQL (connection.execute_wrapper)
+        """
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (perf_counter() - started) * 1000
+            self.queries += 1
+            self.db_ms += elapsed
+            statement = self.statements.setdefault(sql, [0, 0.0])
+            statement[0] += 1
+            statement[1] += elapsed
+
+    def slowest_statements(self, limit: int = 20) -> list:
+        """
+        SQL-запросы, на которые ушло больше всего времени
+        :return: Список словарей sql, count, ms
+        """
+        statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [{'sql': sql, 'count': count, 'ms': round(ms, 3)} for sql, (count, ms) in statements]
+
+
+class RequestStats:
+    """
+    Класс **RequestStats**
+
+    Скользящие замеры последних запросов каждого URL в памяти процесса
+
+    :param window: Сколько последних запросов хранится для каждого URL
+
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, url_name: str, metrics: RequestMetrics) -> None:
+        with self.lock:
+            samples = self.samples.setdefault(url_name, deque(maxlen=self.window))
+            samples.append((metrics.total_ms, metrics.db_ms, metrics.template_ms, metrics.queries))
+
+    def reset(self) -> None:
+        with self.lock:
+            self.samples = {}
+
+    def summary(self) -> dict:
+        """
+        Сводка по каждому URL: количество запросов, перцентили общего времени, средние время в базе,
+        время рендеринга и количество SQL-запросов
+        """
+        with self.lock:
+            samples = {url_name: list(values) for url_name, values in self.samples.items()}
+        summary = {}
+        for url_name, values in samples.items():
+            total, db, template, queries = zip(*values)
+            summary[url_name] = {
+                'requests': len(values),
+                'p50_ms': round(percentile(total, 50), 3),
+                'p90_ms': round(percentile(total, 90), 3),
+                'p99_ms': round(percentile(total, 99), 3),
+                'max_ms': round(max(total), 3),
+                'db_ms': round(sum(db) / len(db), 3),
+                'template_ms': round(sum(template) / len(template), 3),
+                'queries': round(sum(queries) / len(queries), 1),
+                'queries_max': max(queries),
+            }
+        return summary
+
+
+request_stats = RequestStats(getattr(settings, 'INSTRUMENTATION_WINDOW', 500))
+
+
+class InstrumentationMiddleware:
+    """
+    Класс **InstrumentationMiddleware**
+
+    Считает SQL-запросы и время каждого запроса, добавляет замеры в request_stats
+    и пишет строку лога в формате json. Запросы дольше settings.SLOW_REQUEST_MS
+    логируются с уровнем WARNING вместе с самыми долгими SQL-запросами
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            metrics.total_ms = (perf_counter() - started) * 1000
+            current_metrics.reset(token)
+
+        match = getattr(request, 'resolver_match', None)
+        url_name = (match.url_name or match.view_name) if match else "<unresolved>"
+        request_stats.add(url_name, metrics)
+        self.log(request, response, url_name, metrics)
+        return response
+
+    @staticmethod
+    def log(request, response, url_name: str, metrics: RequestMetrics) -> None:
+        record = {
+            'url_name': url_name,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(metrics.total_ms, 3),
+            'db_ms': round(metrics.db_ms, 3),
+            'template_ms': round(metrics.template_ms, 3),
+            'queries': metrics.queries,
+        }
+        if metrics.total_ms >= getattr(settings, 'SLOW_REQUEST_MS', 500):
+            record['slow'] = True
+            record['sql'] = metrics.slowest_statements()
+            logger.warning(json.dumps(record, ensure_ascii=False))
+        else:
+            logger.info(json.dumps(record, ensure_ascii=False))
+
+
+class InstrumentedTemplate(Template):
+    """
+    Шаблон, время рендеринга которого добавляется к замерам текущего запроса
+    """
+
+    def render(self, context=None, request=None):
+        started = perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics = current_metrics.get()
+            if metrics is not None:
+                metrics.template_ms += (perf_counter() - started) * 1000
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    Бэкенд шаблонов Django с замером времени рендеринга (TEMPLATES[...]['BACKEND'])
+    """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return InstrumentedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+@staff_member_required
+def show_request_stats(request):
+    """
+    Сводка замеров по URL для администраторов
+
+    :return: json со сводкой, ?reset=1 - сбросить замеры после выдачи
+    """
+    summary = request_stats.summary()
+    if request.GET.get("reset"):
+        request_stats.reset()
+    return JsonResponse({'window': request_stats.window, 'views': summary})
@@ -0,0 +1,143 @@
+"""
+Чтение публичных страниц из реплики - отдельного соединения только для чтения (settings.REPLICA_DATABASE)
+
+Страницы, обёрнутые в replica_reads, читают из реплики, все записи идут в основную базу.
+Чтение возвращается в основную базу:
+ - после первой записи в этом же запросе;
+ - на settings.REPLICA_PIN_SECONDS после запроса с записью (cookie settings.REPLICA_PIN_COOKIE),
+   чтобы пользователь сразу видел свои изменения;
+ - внутри read_from_primary().
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+request_state: ContextVar = ContextVar("replica_request_state", default=None)
+
+
+class ReplicaState:
+    """
+    Класс **ReplicaState**
+
+    Маршрутизация чтения в рамках одного запроса
+
+    :param replica: Страница разрешает чтение из реплики
+    :param pinned: Читать только из основной базы
+    :param wrote: В запросе была запись
+
+    """
+
+    def __init__(self, pinned: bool = False):
+        self.replica = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+def get_replica_alias() -> str:
+    """
+    Alias реплики или основной базы, если реплика не настроена или указывает на ту же базу
+    Так, зеркало основной базы в тестах (TEST MIRROR) - другое соединение, которое не видит
+    данных незакоммиченной транзакции теста, поэтому вместо него используется сама основная база
+    """
+    alias = getattr(settings, 'REPLICA_DATABASE', None)
+    if not alias or alias not in connections.settings:
+        return DEFAULT_DB_ALIAS
+    # NAME может быть как строкой, так и Path
+    if str(connections[alias].settings_dict['NAME']) == str(connections[DEFAULT_DB_ALIAS].settings_dict['NAME']):
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+class ReplicaRouter:
+    """
+    Класс **ReplicaRouter**
+
+    Роутер баз данных (settings.DATABASE_ROUTERS): запись и миграции - только основная база,
+    чтение - реплика, если её разрешила страница и в запросе ещё не было записи
+
+    """
+
+    def db_for_read(self, model, **hints):
+        state = request_state.get()
+        if state is not None and state.replica and not state.pinned:
+            return get_replica_alias()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = request_state.get()
+        if state is not None:
+            state.wrote = state.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика - та же база, связи между объектами из разных соединений допустимы
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, 'REPLICA_DATABASE', None):
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """
+    Класс **ReplicaMiddleware**
+
+    Создаёт состояние маршрутизации для запроса и ставит cookie, закрепляющую чтение за основной базой
+    после запроса с записью
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = ReplicaState(pinned=settings.REPLICA_PIN_COOKIE in request.COOKIES)
+        token = request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_state.reset(token)
+        if state.wrote:
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite="Lax")
+        return response
+
+
+def replica_reads(view):
+    """
+    Декоратор страницы, которая только читает данные: её запросы идут в реплику
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        state = request_state.get()
+        if state is None:
+            return view(request, *args, **kwargs)
+        previous = state.replica
+        state.replica = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            state.replica = previous
+    return wrapper
+
+
+@contextmanager
+def read_from_primary():
+    """
+    Читать из основной базы внутри блока, например сразу после записи в другом запросе
+    """
+    state = request_state.get()
+    if state is None:
+        yield
+        return
+    previous = state.pinned
+    state.pinned = True
+    try:
+        yield
+    finally:
+        # После записи внутри блока чтение остаётся в основной базе
+        state.pinned = previous or state.wrote
@@ -10,11 +10,28 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+from dotenv import load_dotenv
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+load_dotenv(BASE_DIR / '.env')
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Целое число из переменной окружения: неверное значение - ImproperlyConfigured с именем переменной
+    """
+    value = os.environ.get(name, default)
+    try:
+        return int(value)
+    except ValueError:
+        raise ImproperlyConfigured(f"Переменная окружения {name} должна быть целым числом: {value}")
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.1/howto/deployment/checklist/
 
@@ -42,11 +59,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'distributedEvents.instrumentation.InstrumentationMiddleware',
+    'distributedEvents.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'user_handler.middleware.DomainUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -55,7 +75,8 @@ ROOT_URLCONF = 'distributedEvents.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates с замером времени рендеринга для InstrumentationMiddleware
+        'BACKEND': 'distributedEvents.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [
             'static/templates/',
         ],
@@ -80,7 +101,90 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Соединение переиспользуется между запросами потока столько секунд (0 - закрывать после запроса)
+        'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 600),
+        'CONN_HEALTH_CHECKS': True,
+    },
+    # Только чтение для публичных страниц (distributedEvents/routers.py): по умолчанию тот же файл,
+    # открытый в режиме ro, можно указать периодически обновляемую копию
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('DB_REPLICA_NAME', (BASE_DIR / 'db.sqlite3').as_uri() + '?mode=ro'),
+        'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 600),
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['distributedEvents.routers.ReplicaRouter']
+REPLICA_DATABASE = 'replica'
+# Сколько секунд после запроса с записью пользователь читает из основной базы
+REPLICA_PIN_SECONDS = env_int('REPLICA_PIN_SECONDS', 5)
+REPLICA_PIN_COOKIE = 'read_primary'
+
+# PRAGMA для каждого нового соединения SQLite (distributedEvents/sqlite.py)
+# Значения проверяет distributedEvents.sqlite.get_pragma_statements
+SQLITE_PRAGMAS = {
+    # WAL: чтение не блокирует запись, записи идут последовательно без ошибок "database is locked"
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    # NORMAL в режиме WAL не теряет целостность, fsync только при checkpoint
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    # Сколько миллисекунд ждать освобождения базы другим соединением
+    'busy_timeout': os.environ.get('SQLITE_BUSY_TIMEOUT', 5000),
+    # Размер кэша страниц: отрицательное значение - в КиБ
+    'cache_size': os.environ.get('SQLITE_CACHE_SIZE', -64000),
+    # Сколько байт файла базы читается через mmap
+    'mmap_size': os.environ.get('SQLITE_MMAP_SIZE', 268435456),
+}
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'distributed-events',
+    },
+    # Версии закэшированных данных (distributedEvents/versions.py) должны быть общими для веб-сервера
+    # и обработчика run_jobs: кэш на файлах подходит для одной машины, для нескольких нужен Redis или Memcached
+    'versions': {
+        'BACKEND': os.environ.get('VERSION_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('VERSION_CACHE_LOCATION',
+                                   os.path.join(tempfile.gettempdir(), 'distributed-events-versions')),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+VERSION_CACHE = 'versions'
+PERMISSION_CACHE_TIMEOUT = 300  # Сколько секунд хранятся права модераторов на мероприятие
+EVENT_PAGE_CACHE_TIMEOUT = 600  # Сколько секунд хранятся общие части страницы мероприятия
+LEADERBOARD_CACHE_TIMEOUT = 600  # Сколько секунд хранятся страницы рейтинга этапа (сбрасываются при изменении баллов)
+
+# Замеры запросов (distributedEvents/instrumentation.py)
+
+SLOW_REQUEST_MS = env_int('SLOW_REQUEST_MS', 500)  # Запросы дольше логируются вместе с SQL
+INSTRUMENTATION_WINDOW = 500  # Сколько последних запросов каждого URL учитывается в сводке
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'distributedEvents.requests': {
+            'handlers': ['console'],
+            'level': os.environ.get('REQUEST_LOG_LEVEL', 'WARNING'),
+        },
+        'creator_handler': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
 }
 
 # Password validation
@@ -138,4 +242,10 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = 'distrib.events@gmail.com'
 EMAIL_HOST_PASSWORD = 'rxaujxwbqwcuvnok'
 DEFAULT_FROM_EMAIL = 'Your name'
+MAIL_BATCH_SIZE = 50  # Сколько писем рассылки отправляется за один вызов send_messages
+NEWSLETTER_RATE = 1  # Сколько писем рассылки отправляется в секунду (ограничения SMTP Gmail)
+NEWSLETTER_MAX_ATTEMPTS = 5  # Сколько раз пытаться отправить письмо рассылки
+NEWSLETTER_JOB_BATCH = 60  # Сколько писем отправляет задача рассылки за один запуск, остальные - при следующих
+NEWSLETTER_STALE_AFTER = 600  # Через сколько секунд письмо в статусе SENDING возвращается в ожидающие
+NEWSLETTER_JOB_RETRY_AFTER = 60  # Через сколько секунд задача рассылки проверяет письма, занятые другим обработчиком
 DEFAULT_TO_EMAIL = 'Your email'
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""
+Настройка соединений SQLite: PRAGMA из settings.SQLITE_PRAGMAS выполняются для каждого нового соединения
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+INTEGER_PRAGMAS = ("busy_timeout", "cache_size", "mmap_size")
+
+# Настройки SQLite по умолчанию, как до настройки: для сравнения в benchmark_registration
+BASELINE_PRAGMAS = {
+    'journal_mode': "DELETE",
+    'synchronous': "FULL",
+}
+
+
+def get_pragma_statements(pragmas: dict) -> list:
+    """
+    Проверить настройки и составить команды PRAGMA
+    :param pragmas: Словарь: journal_mode, synchronous, busy_timeout (мс), cache_size (страницы,
+    отрицательное - КиБ), mmap_size (байты); отсутствующие ключи не меняются
+    :return: Список SQL-команд
+    """
+    statements = []
+    if 'journal_mode' in pragmas:
+        journal_mode = str(pragmas['journal_mode']).upper()
+        if journal_mode not in JOURNAL_MODES:
+            raise ImproperlyConfigured(f"Неизвестный journal_mode SQLite: {pragmas['journal_mode']}")
+        statements.append(f"PRAGMA journal_mode={journal_mode}")
+    if 'synchronous' in pragmas:
+        synchronous = str(pragmas['synchronous']).upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ImproperlyConfigured(f"Неизвестный synchronous SQLite: {pragmas['synchronous']}")
+        statements.append(f"PRAGMA synchronous={synchronous}")
+    for name in INTEGER_PRAGMAS:
+        if name in pragmas:
+            try:
+                statements.append(f"PRAGMA {name}={int(pragmas[name])}")
+            except (TypeError, ValueError):
+                raise ImproperlyConfigured(f"{name} SQLite должен быть целым числом: {pragmas[name]}")
+    return statements
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Обработчик сигнала connection_created: выполнить PRAGMA для нового соединения SQLite
+    """
+    if connection.vendor != "sqlite":
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    if is_read_only(connection):
+        # Режим журнала и синхронизацию задаёт соединение для записи
+        pragmas = {name: value for name, value in pragmas.items() if name not in ('journal_mode', 'synchronous')}
+    with connection.cursor() as cursor:
+        for statement in get_pragma_statements(pragmas):
+            cursor.execute(statement)
+
+
+def is_read_only(connection) -> bool:
+    return "mode=ro" in str(connection.settings_dict['NAME'])
+
+
+def get_current_pragmas(connection) -> dict:
+    """
+    Текущие значения настраиваемых PRAGMA соединения (None - PRAGMA не поддерживается, например mmap_size
+    для базы в памяти)
+    """
+    with connection.cursor() as cursor:
+        answer = {}
+        for name in ('journal_mode', 'synchronous', *INTEGER_PRAGMAS):
+            cursor.execute(f"PRAGMA {name}")
+            row = cursor.fetchone()
+            answer[name] = row[0] if row else None
+    return answer
@@ -21,8 +21,10 @@ from django.conf.urls.static import static
 from event_handler import views
 from user_handler import views as user_views
 from creator_handler import views as creator_views
+from distributedEvents.instrumentation import show_request_stats
 urlpatterns = [
     # path('test/', creator_views.test, name='test'),
+    path('stats/requests', show_request_stats, name='request_stats'),
     path('admin/', admin.site.urls),
     path('create-event/', views.create_event, name='create_event'),
 
@@ -31,6 +33,7 @@ urlpatterns = [
     path('stage_registration/<int:stage_id>', views.current_stage_registration, name="current_stage_registration"),
     path('', views.show_events, name="all_events"),
     path('event/<int:event_id>/stage/<int:stage_id>/all_participants', views.show_all_participants, name="all_participants"),
+    path('event/<int:event_id>/stage/<int:stage_id>/leaderboard', views.leaderboard_json, name="leaderboard"),
 
 
     path('register/', user_views.register, name='register'),
@@ -44,12 +47,15 @@ urlpatterns = [
     path('event/<int:event_id>/edit/venue/<int:venue_id>', creator_views.edit_venue, name="edit_venue"),
     path('event/<int:event_id>/edit/venue/create', creator_views.create_venue, name="create_venue"),
     path('event/<int:event_id>/edit/venue/delete', creator_views.delete_venue, name="delete_venue"),
+    path('event/<int:event_id>/edit/venue/import', creator_views.import_venues, name="import_venues"),
+    path('event/<int:event_id>/edit/venue/export', creator_views.export_venues, name="export_venues"),
 
     path('event/<int:event_id>/edit/stages/', creator_views.stages_list, name="stages_list"),
     path('event/<int:event_id>/edit/stages/<stage_id>/end', creator_views.commit_stage, name="end_stage"),
     path('event/<int:event_id>/edit/stages/create', creator_views.create_stage, name="create_stage"),
     path('event/<int:event_id>/edit/stages/delete', creator_views.delete_stage, name="delete_stage"),
     path('event/<int:event_id>/edit/stages/edit', creator_views.edit_stage, name="edit_stage"),
+    path('event/<int:event_id>/edit/jobs/<int:job_id>', creator_views.job_status, name="job_status"),
     # path('event/<int:event_id>/edit/stages/', creator_views.stages_list, name="test"),
 
     # path('event/<int:event_id>/edit/stages/create', creator_views.create_stage, name="create_stage"),
@@ -62,6 +68,8 @@ urlpatterns = [
     path('event/<int:event_id>/edit/participants/accepted', creator_views.accept_participant,
          name="accept_participant"),
     path('event/<int:event_id>/edit/participants/ban', creator_views.ban_participant, name="ban_participant"),
+    path('event/<int:event_id>/edit/participants/moderate', creator_views.moderate_participants,
+         name="moderate_participants"),
 
     path('event/<int:event_id>/edit/participants/make_newsletter', creator_views.make_newsletter, name='make_newsletter')
 ]
@@ -0,0 +1,78 @@
+"""
+Версии закэшированных данных: страниц мероприятий, рейтингов этапов и прав модераторов
+
+Данные кэшируются под ключом с текущей версией, а при изменении версия меняется, и старые записи перестают
+читаться. Версии хранятся в отдельном кэше settings.VERSION_CACHE, общем для всех процессов: этапы завершает
+обработчик фоновых задач run_jobs, и сброс версии в нём должен быть виден веб-серверу. Сами данные остаются
+в локальном кэше процесса
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time_ns
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+deferred_bumps: ContextVar = ContextVar("deferred_version_bumps", default=None)
+
+
+def version_cache():
+    return caches[getattr(settings, 'VERSION_CACHE', 'versions')]
+
+
+def get_version(key: str) -> int:
+    """
+    Текущая версия
+    :param key: Ключ версии
+    """
+    versions = version_cache()
+    version = versions.get(key)
+    if version is None:
+        # Начальная версия берётся из времени, чтобы после вытеснения ключа не вернуться к старой
+        versions.add(key, time_ns(), None)
+        version = versions.get(key)
+    return version
+
+
+def bump_version(key: str) -> None:
+    """
+    Сменить версию
+    Новая версия - текущее время, а не incr: в кэше на файлах incr не атомарен, и при одновременном
+    сбросе из двух процессов одна из смен версии могла бы потеряться
+    :param key: Ключ версии
+    """
+    version_cache().set(key, time_ns(), None)
+
+
+def bump_version_on_commit(key: str) -> None:
+    """
+    Сменить версию после фиксации текущей транзакции: иначе данные, прочитанные до фиксации,
+    успеют закэшироваться по новой версии
+    Внутри defer_version_bumps каждая версия меняется один раз на весь блок
+    :param key: Ключ версии
+    """
+    deferred = deferred_bumps.get()
+    if deferred is not None:
+        deferred.add(key)
+        return
+    transaction.on_commit(lambda: bump_version(key))
+
+
+@contextmanager
+def defer_version_bumps():
+    """
+    Собрать смены версий за блок и сменить каждую один раз после фиксации транзакции
+    (например, при удалении поддерева из тысяч этапов одного мероприятия)
+    """
+    if deferred_bumps.get() is not None:
+        yield
+        return
+    keys = set()
+    token = deferred_bumps.set(keys)
+    try:
+        yield
+    finally:
+        deferred_bumps.reset(token)
+    for key in keys:
+        transaction.on_commit(lambda key=key: bump_version(key))
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Event, Stage, StageRelation, StageStaff, StageParticipants, Venue
+from .models import Event, EventSummary, Stage, StageRelation, StageStaff, StageParticipants, Venue
 
 
 @admin.register(Event)
@@ -30,3 +30,9 @@ class StageStaffAdmin(admin.ModelAdmin):
 @admin.register(Venue)
 class VenueAdmin(admin.ModelAdmin):
     list_display = ("id", "name", "address", "parental_stage_id", "contacts")
+
+
+
+@admin.register(EventSummary)
+class EventSummaryAdmin(admin.ModelAdmin):
+    list_display = ("event", "is_open", "first_stage", "participants_count")
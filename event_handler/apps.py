@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class EventHandlerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'event_handler'
+
+    def ready(self):
+        from event_handler import signals  # noqa: F401 - подключение обработчиков сигналов
+        from event_handler.summary import backfill_event_summaries
+        post_migrate.connect(backfill_event_summaries, sender=self)
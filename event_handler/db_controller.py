@@ -1,51 +1,127 @@
 from user_handler.models import User, PersonalData
 from event_handler.models import Stage, Event, StageStaff, StageParticipants
 
+from event_handler.leaderboard import ROLE_NAMES, get_leaderboard_page
+from event_handler.summary import is_open_expression
 from user_handler.db_controller import create_user_for_django_user
 
 from django.contrib.auth.admin import User as DjangoUser
+from django.db.models import Exists, ExpressionWrapper, OuterRef, Value, BooleanField, Q
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.core.exceptions import ObjectDoesNotExist
-from typing import Union, List, Tuple, Set
+from typing import Union, List, Tuple, Set, Optional, Iterable, Iterator
 
 from itertools import chain
 
 from collections import namedtuple
 
 ITEMS_PER_PAGE = 12  # Количество объектов в одной странице выдачи
+RESULTS_PER_PAGE = 100  # Количество строк в одной странице таблицы результатов
 
-import itertools
+ResultRow = namedtuple("ResultRow", "num name_all status_score total_score")
 
 
-def get_list_results_by_stage(stage_id: int):
-    info_stage = get_stage_by_id(stage_id)
-    # participants = StageParticipants.objects.filter(stage=stage_id).values_list('user', 'role', 'score')
-    # participants = StageParticipants.objects.filter(stage=stage_id).order_by('score').values_list('user', 'role', 'score').reverse()
-    participants = StageParticipants.objects.filter(stage=stage_id).order_by('-role', '-score')
+class ResultsCursor(namedtuple("ResultsCursor", "role score id num")):
+    """
+    Позиция в таблице результатов для keyset-пагинации
+
+    :param role: Роль последнего участника на странице
+    :param score: Баллы последнего участника на странице
+    :param id: id последней записи StageParticipants на странице
+    :param num: Номер последней строки на странице
+    """
+
+    def to_param(self) -> str:
+        return ".".join(str(value) for value in self)
+
+    @classmethod
+    def from_param(cls, param: Optional[str]):
+        """
+        Разобрать курсор из параметра запроса
+        :param param: Строка вида role.score.id.num
+        :return: Курсор или None, если параметр пустой или некорректный
+        """
+        if not param:
+            return None
+        try:
+            return cls(*map(int, param.split(".")))
+        except (TypeError, ValueError):
+            return None
+
+
+def get_results_page(stage_id: int, cursor: ResultsCursor = None,
+                     limit: int = RESULTS_PER_PAGE) -> Tuple[List[ResultRow], Optional[ResultsCursor]]:
+    """
+    Получить одну страницу таблицы результатов этапа
+    Участник, его пользователь и персональные данные загружаются одним запросом,
+    страницы отсчитываются по ключу (role, score, id), а не через OFFSET
+    :param stage_id: id этапа
+    :param cursor: Позиция, после которой начинается страница (None - первая страница)
+    :param limit: Количество строк на странице
+    :return: Пара: строки страницы, курсор следующей страницы (None, если страница последняя)
+    """
+    participants = StageParticipants.objects.filter(stage=stage_id) \
+        .select_related('user__user', 'user__personal_data') \
+        .annotate(total_score=Coalesce('score', 0)) \
+        .order_by('-role', '-total_score', '-id')
+    if cursor is not None:
+        participants = participants.filter(
+            Q(role__lt=cursor.role) |
+            Q(role=cursor.role, total_score__lt=cursor.score) |
+            Q(role=cursor.role, total_score=cursor.score, id__lt=cursor.id)
+        )
+    participants = list(participants[:limit + 1])
+
+    num = cursor.num if cursor is not None else 0
     answer = []
-    for index, participant in enumerate(participants):
-        role = ""
-        if participant.role == 0:
-            role = "Участник"
-        elif participant.role == 10:
-            role = "Призер"
-        else:
-            role = "Победитель"
-
-        list = namedtuple("namedtuplelist", "num name_all status_score total_score")
-        # answer.append((index + 1, participant.user.personal_data, role, participant.score))
-        # print("here")
-        if participant.user.personal_data.name != "" and participant.user.personal_data.surname != "":
-            # print("participant.user.personal_data='", participant.user.personal_data,"'", sep='')
-            answer.append(list(num=(index + 1), name_all=participant.user.personal_data, status_score=(role),
-                               total_score=(participant.score)))
-        else:
-            # print("participant.user.username")
-            answer.append(
-                list(num=(index + 1), name_all=participant.user, status_score=(role), total_score=(participant.score)))
-    # (user, role, score)
-    # print(participants, "participants")
-    return answer
+    for participant in participants[:limit]:
+        num += 1
+        personal_data = participant.user.personal_data
+        name_all = personal_data if personal_data.name != "" and personal_data.surname != "" else participant.user
+        answer.append(ResultRow(num=num, name_all=name_all,
+                                status_score=ROLE_NAMES.get(participant.role, "Победитель"),
+                                total_score=participant.total_score))
+
+    next_cursor = None
+    if len(participants) > limit:
+        last = participants[limit - 1]
+        next_cursor = ResultsCursor(role=last.role, score=last.total_score, id=last.id, num=num)
+    return answer, next_cursor
+
+
+def iter_results_by_stage(stage_id: int, page_size: int = RESULTS_PER_PAGE) -> Iterator[ResultRow]:
+    """
+    Постранично обойти таблицу результатов этапа, не загружая её в память целиком
+    :param stage_id: id этапа
+    :param page_size: Размер одной страницы
+    :return: Генератор строк таблицы результатов
+    """
+    cursor = None
+    while True:
+        page, cursor = get_results_page(stage_id, cursor, page_size)
+        yield from page
+        if cursor is None:
+            return
+
+
+def get_list_results_by_stage(stage_id: int) -> List[ResultRow]:
+    """
+    Получить таблицу результатов этапа целиком
+    Номер строки - место в рейтинге: у участников с одинаковыми ролью и баллами он одинаковый
+    :param stage_id: id этапа
+    :return: Список строк: место, участник, статус результата, баллы
+    """
+    get_stage_by_id(stage_id)
+    answer = []
+    cursor = None
+    while True:
+        leaderboard = get_leaderboard_page(stage_id, after=cursor)
+        answer.extend(ResultRow(num=row.place, name_all=row.name, status_score=row.status, total_score=row.score)
+                      for row in leaderboard['rows'])
+        cursor = leaderboard['next']
+        if cursor is None:
+            return answer
 
 
 def get_info_event(event_id: int) -> Union[Event]:
@@ -61,67 +137,81 @@ def get_info_event(event_id: int) -> Union[Event]:
         return None
 
 
+def get_events_catalogue(django_user: DjangoUser = None) -> Tuple[List, List]:
+    """
+    Получить открытые и закрытые мероприятия одним запросом
+    Мероприятие открыто, если хотя бы на один его этап можно зарегистрироваться (EventSummary.is_open)
+    :param django_user: Пользователь, сделавший запрос
+    :return: Пара списков (открытые, закрытые) из пар: мероприятие, bool участвует ли django_user в этом мероприятии
+    """
+    if django_user is not None and not django_user.is_anonymous:
+        is_participant = Exists(StageParticipants.objects.filter(stage__parent=OuterRef('pk'), user__user=django_user))
+    else:
+        is_participant = Value(False, output_field=BooleanField())
+    # Без сводки (если она ещё не создана) открытость считается по этапам мероприятия
+    events = Event.objects.annotate(is_open=Coalesce('summary__is_open', is_open_expression(OuterRef('pk'))),
+                                    is_participant=is_participant)
+
+    events_open, events_closed = list(), list()
+    for event in events:
+        if event.is_open:
+            events_open.append((event, event.is_participant))
+        else:
+            events_closed.append((event, event.is_participant))
+    return events_open, events_closed
+
+
 def get_open_or_closed_events(django_user: DjangoUser = None, is_open: bool = True) -> Union[
     List, Union[Tuple, Event, int]]:
     """
     Получить список открытых или закрытых мероприятий по заданным параметрам
+    Если нужны оба списка, используйте get_events_catalogue: он строит их за один запрос
     :param django_user: Пользователь, сделавший запрос
     :return: Список из пар: мероприятие, bool участвует ли django_user в этом мероприятии
 
     """
+    events_open, events_closed = get_events_catalogue(django_user)
+    return events_open if is_open else events_closed
 
-    user_events = set()
-    if (not django_user.is_anonymous) and django_user is not None:
-        user = get_user_by_django_user(django_user)
-        user_events = get_user_events(user)
-
-    result = list()
-    stages_open = Stage.objects.filter(settings__can_register=True)
-    stages_closed = Stage.objects.filter(settings__can_register=False)
-    # print(stages_open)
-    # print(stages_closed)
-    events_opened_id = stages_open.values_list('parent', flat=True).distinct()
-    events_closed_id = Event.objects.exclude(id__in=events_opened_id).values_list('id', flat=True)
-    # print(events_opened_id)
-    # print(events_closed_id)
-    if is_open:
-        events_opened = Event.objects.filter(id__in=events_opened_id)
-        for event in events_opened:
-            result.append((event, True))
-    else:
-        events_closed = Event.objects.filter(id__in=events_closed_id)
-        for event in events_closed:
-            result.append((event, False))
-    return result
-    # for event_id in parents_event:
-    #    if event in user_events:
-    #        result.append((event, True))
-    #    else:
-    #        result.append((event, False))
-    # return result
+
+def get_user_events_condition(django_user: DjangoUser, user_role=0):
+    """
+    Условие для Event.objects.filter: в мероприятии есть этап, в котором участвует django_user
+    :param django_user: Пользователь, сделавший запрос
+    :param user_role: Роль пользователя. (0 - все, 1 - участник, 2 - модератор)
+    """
+    participant = Exists(StageParticipants.objects.filter(stage__parent=OuterRef('pk'), user__user=django_user))
+    staff = Exists(StageStaff.objects.filter(stage__parent=OuterRef('pk'), user__user=django_user))
+    if user_role == 1:
+        return Q(participant)
+    if user_role == 2:
+        return Q(staff)
+    return Q(participant) | Q(staff)
+
+
+def get_event_first_stage(event: Event) -> Optional[Stage]:
+    """
+    Первый этап мероприятия из сводки (загружайте события с select_related('summary__first_stage'))
+    Сводки может не быть, пока не запущена rebuild_event_summaries (например, после загрузки фикстур)
+    """
+    summary = getattr(event, 'summary', None)
+    return summary.first_stage if summary is not None else None
 
 
 def get_all_events(django_user: DjangoUser = None) -> Union[List, Union[Tuple, Event, Stage, int]]:
     """
     Получить список всех мероприятий по заданным параметрам
+    Мероприятия, их первые этапы и участие пользователя загружаются одним запросом
     :param django_user: Пользователь, сделавший запрос
     :return: Список из троек: мероприятие, его первый этап, bool участвует ли django_user в этом мероприятии
 
     """
-
-    user_events = set()
-    if (not django_user.is_anonymous) and django_user is not None:
-        user = get_user_by_django_user(django_user)
-        user_events = get_user_events(user)
-
-    result = list()
-    events = Event.objects.all()
-    for event in events:
-        if event in user_events:
-            result.append((event, event.stage_set.first, True))
-        else:
-            result.append((event, event.stage_set.first, False))
-    return result
+    if django_user is not None and not django_user.is_anonymous:
+        is_participant = ExpressionWrapper(get_user_events_condition(django_user), output_field=BooleanField())
+    else:
+        is_participant = Value(False, output_field=BooleanField())
+    events = Event.objects.select_related('summary__first_stage').annotate(is_participant=is_participant)
+    return [(event, get_event_first_stage(event), event.is_participant) for event in events]
 
 
 def get_user_events(user: User, user_role=0) -> Union[Set, int]:
@@ -152,9 +242,36 @@ def get_user_stages(user: User, user_role=0):
     return stages
 
 
+def get_user_stage_ids(user: Union[User, DjangoUser], stage_ids: Iterable[int] = None, user_role=1) -> Set[int]:
+    """
+    Узнать, на каких из этапов пользователь зарегистрирован, одним запросом values_list
+    :param user: Пользователь: User или DjangoUser (например, request.user)
+    :param stage_ids: id проверяемых этапов (None - все этапы пользователя)
+    :param user_role: Роль пользователя. (0 - все, 1 - участник, 2 - модератор)
+    :return: Множество id этапов из stage_ids, в которых участвует user
+    """
+    if user is None or getattr(user, 'is_anonymous', False):
+        return set()
+    lookup = {'user__user': user} if isinstance(user, DjangoUser) else {'user': user}
+    if stage_ids is not None:
+        stage_ids = list(stage_ids)
+        if not stage_ids:
+            return set()
+        lookup['stage__in'] = stage_ids
+    participants = StageParticipants.objects.filter(**lookup).values_list('stage', flat=True)
+    staff = StageStaff.objects.filter(**lookup).values_list('stage', flat=True)
+    if user_role == 1:
+        stages = participants
+    elif user_role == 2:
+        stages = staff
+    else:
+        stages = participants.union(staff)
+    return set(stages)
+
+
 def can_user_register_on_stage(user: User, stage: Stage) -> bool:
-    return (len(StageParticipants.objects.filter(user=user, stage=stage)) == 0) and (
-            stage.status == Stage.Status.WAITING) and stage.settings.can_register
+    return stage.status == Stage.Status.WAITING and stage.settings.can_register and \
+        stage.id not in get_user_stage_ids(user, [stage.id])
 
 
 def get_events_by_role(django_user: DjangoUser = None, user_role=0) -> Union[List, Union[Tuple, Event, Stage, int]]:
@@ -164,29 +281,32 @@ def get_events_by_role(django_user: DjangoUser = None, user_role=0) -> Union[Lis
     :param user_role: Роль пользователя. (0 - все, 1 - участник, 2 - модератор)
     :return: Список из троек: мероприятие, его первый этап, bool участвует ли django_user в этом мероприятии
     """
-
-    user_events = set()
-    if (not django_user.is_anonymous) and django_user is not None:
-        user = get_user_by_django_user(django_user)
-        user_events = get_user_events(user, user_role)
-
-    result = list()
-    for event in user_events:
-        result.append((event, event.stage_set.first, True))
-    return result
+    if django_user is None or django_user.is_anonymous:
+        return []
+    events = Event.objects.filter(get_user_events_condition(django_user, user_role)) \
+        .select_related('summary__first_stage')
+    return [(event, get_event_first_stage(event), True) for event in events]
 
 
 def get_user_by_django_user(django_user: DjangoUser) -> User:
     """
+    Найденный пользователь запоминается на объекте django_user: request.user живёт один запрос,
+    поэтому повторные вызовы в рамках запроса не обращаются к базе
 
     :param dj_user: Пользователь в django-формате (обычно передаётся в качестве request.user)
-    :return: User from user_handler
+    :return: User from user_handler (None для анонимного пользователя)
 
     """
+    if django_user is None or django_user.is_anonymous:
+        return None
+    user = getattr(django_user, '_domain_user_cache', None)
+    if user is not None:
+        return user
     try:
-        user = User.objects.get(user=django_user)
+        user = User.objects.select_related('user', 'personal_data').get(user=django_user)
     except ObjectDoesNotExist:
         user = create_user_for_django_user(django_user=django_user)
+    django_user._domain_user_cache = user
     return user
 
 
@@ -217,13 +337,11 @@ def get_event_by_stage(stage: Stage) -> Event:
     return stage.parent
 
 
-def check_user_participate_in_stage(django_user: User, stage: Stage) -> bool:
-    try:
-        if stage in map(lambda stage_part: stage_part.stage, get_user_stages(get_user_by_django_user(django_user))):
-            return True
-        return False
-    except Exception:
-        return False
+def check_user_participate_in_stage(django_user: DjangoUser, stage: Stage) -> bool:
+    """
+    Участвует ли пользователь в этапе как участник или модератор
+    """
+    return stage.id in get_user_stage_ids(django_user, [stage.id], user_role=0)
 
 
 def get_stage_by_id(stage_id: int):
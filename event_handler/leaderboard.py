@@ -0,0 +1,246 @@
+"""
+Рейтинг участников этапа
+
+Места считаются в SQL оконными функциями: одинаковые роль и баллы дают одинаковое место.
+Страницы рейтинга кэшируются до изменения результатов этапа: сигнал post_save заявки и функции,
+меняющие баллы массово (bulk_update, QuerySet.update), вызывают invalidate_leaderboard_on_commit
+"""
+from collections import namedtuple
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q, Window
+from django.db.models.functions import Coalesce, DenseRank, Rank
+
+from distributedEvents.versions import bump_version, bump_version_on_commit, get_version
+from event_handler.models import StageParticipants
+from user_handler.regions.regions_dict import DATA_REGIONS
+
+LEADERBOARD_PER_PAGE = 100  # Количество строк на одной странице рейтинга
+
+# competition - места 1, 1, 3; dense - места 1, 1, 2
+RANK_FUNCTIONS = {
+    'competition': Rank,
+    'dense': DenseRank,
+}
+
+# Разбивка рейтинга: места считаются отдельно внутри площадки или региона.
+# Регион участника - регион площадки, а если он не указан, то регион из персональных данных
+BREAKDOWN_FIELDS = {
+    'venue': 'venue_id',
+    'region': 'region',
+}
+
+ROLE_NAMES = {
+    StageParticipants.Roles.PARTICIPANT: "Участник",
+    StageParticipants.Roles.AWARDEE: "Призер",
+    StageParticipants.Roles.WINNER: "Победитель",
+}
+
+REGION_NAMES = dict(DATA_REGIONS)
+
+_START = object()  # Часть разбивки до первой строки рейтинга
+
+LeaderboardRow = namedtuple("LeaderboardRow", "place name status score venue_id venue region region_name")
+
+
+def _version_key(stage_id: int) -> str:
+    return f"leaderboard:version:{stage_id}"
+
+
+def get_leaderboard_version(stage_id: int) -> int:
+    """
+    Текущая версия рейтинга этапа: растёт при изменении баллов, ролей или состава участников
+    """
+    return get_version(_version_key(stage_id))
+
+
+def invalidate_leaderboard(stage_id: Optional[int]) -> None:
+    """
+    Сбросить закэшированные страницы рейтинга этапа
+    :param stage_id: id этапа
+    """
+    if stage_id is None:
+        return
+    bump_version(_version_key(stage_id))
+
+
+def invalidate_leaderboard_on_commit(stage_id: Optional[int]) -> None:
+    """
+    Сбросить рейтинг этапа после фиксации текущей транзакции: иначе страницу успеют закэшировать
+    по новой версии из ещё не изменённых данных
+    :param stage_id: id этапа
+    """
+    if stage_id is None:
+        return
+    bump_version_on_commit(_version_key(stage_id))
+
+
+def region_expression():
+    return Coalesce('venue__region', 'user__personal_data__region')
+
+
+class LeaderboardCursor(namedtuple("LeaderboardCursor", "partition role score id place position")):
+    """
+    Позиция в рейтинге для keyset-пагинации: последняя строка предыдущей страницы
+
+    :param partition: Часть разбивки (id площадки или код региона, None - без разбивки или без площадки)
+    :param role: Роль участника
+    :param score: Баллы участника
+    :param id: id записи StageParticipants
+    :param place: Место участника
+    :param position: Номер строки внутри части разбивки, начиная с 1
+    """
+
+    def to_param(self) -> str:
+        return ".".join("" if value is None else str(value) for value in self)
+
+    @classmethod
+    def from_param(cls, param: Optional[str]):
+        """
+        Разобрать курсор из параметра запроса
+        :param param: Строка вида partition.role.score.id.place.position (partition может быть пустым)
+        :return: Курсор или None, если параметр пустой или некорректный
+        """
+        if not param:
+            return None
+        try:
+            partition, *values = param.split(".")
+            return cls(int(partition) if partition else None, *map(int, values))
+        except (TypeError, ValueError):
+            return None
+
+
+def _after_cursor(after: LeaderboardCursor, field: Optional[str]) -> Q:
+    """
+    Условие на строки после курсора в порядке (часть разбивки, роль и баллы по убыванию, id по убыванию)
+    """
+    same_key_after = Q(role__lt=after.role) | Q(role=after.role, total_score__lt=after.score) | \
+        Q(role=after.role, total_score=after.score, id__lt=after.id)
+    if field is None:
+        return same_key_after
+    # Строки без части разбивки (NULL) идут первыми
+    if after.partition is None:
+        return Q(**{f"{field}__isnull": False}) | (Q(**{f"{field}__isnull": True}) & same_key_after)
+    return Q(**{f"{field}__gt": after.partition}) | (Q(**{field: after.partition}) & same_key_after)
+
+
+def get_leaderboard_queryset(stage_id: int, rank: str = "competition", breakdown: str = None, group: int = None,
+                             after: LeaderboardCursor = None):
+    """
+    Участники этапа с местом (place) и баллами (total_score)
+    Регион присоединяется только для разбивки по регионам: без соединений окно считается по одной таблице
+    :param stage_id: id этапа
+    :param rank: Способ нумерации мест: ключ RANK_FUNCTIONS
+    :param breakdown: Разбивка: ключ BREAKDOWN_FIELDS или None - общий рейтинг
+    :param group: id площадки или код региона: только эта часть разбивки
+    :param after: Только строки после курсора. Окно считается по ним же, поэтому места в части разбивки курсора
+    нужно сдвинуть (это делает compute_leaderboard_page)
+    :return: QuerySet, упорядоченный по части разбивки и месту
+    """
+    participants = StageParticipants.objects.filter(stage=stage_id).annotate(total_score=Coalesce('score', 0))
+    field = None
+    partition = None
+    ordering = []
+    if breakdown is not None:
+        field = BREAKDOWN_FIELDS[breakdown]
+        if breakdown == "region":
+            participants = participants.annotate(region=region_expression())
+        if group is not None:
+            # Места внутри одной части те же, что при разбиении на все части, но считаются по меньшему числу строк
+            participants = participants.filter(**{field: group})
+            field = None
+        else:
+            partition = [F(field)]
+            ordering.append(F(field).asc(nulls_first=True))
+    if after is not None:
+        participants = participants.filter(_after_cursor(after, field))
+    participants = participants.annotate(place=Window(
+        RANK_FUNCTIONS[rank](),
+        partition_by=partition,
+        order_by=[F('role').desc(), F('total_score').desc()],
+    ))
+    return participants.order_by(*ordering, 'place', '-id')
+
+
+def compute_leaderboard_page(stage_id: int, rank: str = "competition", breakdown: str = None, group: int = None,
+                             after: LeaderboardCursor = None, per_page: int = LEADERBOARD_PER_PAGE) -> dict:
+    """
+    Посчитать одну страницу рейтинга (без кэша)
+    Страница начинается после курсора (keyset-пагинация по роли, баллам и id, а не OFFSET): окно считается
+    только по строкам после курсора, а места в части разбивки курсора продолжают его место и номер строки.
+    Имена, площадки и регионы загружаются только для строк страницы
+    :return: Словарь: rows - строки LeaderboardRow, count - количество участников, next - курсор следующей
+    страницы (None, если страница последняя), is_first_page
+    """
+    ranked = get_leaderboard_queryset(stage_id, rank, breakdown, group, after)
+    field = BREAKDOWN_FIELDS[breakdown] if breakdown is not None and group is None else None
+    count = get_leaderboard_queryset(stage_id, rank, breakdown, group).order_by().values('id').count()
+    places = list(ranked.values_list('id', 'place', 'role', 'total_score', *([field] if field else []))
+                  [:per_page + 1])
+
+    ranks = []
+    partition, position = (after.partition, after.position) if after is not None else (_START, 0)
+    # Строки части разбивки курсора идут в начале страницы. Окно по ним начинается после курсора:
+    # равные курсору строки получают его место, остальные сдвигаются на строки (или места) до курсора
+    tied = after is not None and bool(places) and places[0][4:] == ((after.partition,) if field else ()) \
+        and places[0][2:4] == (after.role, after.score)
+    for participation_id, place, role, score, *row_partition in places[:per_page]:
+        row_partition = row_partition[0] if field else None
+        if after is not None and row_partition == after.partition:
+            if (role, score) == (after.role, after.score):
+                place = after.place
+            elif rank == "dense":
+                place = after.place + place - tied
+            else:
+                place = after.position + place
+        if row_partition != partition:
+            partition, position = row_partition, 0
+        position += 1
+        ranks.append((participation_id, place, role, score, row_partition, position))
+
+    details = StageParticipants.objects.filter(id__in=[participation_id for participation_id, *_ in ranks]) \
+        .annotate(total_score=Coalesce('score', 0), region=region_expression()) \
+        .values_list('id', 'user__personal_data__name', 'user__personal_data__surname', 'user__user__username',
+                     'role', 'total_score', 'venue_id', 'venue__name', 'region')
+    details = {row[0]: row[1:] for row in details}
+    rows = []
+    for participation_id, place, *_ in ranks:
+        name, surname, username, role, score, venue_id, venue, region = details[participation_id]
+        rows.append(LeaderboardRow(
+            place=place, name=f"{name} {surname}" if name and surname else username,
+            status=ROLE_NAMES.get(role, "Победитель"), score=score, venue_id=venue_id, venue=venue, region=region,
+            region_name=REGION_NAMES.get(region, ""),
+        ))
+
+    next_cursor = None
+    if len(places) > per_page:
+        participation_id, place, role, score, row_partition, position = ranks[-1]
+        next_cursor = LeaderboardCursor(partition=row_partition, role=role, score=score, id=participation_id,
+                                        place=place, position=position)
+    return {
+        'rows': rows,
+        'count': count,
+        'next': next_cursor,
+        'is_first_page': after is None,
+    }
+
+
+def get_leaderboard_page(stage_id: int, rank: str = "competition", breakdown: str = None, group: int = None,
+                         after: LeaderboardCursor = None, per_page: int = LEADERBOARD_PER_PAGE) -> dict:
+    """
+    Страница рейтинга из кэша (ключ - этап, версия рейтинга и параметры страницы)
+    Параметры и результат - как у compute_leaderboard_page
+    """
+    if rank not in RANK_FUNCTIONS:
+        raise ValueError(f"Неизвестный способ нумерации мест: {rank}")
+    if breakdown is not None and breakdown not in BREAKDOWN_FIELDS:
+        raise ValueError(f"Неизвестная разбивка рейтинга: {breakdown}")
+    page = after.to_param() if after is not None else ""
+    key = f"leaderboard:{stage_id}:{get_leaderboard_version(stage_id)}:{rank}:{breakdown}:{group}:{page}:{per_page}"
+    leaderboard = cache.get(key)
+    if leaderboard is None:
+        leaderboard = compute_leaderboard_page(stage_id, rank, breakdown, group, after, per_page)
+        cache.set(key, leaderboard, getattr(settings, 'LEADERBOARD_CACHE_TIMEOUT', 600))
+    return leaderboard
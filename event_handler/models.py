@@ -88,6 +88,7 @@ class Stage(models.Model):
         verbose_name = 'Этап'
         verbose_name_plural = 'Этапы'
         ordering = ['name']
+        indexes = [models.Index(fields=['parent', 'status'])]
 
 class Venue(models.Model):
     """
@@ -99,6 +100,7 @@ class Venue(models.Model):
     :param address: адрес проведения
     :param region: Регион, в котором площадка
     :param participants_maximum: Максимальное число участников
+    :param participants_count: Количество зарегистрированных участников
     :param parental_stage: Stage, на котором проводится мероприятие
     :param contacts: Контакты
 
@@ -107,6 +109,7 @@ class Venue(models.Model):
     address = models.TextField("Адрес", max_length=500)
     region = models.SmallIntegerField("Регион, в котором площадка", null=True, blank=True)
     participants_maximum = models.IntegerField("Максимальное число участников", null=True, blank=True)
+    participants_count = models.PositiveIntegerField("Количество зарегистрированных участников", default=0)
     parental_stage = models.ForeignKey(Stage, null=True, on_delete=models.SET_NULL)
     contacts = models.TextField("Контакты", max_length=100, null=True, blank=True)
 
@@ -115,6 +118,15 @@ class Venue(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def seats_left(self):
+        """
+        Количество свободных мест по счётчику participants_count, None - вместимость не ограничена
+        """
+        if self.participants_maximum is None:
+            return None
+        return max(0, self.participants_maximum - self.participants_count)
+
     class Meta:
         """
         Настройка отображения в админ-панели
@@ -122,6 +134,8 @@ class Venue(models.Model):
         verbose_name = 'Площадка проведения'
         verbose_name_plural = 'Площадки проведения'
         ordering = ['name']
+        # Площадки этапа выбираются в порядке ordering
+        indexes = [models.Index(fields=['parental_stage', 'name'])]
 
 
 class StageParticipants(models.Model):
@@ -180,6 +194,11 @@ class StageParticipants(models.Model):
         """
         verbose_name = 'Участники этапов'
         verbose_name_plural = 'Участники этапов'
+        constraints = [models.UniqueConstraint(fields=['stage', 'user'], name='unique_stage_participant')]
+        indexes = [
+            models.Index(fields=['stage', 'status', 'role']),
+            models.Index(fields=['yandex_contest_id']),
+        ]
 
 
 class StageStaff(models.Model):
@@ -231,8 +250,64 @@ class StageStaff(models.Model):
         """
         verbose_name = 'Модераторы этапов'
         verbose_name_plural = 'Модераторы этапов'
+        indexes = [models.Index(fields=['user', 'stage'])]
 
 
 class StageRelation(models.Model):
     stage_from = models.OneToOneField(Stage, related_name="stage_from", on_delete=models.CASCADE)
     stage_to = models.OneToOneField(Stage, related_name="stage_to", on_delete=models.CASCADE)
+
+
+class StageTreeNode(models.Model):
+    """
+    Класс **StageTreeNode**
+
+    Положение этапа в дереве этапов мероприятия.
+    Этапы хранятся в порядке обхода дерева от финального этапа к отборочным,
+    поэтому поддерево этапа занимает непрерывный отрезок позиций
+
+    :param event: Мероприятие
+    :param stage: Этап
+    :param position: Номер этапа в обходе дерева
+    :param depth: Глубина этапа в дереве (у финального этапа 0)
+
+    """
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name="stage_tree")
+    stage = models.OneToOneField(Stage, on_delete=models.CASCADE, related_name="tree_node")
+    position = models.PositiveIntegerField("Позиция в обходе дерева")
+    depth = models.PositiveIntegerField("Глубина в дереве")
+
+    class Meta:
+        """
+        Настройка отображения в админ-панели
+        """
+        verbose_name = 'Узел дерева этапов'
+        verbose_name_plural = 'Дерево этапов'
+        ordering = ['event', 'position']
+        indexes = [models.Index(fields=['event', 'position'])]
+
+
+class EventSummary(models.Model):
+    """
+    Класс **EventSummary**
+
+    Сводка по мероприятию для списков мероприятий: пересчитывается сигналами
+    (см. event_handler/signals.py) и командой rebuild_event_summaries
+
+    :param event: Мероприятие
+    :param is_open: Можно ли зарегистрироваться хотя бы на один этап
+    :param first_stage: Первый этап мероприятия (по названию)
+    :param participants_count: Количество заявок на этапы мероприятия
+
+    """
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, primary_key=True, related_name="summary")
+    is_open = models.BooleanField("Открыта регистрация", default=False)
+    first_stage = models.ForeignKey(Stage, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    participants_count = models.PositiveIntegerField("Количество заявок", default=0)
+
+    class Meta:
+        """
+        Настройка отображения в админ-панели
+        """
+        verbose_name = 'Сводка по мероприятию'
+        verbose_name_plural = 'Сводки по мероприятиям'
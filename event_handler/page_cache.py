@@ -0,0 +1,91 @@
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from distributedEvents.versions import bump_version, bump_version_on_commit, get_version
+from event_handler.models import Event, Stage
+
+
+def _version_key(event_id: int) -> str:
+    return f"event_page:version:{event_id}"
+
+
+def get_event_page_version(event_id: int) -> int:
+    """
+    Текущая версия страницы мероприятия: растёт при изменении мероприятия, его этапов,
+    их настроек и площадок, после чего старые фрагменты перестают читаться
+    """
+    return get_version(_version_key(event_id))
+
+
+def invalidate_event_page(event_id: Optional[int]) -> None:
+    """
+    Сбросить закэшированные фрагменты страницы мероприятия
+    :param event_id: id мероприятия
+    """
+    if event_id is None:
+        return
+    bump_version(_version_key(event_id))
+
+
+def invalidate_event_page_on_commit(event_id: Optional[int]) -> None:
+    """
+    Сбросить фрагменты страницы мероприятия после фиксации текущей транзакции: иначе страницу успеют
+    закэшировать по новой версии из ещё не изменённых данных
+    :param event_id: id мероприятия
+    """
+    if event_id is None:
+        return
+    bump_version_on_commit(_version_key(event_id))
+
+
+def render_event_page_fragments(event_id: int) -> Optional[dict]:
+    """
+    Отрисовать общие для всех пользователей части страницы мероприятия
+    Этапы загружаются одним запросом, уже упорядоченными по времени начала и названию
+    :return: Словарь с html описания мероприятия, списка всех этапов и карточек открытых этапов
+    или None, если мероприятия нет
+    """
+    event = Event.objects.filter(id=event_id).first()
+    if event is None:
+        return None
+    stages = list(Stage.objects.filter(parent=event_id).select_related('settings')
+                  .order_by(F('time_start').asc(nulls_last=True), 'name', 'id'))
+    open_stages = [stage for stage in stages
+                   if stage.status == Stage.Status.WAITING and stage.settings and stage.settings.can_register]
+    return {
+        'name': event.name,
+        'info': render_to_string('event_handler/fragments/event_info.html', {'event': event}),
+        'all_stages': render_to_string('event_handler/fragments/all_stages.html', {
+            'all_stages': stages,
+            'waiting_status': Stage.Status.WAITING,
+            'active_status': Stage.Status.ACTIVE,
+        }),
+        'open_stages': [(stage.id, render_to_string('event_handler/fragments/open_stage_card.html',
+                                                    {'stage': stage}))
+                        for stage in open_stages],
+    }
+
+
+def get_event_page_fragments(event_id: int) -> Optional[dict]:
+    """
+    Фрагменты страницы мероприятия из кэша (ключ - id мероприятия и версия)
+    :return: Фрагменты, как в render_event_page_fragments, или None, если мероприятия нет
+    """
+    key = f"event_page:{event_id}:{get_event_page_version(event_id)}"
+    fragments = cache.get(key)
+    if fragments is None:
+        fragments = render_event_page_fragments(event_id)
+        if fragments is None:
+            return None
+        cache.set(key, fragments, getattr(settings, 'EVENT_PAGE_CACHE_TIMEOUT', 600))
+    return {
+        'name': fragments['name'],
+        'info': mark_safe(fragments['info']),
+        'all_stages': mark_safe(fragments['all_stages']),
+        'open_stages': [(stage_id, mark_safe(card)) for stage_id, card in fragments['open_stages']],
+    }
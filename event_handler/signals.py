@@ -0,0 +1,77 @@
+from typing import Optional
+
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from creator_handler.models import StageSettings
+from event_handler.models import Event, EventSummary, Stage, StageParticipants, Venue
+from event_handler.leaderboard import invalidate_leaderboard_on_commit
+from event_handler.page_cache import invalidate_event_page_on_commit
+from event_handler.summary import add_participant_to_summary, refresh_event_summary
+
+
+def deleted_with(origin, *models) -> bool:
+    """
+    Удаляется ли объект каскадно вместе с объектом одной из моделей models
+    Обработчики post_delete таких моделей (этапа, мероприятия) уже сбросили кэши, и обработчик удаляемой строки
+    может ничего не делать: иначе удаление поддерева этапов выполняло бы по запросу на каждую строку
+    :param origin: Аргумент origin сигнала post_delete: объект или QuerySet, у которого вызван delete()
+    """
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return issubclass(model, models)
+
+
+def get_stage_event_id(instance, field: str) -> Optional[int]:
+    """
+    id мероприятия этапа, на который ссылается instance: из уже загруженного этапа или одним запросом
+    :param instance: Объект со ссылкой на этап
+    :param field: Название поля со ссылкой на этап
+    """
+    if getattr(type(instance), field).is_cached(instance):
+        stage = getattr(instance, field)
+        return stage.parent_id if stage is not None else None
+    return Stage.objects.filter(id=getattr(instance, f"{field}_id")).values_list('parent', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Event)
+def event_changed(sender, instance, **kwargs):
+    invalidate_event_page_on_commit(instance.id)
+
+
+@receiver(post_save, sender=Event)
+def event_created(sender, instance, created, **kwargs):
+    if created:
+        EventSummary.objects.create(event=instance)
+
+
+@receiver([post_save, post_delete], sender=Stage)
+def stage_changed(sender, instance, **kwargs):
+    invalidate_event_page_on_commit(instance.parent_id)
+    refresh_event_summary(instance.parent_id)
+
+
+# Только post_save: к моменту post_delete настроек их этапы уже удалены каскадно и сбросили кэши сами
+@receiver(post_save, sender=StageSettings)
+def stage_settings_changed(sender, instance, **kwargs):
+    for event_id in Stage.objects.filter(settings=instance).values_list('parent', flat=True):
+        invalidate_event_page_on_commit(event_id)
+        refresh_event_summary(event_id)
+
+
+@receiver([post_save, post_delete], sender=Venue)
+def venue_changed(sender, instance, origin=None, **kwargs):
+    if origin is not None and deleted_with(origin, Stage, Event):
+        return
+    invalidate_event_page_on_commit(get_stage_event_id(instance, 'parental_stage'))
+    # В рейтинге показываются название и регион площадки
+    invalidate_leaderboard_on_commit(instance.parental_stage_id)
+
+
+@receiver(post_save, sender=StageParticipants)
+def participant_saved(sender, instance, created, **kwargs):
+    invalidate_leaderboard_on_commit(instance.stage_id)
+    if created:
+        # Удаление заявки не отслеживается: обработчик post_delete отключил бы быстрое каскадное удаление.
+        # Заявки удаляются вместе с этапом, а его удаление пересчитывает сводку целиком
+        add_participant_to_summary(instance.stage_id)
@@ -0,0 +1,121 @@
+"""
+Сводки по мероприятиям (EventSummary) для списков мероприятий
+
+Сигналы пересчитывают сводку одним UPDATE при изменении этапов и их настроек и увеличивают счётчик заявок
+при создании заявки. Массовые операции (bulk_create, QuerySet.update) сигналов не отправляют,
+поэтому после них вызывается refresh_event_summary, а расхождения (например, после удаления пользователей)
+исправляет rebuild_event_summaries
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from event_handler.models import Event, EventSummary, Stage, StageParticipants
+
+deferred_events: ContextVar = ContextVar("deferred_event_summaries", default=None)
+
+
+def is_open_expression(event) -> Exists:
+    """
+    Условие "на какой-то этап мероприятия можно зарегистрироваться" (EventSummary.is_open)
+    :param event: Ссылка на мероприятие, например OuterRef('pk')
+    """
+    return Exists(Stage.objects.filter(parent=event, settings__can_register=True))
+
+
+def event_summary_fields() -> dict:
+    """
+    Выражения полей сводки для EventSummary.objects.update: считаются подзапросами по этапам мероприятия
+    """
+    stages = Stage.objects.filter(parent=OuterRef('event'))
+    participants = StageParticipants.objects.filter(stage__parent=OuterRef('event')).order_by() \
+        .values('stage__parent').annotate(count=Count('id')).values('count')
+    return {
+        'is_open': is_open_expression(OuterRef('event')),
+        # Тот же этап, что event.stage_set.first(): этапы упорядочены по названию
+        'first_stage': Subquery(stages.order_by('name', 'id').values('id')[:1]),
+        'participants_count': Coalesce(Subquery(participants), 0),
+    }
+
+
+def refresh_event_summary(event_id: Optional[int]) -> None:
+    """
+    Пересчитать сводку мероприятия
+    Существующая сводка только обновляется: при каскадном удалении мероприятия она не создаётся заново
+    :param event_id: id мероприятия
+    """
+    if event_id is None:
+        return
+    deferred = deferred_events.get()
+    if deferred is not None:
+        deferred.add(event_id)
+        return
+    EventSummary.objects.filter(event=event_id).update(**event_summary_fields())
+
+
+@contextmanager
+def defer_event_summaries():
+    """
+    Пересчитать сводки затронутых мероприятий один раз в конце блока, а не на каждый сигнал
+    (например, при удалении поддерева из тысяч этапов)
+    """
+    if deferred_events.get() is not None:
+        yield
+        return
+    events = set()
+    token = deferred_events.set(events)
+    try:
+        yield
+    finally:
+        deferred_events.reset(token)
+    for event_id in events:
+        refresh_event_summary(event_id)
+
+
+def add_participant_to_summary(stage_id: Optional[int]) -> None:
+    """
+    Увеличить счётчик заявок в сводке мероприятия этапа
+    :param stage_id: id этапа новой заявки
+    """
+    if stage_id is None:
+        return
+    EventSummary.objects.filter(event__stage=stage_id).update(participants_count=F('participants_count') + 1)
+
+
+def rebuild_event_summaries(event_ids: Iterable[int] = None) -> int:
+    """
+    Создать недостающие сводки и пересчитать все (например, после загрузки фикстур или generate_dataset)
+    :param event_ids: id мероприятий (по умолчанию все)
+    :return: Количество пересчитанных сводок
+    """
+    events = Event.objects.all() if event_ids is None else Event.objects.filter(id__in=list(event_ids))
+    with transaction.atomic():
+        EventSummary.objects.bulk_create(
+            [EventSummary(event_id=event_id) for event_id in events.filter(summary__isnull=True)
+                .values_list('id', flat=True)],
+            ignore_conflicts=True,
+        )
+        return EventSummary.objects.filter(event__in=events).update(**event_summary_fields())
+
+
+def backfill_event_summaries(sender, using=DEFAULT_DB_ALIAS, apps=None, **kwargs) -> None:
+    """
+    Обработчик post_migrate: создать сводки мероприятий, у которых их нет (например, созданных до появления
+    EventSummary), чтобы списки мероприятий не считали их закрытыми
+    """
+    # Сводки пересчитываются в основной базе; реплика не мигрируется
+    if using != DEFAULT_DB_ALIAS:
+        return
+    if apps is not None:
+        try:
+            apps.get_model('event_handler', 'EventSummary')
+        except LookupError:
+            # База мигрирована до версии без таблицы сводок
+            return
+    missing = list(Event.objects.filter(summary__isnull=True).values_list('id', flat=True))
+    if missing:
+        rebuild_event_summaries(missing)
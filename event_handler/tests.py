@@ -1,3 +1,511 @@
-from django.test import TestCase
+import json
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User as DjangoUser
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from creator_handler import db_controller as c_db
+from creator_handler.models import StageSettings
+from distributedEvents.instrumentation import request_stats
+from distributedEvents import routers, sqlite
+from distributedEvents.routers import get_replica_alias
+from distributedEvents.settings import env_int
+from event_handler.models import Event, EventSummary, Stage, StageParticipants, StageStaff, Venue
+from event_handler import db_controller as e_db, leaderboard, page_cache
+from event_handler.summary import rebuild_event_summaries
+from user_handler.db_controller import create_user_for_django_user
+
+
+def make_user(username: str):
+    django_user = DjangoUser.objects.create(username=username, email=f"{username}@example.com")
+    return django_user, create_user_for_django_user(django_user)
+
+
+def make_event(name: str, can_register: bool = False, stages: int = 1):
+    event = Event.objects.create(name=name)
+    for index in range(stages):
+        Stage.objects.create(name=f"{name} {index}", parent=event,
+                             settings=StageSettings.objects.create(can_register=can_register))
+    return event
+
+
+class EventsCatalogueTestCase(TestCase):
+    def setUp(self):
+        self.django_user, self.user = make_user("participant")
+        self.open_events = [make_event(f"Открытое {index}", can_register=True, stages=3) for index in range(5)]
+        self.closed_events = [make_event(f"Закрытое {index}", stages=2) for index in range(5)]
+        StageParticipants.objects.create(stage=self.open_events[0].stage_set.first(), user=self.user)
+
+    def test_partitions(self):
+        events_open, events_closed = e_db.get_events_catalogue(self.django_user)
+        self.assertEqual({event for event, _ in events_open}, set(self.open_events))
+        self.assertEqual({event for event, _ in events_closed}, set(self.closed_events))
+        participates = {event for event, is_participant in events_open + events_closed if is_participant}
+        self.assertEqual(participates, {self.open_events[0]})
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            e_db.get_events_catalogue(self.django_user)
+        make_event("Ещё одно", can_register=True, stages=5)
+        with self.assertNumQueries(1):
+            e_db.get_events_catalogue(self.django_user)
+
+    def test_events_without_summary(self):
+        # Мероприятия, созданные до появления сводок: открытость считается по этапам
+        EventSummary.objects.filter(event__in=[self.open_events[1], self.closed_events[1]]).delete()
+        with self.assertNumQueries(1):
+            events_open, events_closed = e_db.get_events_catalogue(self.django_user)
+        self.assertEqual({event for event, _ in events_open}, set(self.open_events))
+        self.assertEqual({event for event, _ in events_closed}, set(self.closed_events))
+
+    def test_show_events_query_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['event_list_open']), 5)
+        self.assertEqual(len(response.context['event_list_closed']), 5)
+
+
+class EventSummaryTestCase(TestCase):
+    def setUp(self):
+        self.django_user, self.user = make_user("participant")
+        self.event = make_event("Олимпиада", stages=2)
+
+    def summary(self) -> EventSummary:
+        return EventSummary.objects.get(event=self.event)
+
+    def test_signals_keep_summary(self):
+        summary = self.summary()
+        self.assertFalse(summary.is_open)
+        self.assertEqual(summary.first_stage.name, "Олимпиада 0")
+
+        stage = Stage.objects.get(name="Олимпиада 1")
+        stage.settings.can_register = True
+        stage.settings.save()
+        stage.name = "Авангард"
+        stage.save()
+        StageParticipants.objects.create(stage=stage, user=self.user)
+        summary = self.summary()
+        self.assertTrue(summary.is_open)
+        self.assertEqual(summary.first_stage, stage)
+        self.assertEqual(summary.participants_count, 1)
+
+        stage.delete()
+        summary = self.summary()
+        self.assertEqual((summary.is_open, summary.first_stage.name, summary.participants_count),
+                         (False, "Олимпиада 0", 0))
+        self.event.delete()
+        self.assertFalse(EventSummary.objects.exists())
+
+    def test_rebuild(self):
+        EventSummary.objects.filter(event=make_event("Без сводки")).delete()
+        StageSettings.objects.update(can_register=True)
+        self.assertEqual(rebuild_event_summaries(), 2)
+        self.assertTrue(all(EventSummary.objects.values_list('is_open', flat=True)))
+
+    def test_backfill_after_migrate(self):
+        EventSummary.objects.filter(event=make_event("Без сводки", can_register=True)).delete()
+        emit_post_migrate_signal(0, False, DEFAULT_DB_ALIAS)
+        self.assertEqual(EventSummary.objects.count(), 2)
+        self.assertTrue(EventSummary.objects.get(event__name="Без сводки").is_open)
+
+    def test_lists_single_query(self):
+        for index in range(5):
+            event = make_event(f"Мероприятие {index}", stages=3)
+            stage = event.stage_set.first()
+            StageParticipants.objects.create(stage=stage, user=self.user)
+            StageStaff.objects.create(stage=stage, user=self.user, role=StageStaff.Roles.PROVIDER)
+        with self.assertNumQueries(1):
+            events = e_db.get_all_events(self.django_user)
+            self.assertEqual(len(events), 6)
+            self.assertEqual(sum(is_participant for _, _, is_participant in events), 5)
+            self.assertTrue(all(stage.name.endswith(" 0") for _, stage, _ in events))
+        for role in (0, 1, 2):
+            with self.assertNumQueries(1):
+                self.assertEqual(len(e_db.get_events_by_role(self.django_user, role)), 5)
+
+        self.client.force_login(self.django_user)
+        self.client.get("/profile/participant_event_list")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/profile/participant_event_list")
+        expected = len(queries)
+        make_event("Ещё одно", stages=3).stage_set.first().stageparticipants_set.create(user=self.user)
+        with self.assertNumQueries(expected):
+            response = self.client.get("/profile/participant_event_list")
+        self.assertContains(response, "event_name", count=6)
+
+
+class ParticipationLookupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.django_user, self.user = make_user("participant")
+        self.event = make_event("Олимпиада", can_register=True, stages=4)
+        self.stages = list(self.event.stage_set.order_by('id'))
+        StageParticipants.objects.create(stage=self.stages[0], user=self.user)
+        StageStaff.objects.create(stage=self.stages[1], user=self.user)
+
+    def test_lookup(self):
+        stage_ids = [stage.id for stage in self.stages]
+        with self.assertNumQueries(1):
+            self.assertEqual(e_db.get_user_stage_ids(self.user, stage_ids), {stage_ids[0]})
+        with self.assertNumQueries(1):
+            self.assertEqual(e_db.get_user_stage_ids(self.django_user, stage_ids, user_role=0), set(stage_ids[:2]))
+        self.assertEqual(e_db.get_user_stage_ids(self.user, user_role=2), {stage_ids[1]})
+        with self.assertNumQueries(0):
+            self.assertEqual(e_db.get_user_stage_ids(AnonymousUser(), stage_ids), set())
+            self.assertEqual(e_db.get_user_stage_ids(self.user, []), set())
+
+        self.assertTrue(e_db.check_user_participate_in_stage(self.django_user, self.stages[1]))
+        self.assertFalse(e_db.check_user_participate_in_stage(self.django_user, self.stages[2]))
+        self.assertFalse(e_db.can_user_register_on_stage(self.user, self.stages[0]))
+        self.assertTrue(e_db.can_user_register_on_stage(self.user, self.stages[2]))
+
+    def get_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_pages_query_count_is_constant(self):
+        self.client.force_login(self.django_user)
+        event_url = f"/event/{self.event.id}"
+        registration_url = f"/stage_registration/{self.stages[2].id}"
+        self.get_queries(event_url)
+        expected = self.get_queries(event_url), self.get_queries(registration_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for index in range(10):
+                stage = Stage.objects.create(name=f"Дополнительный {index}", parent=self.event,
+                                             settings=StageSettings.objects.create(can_register=True))
+                StageParticipants.objects.create(stage=stage, user=self.user)
+                StageParticipants.objects.create(stage=make_event(f"Другое {index}").stage_set.get(), user=self.user)
+        self.get_queries(event_url)
+        self.assertEqual((self.get_queries(event_url), self.get_queries(registration_url)), expected)
+        self.assertContains(self.client.get(event_url), "open-stage-list__link_disabled", count=11)
+
+
+class ResultsTableTestCase(TestCase):
+    def setUp(self):
+        event = make_event("Олимпиада")
+        self.stage = event.stage_set.first()
+        self.participations = []
+        for index in range(25):
+            _, user = make_user(f"user{index}")
+            role = StageParticipants.Roles.AWARDEE if index % 5 == 0 else StageParticipants.Roles.PARTICIPANT
+            self.participations.append(StageParticipants.objects.create(stage=self.stage, user=user, role=role,
+                                                                        score=index % 7))
+
+    def test_page_is_single_query(self):
+        with self.assertNumQueries(1):
+            page, cursor = e_db.get_results_page(self.stage.id, limit=10)
+            [str(row.name_all) for row in page]
+        self.assertEqual(len(page), 10)
+        self.assertIsNotNone(cursor)
+
+    def test_pages_cover_ordered_table(self):
+        rows = list(e_db.iter_results_by_stage(self.stage.id, page_size=7))
+        self.assertEqual([row.num for row in rows], list(range(1, 26)))
+        expected = sorted(self.participations, key=lambda item: (-item.role, -item.score, -item.id))
+        self.assertEqual([row.total_score for row in rows], [item.score for item in expected])
+        self.assertEqual(rows[0].status_score, "Призер")
+
+    def test_cursor_round_trip(self):
+        _, cursor = e_db.get_results_page(self.stage.id, limit=3)
+        self.assertEqual(e_db.ResultsCursor.from_param(cursor.to_param()), cursor)
+        self.assertIsNone(e_db.ResultsCursor.from_param("garbage"))
+
+    def test_view_is_paginated(self):
+        url = f"/event/{self.stage.parent_id}/stage/{self.stage.id}/all_participants"
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['table']), 25)
+        self.assertIsNone(response.context['leaderboard']['next'])
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        event = make_event("Олимпиада")
+        self.stage = event.stage_set.get()
+        self.venues = [Venue.objects.create(name=f"Площадка {index}", address="ул. Тестовая", region=77 + index,
+                                            parental_stage=self.stage) for index in range(2)]
+        self.participations = []
+        # Баллы: 10, 10, 7, 5, 5, 5 на первой площадке и 9, 9 на второй
+        for index, (score, venue) in enumerate([(10, 0), (10, 0), (7, 0), (5, 0), (5, 0), (5, 0), (9, 1), (9, 1)]):
+            _, user = make_user(f"user{index}")
+            self.participations.append(StageParticipants.objects.create(
+                stage=self.stage, user=user, score=score, venue=self.venues[venue]))
+        self.url = f"/event/{event.id}/stage/{self.stage.id}/leaderboard"
+
+    def places(self, **options) -> list:
+        return [(row.place, row.score) for row in leaderboard.get_leaderboard_page(self.stage.id, **options)['rows']]
+
+    def test_ties_share_place(self):
+        self.assertEqual(self.places(), [(1, 10), (1, 10), (3, 9), (3, 9), (5, 7), (6, 5), (6, 5), (6, 5)])
+        self.assertEqual([place for place, _ in self.places(rank="dense")], [1, 1, 2, 2, 3, 4, 4, 4])
+
+    def test_breakdowns(self):
+        by_venue = leaderboard.get_leaderboard_page(self.stage.id, breakdown="venue")['rows']
+        self.assertEqual([(row.venue_id, row.place) for row in by_venue],
+                         [(self.venues[0].id, place) for place in (1, 1, 3, 4, 4, 4)] +
+                         [(self.venues[1].id, 1), (self.venues[1].id, 1)])
+        self.assertEqual(self.places(breakdown="region", group=78), [(1, 9), (1, 9)])
+        self.assertEqual(self.places(breakdown="venue", group=self.venues[0].id, rank="dense"),
+                         [(1, 10), (1, 10), (2, 7), (3, 5), (3, 5), (3, 5)])
+
+    def test_cached_until_scores_change(self):
+        leaderboard.get_leaderboard_page(self.stage.id)
+        with self.assertNumQueries(0):
+            leaderboard.get_leaderboard_page(self.stage.id)
+
+        participation = self.participations[-1]
+        with self.captureOnCommitCallbacks(execute=True):
+            participation.score = 11
+            participation.save()
+            # До фиксации транзакции рейтинг не сбрасывается
+            self.assertEqual(self.places()[0], (1, 10))
+        self.assertEqual(self.places()[0], (1, 11))
+
+        participation.score = 0
+        participation.yandex_contest_id = "0"
+        StageParticipants.objects.bulk_update([participation], ['score', 'yandex_contest_id'])
+        self.assertEqual(self.places()[0], (1, 11))
+        with self.captureOnCommitCallbacks(execute=True):
+            c_db.apply_stage_scores([participation], [{'participantInfo': {'id': 0}, 'score': 20}], 100)
+        self.assertEqual(self.places()[0], (1, 20))
+
+    def test_invalidated_from_another_process(self):
+        # Этапы завершает run_jobs - отдельный процесс со своим экземпляром кэша версий
+        self.assertNotIsInstance(caches[settings.VERSION_CACHE], LocMemCache)
+        self.assertEqual(self.places()[0], (1, 10))
+        StageParticipants.objects.filter(id=self.participations[-1].id).update(score=11)
+        other_process = caches.create_connection(settings.VERSION_CACHE)
+        with mock.patch('distributedEvents.versions.version_cache', return_value=other_process):
+            leaderboard.invalidate_leaderboard(self.stage.id)
+        self.assertEqual(self.places()[0], (1, 11))
+
+    def walk(self, per_page: int, **options) -> list:
+        rows, cursor = [], None
+        while True:
+            table = leaderboard.compute_leaderboard_page(self.stage.id, after=cursor, per_page=per_page, **options)
+            rows.extend(table['rows'])
+            if table['next'] is None:
+                return rows
+            cursor = leaderboard.LeaderboardCursor.from_param(table['next'].to_param())
+
+    def test_pages(self):
+        table = leaderboard.get_leaderboard_page(self.stage.id, per_page=3)
+        self.assertEqual(([row.place for row in table['rows']], table['count']), ([1, 1, 3], 8))
+        table = leaderboard.get_leaderboard_page(self.stage.id, after=table['next'], per_page=3)
+        self.assertEqual([row.place for row in table['rows']], [3, 5, 6])
+        self.assertFalse(table['is_first_page'])
+        self.assertIsNone(leaderboard.LeaderboardCursor.from_param("garbage"))
+
+    def test_keyset_pages_match_whole_table(self):
+        # Участники без площадки и призёр: части разбивки с NULL и разные роли
+        roles = StageParticipants.Roles
+        for index, (score, role) in enumerate([(10, roles.PARTICIPANT), (3, roles.AWARDEE), (3, roles.AWARDEE)]):
+            _, user = make_user(f"extra{index}")
+            StageParticipants.objects.create(stage=self.stage, user=user, score=score, role=role)
+        for rank in leaderboard.RANK_FUNCTIONS:
+            for breakdown, group in ((None, None), ("venue", None), ("region", None), ("venue", self.venues[0].id)):
+                options = {'rank': rank, 'breakdown': breakdown, 'group': group}
+                whole = self.walk(100, **options)
+                for per_page in range(1, 5):
+                    self.assertEqual(self.walk(per_page, **options), whole, (options, per_page))
+
+    def test_json(self):
+        response = self.client.get(self.url, {'rank': "dense", 'by': "region", 'group': 77})
+        data = response.json()
+        self.assertEqual((data['count'], data['by'], data['group']), (6, "region", 77))
+        self.assertEqual([row['place'] for row in data['results']], [1, 1, 2, 3, 3, 3])
+        # При равенстве выше более поздняя заявка, как в таблице результатов
+        self.assertEqual(data['results'][0]['name'], "user1")
+        for params in ({'rank': "olympic"}, {'by': "city"}, {'group': 77}, {'by': "venue", 'group': "x"}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+        self.assertEqual(self.client.get(f"/event/100500/stage/{self.stage.id}/leaderboard").status_code, 404)
+
+    def test_html(self):
+        response = self.client.get(self.url.replace("leaderboard", "all_participants"), {'by': "venue"})
+        self.assertContains(response, "Площадка 1", count=2)
+        self.assertEqual([row.place for row in response.context['table']], [1, 1, 3, 4, 4, 4, 1, 1])
+        self.assertEqual(self.client.get(self.url.replace("leaderboard", "all_participants"),
+                                         {'rank': "olympic"}).status_code, 400)
+        self.assertTemplateUsed(self.client.get(f"/event/100500/stage/{self.stage.id}/all_participants"),
+                                "404.html")
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        request_stats.reset()
+        self.django_user, self.user = make_user("participant")
+        self.event = make_event("Олимпиада", can_register=True, stages=3)
+
+    def test_request_is_measured(self):
+        self.client.force_login(self.django_user)
+        with self.assertLogs("distributedEvents.requests", level="INFO") as logs:
+            self.client.get("/")
+            self.client.get(f"/event/{self.event.id}")
+        records = [json.loads(line.split(":", 2)[2]) for line in logs.output]
+        self.assertEqual([record['url_name'] for record in records], ["all_events", "cur_event"])
+        self.assertGreater(records[0]['queries'], 0)
+        self.assertGreater(records[0]['template_ms'], 0)
+        self.assertGreaterEqual(records[0]['total_ms'], records[0]['db_ms'])
+
+        summary = request_stats.summary()
+        self.assertEqual(summary['all_events']['requests'], 1)
+        self.assertEqual(summary['all_events']['queries'], records[0]['queries'])
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_request_dumps_sql(self):
+        with self.assertLogs("distributedEvents.requests", level="WARNING") as logs:
+            self.client.get("/")
+        record = json.loads(logs.output[0].split(":", 2)[2])
+        self.assertTrue(record['slow'])
+        self.assertTrue(any('event_handler_event' in statement['sql'] for statement in record['sql']))
+
+    def test_stats_are_admin_only(self):
+        self.client.force_login(self.django_user)
+        self.client.get("/")
+        self.assertEqual(self.client.get("/stats/requests").status_code, 302)
+        DjangoUser.objects.filter(id=self.django_user.id).update(is_staff=True)
+        response = self.client.get("/stats/requests")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['views']['all_events']['requests'], 1)
+
+
+class SqlitePragmasTestCase(SimpleTestCase):
+    databases = {'default'}
+
+    def test_statements(self):
+        self.assertEqual(sqlite.get_pragma_statements({'journal_mode': "wal", 'synchronous': "normal",
+                                                       'busy_timeout': "250"}),
+                         ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA busy_timeout=250"])
+        with self.assertRaises(ImproperlyConfigured):
+            sqlite.get_pragma_statements({'journal_mode': "WAL; DROP TABLE auth_user"})
+        with self.assertRaises(ImproperlyConfigured):
+            sqlite.get_pragma_statements({'cache_size': "много"})
+
+    def test_env_int(self):
+        with mock.patch.dict("os.environ", {'DB_CONN_MAX_AGE': "60"}):
+            self.assertEqual(env_int('DB_CONN_MAX_AGE', 600), 60)
+        with mock.patch.dict("os.environ", {'DB_CONN_MAX_AGE': "10 минут"}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "DB_CONN_MAX_AGE"):
+                env_int('DB_CONN_MAX_AGE', 600)
+
+    @override_settings(SQLITE_PRAGMAS={'synchronous': "OFF", 'busy_timeout': 1234, 'cache_size': -1000})
+    def test_new_connection_is_configured(self):
+        self.addCleanup(sqlite.configure_connection, sender=None, connection=connection)
+        sqlite.configure_connection(sender=None, connection=connection)
+        pragmas = sqlite.get_current_pragmas(connection)
+        self.assertEqual((pragmas['synchronous'], pragmas['busy_timeout'], pragmas['cache_size']), (0, 1234, -1000))
+
+
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        # В тестах реплика - зеркало основной базы, поэтому подменяется только выбор alias
+        patcher = mock.patch('distributedEvents.routers.get_replica_alias', return_value="replica")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = routers.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def call(self, view, cookies=None):
+        request = self.factory.get("/")
+        request.COOKIES.update(cookies or {})
+        return routers.ReplicaMiddleware(routers.replica_reads(view))(request)
+
+    def test_reads_go_to_replica_until_write(self):
+        used = []
+
+        def view(request):
+            used.append(self.router.db_for_read(Event))
+            self.assertEqual(self.router.db_for_write(Event), "default")
+            used.append(self.router.db_for_read(Event))
+            return HttpResponse()
+
+        response = self.call(view)
+        self.assertEqual(used, ["replica", "default"])
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_pin_cookie_and_read_from_primary(self):
+        used = []
+
+        def view(request):
+            used.append(self.router.db_for_read(Event))
+            with routers.read_from_primary():
+                used.append(self.router.db_for_read(Event))
+            used.append(self.router.db_for_read(Event))
+            return HttpResponse()
+
+        response = self.call(view)
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.call(view, {settings.REPLICA_PIN_COOKIE: "1"})
+        self.assertEqual(used, ["replica", "default", "replica", "default", "default", "default"])
+
+    def test_primary_outside_replica_pages(self):
+        self.assertEqual(self.router.db_for_read(Event), "default")
+        self.assertFalse(self.router.allow_migrate("replica", "event_handler"))
+        self.assertIsNone(self.router.allow_migrate("default", "event_handler"))
+
+    def test_test_mirror_uses_default(self):
+        self.assertEqual(get_replica_alias(), "default")
+        name = Path(str(connections['default'].settings_dict['NAME']))
+        with mock.patch.dict(connections['replica'].settings_dict, {'NAME': name}):
+            self.assertEqual(get_replica_alias(), "default")
+
+
+class EventPageCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = make_event("Олимпиада", can_register=True, stages=2)
+        self.stage = self.event.stage_set.order_by('id').first()
+        self.url = f"/event/{self.event.id}"
+
+    def test_fragments_are_cached(self):
+        self.assertContains(self.client.get(self.url), "Олимпиада 0")
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(self.url), "Олимпиада 1")
+
+    def test_changes_invalidate(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stage.name = "Отборочный"
+            self.stage.save()
+        self.assertContains(self.client.get(self.url), "Отборочный")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stage.settings.can_register = False
+            self.stage.settings.save()
+        self.assertContains(self.client.get(self.url), '<li class="open-stage-list__stage-card">', count=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.event.description = "Новое описание"
+            self.event.save()
+        self.assertContains(self.client.get(self.url), "Новое описание")
+
+    def test_invalidated_after_commit(self):
+        version = page_cache.get_event_page_version(self.event.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stage.save()
+            self.assertEqual(page_cache.get_event_page_version(self.event.id), version)
+        self.assertNotEqual(page_cache.get_event_page_version(self.event.id), version)
+
+    def test_participation_is_per_user(self):
+        django_user, user = make_user("participant")
+        StageParticipants.objects.create(stage=self.stage, user=user)
+        self.client.get(self.url)
+        self.client.force_login(django_user)
+        self.assertContains(self.client.get(self.url), "open-stage-list__link_disabled", count=1)
+        self.client.force_login(make_user("newcomer")[0])
+        self.assertNotContains(self.client.get(self.url), "open-stage-list__link_disabled")
+
+    def test_missing_event(self):
+        self.assertTemplateUsed(self.client.get("/event/100500"), "404.html")
@@ -1,4 +1,4 @@
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
@@ -13,6 +13,9 @@ import creator_handler.db_controller as c_db
 from event_handler.models import Event, Stage, StageStaff
 
 import event_handler.db_controller as e_db
+from event_handler import leaderboard
+from event_handler.page_cache import get_event_page_fragments
+from distributedEvents.routers import replica_reads
 import creator_handler.db_controller as c_db
 
 NAVIGATE_BUTTONS = [
@@ -30,6 +33,13 @@ NAVIGATE_BUTTONS = [
     }
 ]
 
+REGISTRATION_ERRORS = {
+    c_db.RegistrationResult.ALREADY_REGISTERED: "Вы уже зарегистрированы на этот этап",
+    c_db.RegistrationResult.CLOSED: "Регистрация на этап закрыта",
+    c_db.RegistrationResult.WRONG_VENUE: "Выберите площадку этого мероприятия",
+    c_db.RegistrationResult.VENUE_FULL: "На площадке не осталось мест",
+}
+
 
 def error404(request):
     """
@@ -110,16 +120,60 @@ def all_events(request):
     return render(request, 'event_handler/all_events.html', context)
 
 
+def get_leaderboard_options(request, event_id: int, stage_id: int) -> dict:
+    """
+    Разобрать параметры рейтинга: ?rank=competition|dense, ?by=venue|region, ?group=<id площадки или код региона>,
+    ?after=<курсор последней строки предыдущей страницы>
+
+    :return: Аргументы для get_leaderboard_page
+    :raise Http404: этапа нет в мероприятии
+    :raise ValueError: некорректные параметры
+    """
+    if not Stage.objects.filter(id=stage_id, parent=event_id).exists():
+        raise Http404
+    rank = request.GET.get('rank') or "competition"
+    breakdown = request.GET.get('by') or None
+    group = request.GET.get('group') or None
+    if rank not in leaderboard.RANK_FUNCTIONS:
+        raise ValueError("Неизвестный способ нумерации мест")
+    if breakdown is not None and breakdown not in leaderboard.BREAKDOWN_FIELDS:
+        raise ValueError("Неизвестная разбивка рейтинга")
+    if group is not None:
+        if breakdown is None or not group.isdigit():
+            raise ValueError("Часть разбивки задаётся числом вместе с параметром by")
+        group = int(group)
+    return {'stage_id': stage_id, 'rank': rank, 'breakdown': breakdown, 'group': group,
+            'after': leaderboard.LeaderboardCursor.from_param(request.GET.get('after'))}
+
+
+@replica_reads
 def show_all_participants(request, event_id, stage_id):
+    """
+    Страница результатов этапа
+
+    Места считаются в базе: у участников с одинаковыми ролью и баллами место одинаковое.
+    Параметры - как у get_leaderboard_options
+
+    :param request: объект с деталями запроса
+    :type request: :class: 'django.http.HttpRequest'
+    :param stage_id: id этапа
+    :type stage_id: :class: 'int'
+    :return: html страница
+    """
     try:
-        table = get_list_results_by_stage(stage_id)
-        # print(table)
-    except Exception as e:
-        print(e)
+        options = get_leaderboard_options(request, event_id, stage_id)
+    except Http404:
         return error404(request)
-    ans = list(table)
+    except ValueError as e:
+        return JsonResponse({"errors": str(e)}, status=400)
+    table = leaderboard.get_leaderboard_page(**options)
+    query = request.GET.copy()
+    query.pop('after', None)
     context = {'page_name': 'Все участники',
-               'table': ans,
+               'table': table['rows'],
+               'leaderboard': table,
+               'options': options,
+               'query': query.urlencode(),
                'navigation_buttons': [
                    {
                        'name': "Главная",
@@ -142,6 +196,30 @@ def show_all_participants(request, event_id, stage_id):
     return render(request, 'event_handler/all_participants.html', context)
 
 
+@replica_reads
+def leaderboard_json(request, event_id, stage_id):
+    """
+    Рейтинг этапа в формате json, параметры - как у get_leaderboard_options
+
+    :return: json: количество участников, курсор следующей страницы (параметр after), строки рейтинга
+    """
+    try:
+        options = get_leaderboard_options(request, event_id, stage_id)
+    except ValueError as e:
+        return JsonResponse({"errors": str(e)}, status=400)
+    table = leaderboard.get_leaderboard_page(**options)
+    return JsonResponse({
+        'stage': stage_id,
+        'rank': options['rank'],
+        'by': options['breakdown'],
+        'group': options['group'],
+        'count': table['count'],
+        'next': table['next'].to_param() if table['next'] else None,
+        'results': [row._asdict() for row in table['rows']],
+    })
+
+
+@replica_reads
 def show_events(request):
     """
     Страница всех мероприятий
@@ -152,11 +230,7 @@ def show_events(request):
     :return: html страница
     """
 
-    # a = get_open_or_closed_events(request.user)
-    # print(a)
-
-    event_list_open = get_open_or_closed_events(request.user, True)
-    event_list_closed = get_open_or_closed_events(request.user, False)
+    event_list_open, event_list_closed = get_events_catalogue(request.user)
 
     context = {'page_name': 'Все мероприятия',
                'event_list_open': event_list_open,
@@ -286,6 +360,7 @@ def staff_event_list(request):
 #         raise Http404
 
 
+@replica_reads
 def current_event(request, event_id):
     """
     Страница одного мероприятия
@@ -297,25 +372,17 @@ def current_event(request, event_id):
     :return: html страница
     """
 
-    try:
-        event = e_db.get_event_by_id(event_id)
-    except ObjectDoesNotExist:
+    fragments = get_event_page_fragments(event_id)
+    if fragments is None:
         return error404(request)
 
-    all_stages = list(get_stages_by_event(event_id))
-    open_stages = list(get_open_stages_by_event(event_id))
-    all_stages.sort(key=lambda stage: stage.name)
-    open_stages.sort(key=lambda stage: stage.name)
-    all_stages.sort(key=lambda stage: stage.time_start.timestamp() if stage.time_start else float("inf"))
-    open_stages.sort(key=lambda stage: stage.time_start.timestamp() if stage.time_start else float("inf"))
+    # Отметки "уже участвую" зависят от пользователя и не кэшируются
+    user_stage_ids = get_user_stage_ids(request.user, [stage_id for stage_id, _ in fragments['open_stages']])
 
     context = {
-        'event': event,
-        'all_stages': all_stages,
-        'open_stages': [(stage, check_user_participate_in_stage(request.user, stage))
-                        for stage in open_stages],
-        'waiting_status': Stage.Status.WAITING,
-        'active_status': Stage.Status.ACTIVE,
+        'fragments': fragments,
+        'open_stages': [(stage_id, card, stage_id in user_stage_ids)
+                        for stage_id, card in fragments['open_stages']],
         'navigation_buttons': [
             {
                 'name': "Вернуться назад",
@@ -338,24 +405,29 @@ def current_stage_registration(request, stage_id):
     :type event_id: :class: 'int'
     :return: html страница
     """
-    stage = get_stage_by_id(stage_id)
+    stage = Stage.objects.select_related('settings').filter(id=stage_id).first()
+    if stage is None:
+        return error404(request)
+    user = request.domain_user
+    error = None
 
-    if request.method == "POST" and can_user_register_on_stage(get_user_by_django_user(request.user), stage):
+    if request.method == "POST":
         form = RegistrateStageForm(request.POST)
         if form.is_valid():
-            venue_id = form.cleaned_data['venue_id']
-            user = get_user_by_django_user(request.user)
-            c_db.register_on_stage(stage_id, venue_id, user)
-            return redirect('all_events')
+            result = c_db.register_on_stage(stage, form.cleaned_data['venue_id'], user)
+            if result == c_db.RegistrationResult.REGISTERED:
+                return redirect('all_events')
+            error = REGISTRATION_ERRORS[result]
 
     context = {
         'stage': stage,
-        'venues_list': get_venues_by_stage_id(stage_id),
-        'can_register': can_user_register_on_stage(get_user_by_django_user(request.user), stage),
+        'venues_list': c_db.get_free_venues_by_stage_id(stage_id),
+        'can_register': can_user_register_on_stage(user, stage),
+        'error': error,
         'navigation_buttons': [
             {
                 'name': "Обратно к мероприятию",
-                'href': f"/event/{get_event_by_stage(stage).id}"
+                'href': f"/event/{stage.parent_id}"
             }
         ]
     }
@@ -363,6 +435,7 @@ def current_stage_registration(request, stage_id):
     return render(request, 'event_handler/stage_registration.html', context)
 
 
+@replica_reads
 def current_stage(request, event_id, stage_id):
     """
     Страница этапа мероприятия
@@ -116,7 +116,26 @@ editPopup.querySelector('.popup__form').addEventListener('submit', (evt) => {
 })
 
 const endButtons = Array.from(document.querySelectorAll('.stage__button_type_end'))
-console.log(endButtons)
+
+function pollJob(btn, statusUrl) {
+    return fetch(statusUrl).then((res) => {
+        if (!res.ok) {
+            return Promise.reject(res.status);
+        }
+        return res.json();
+    }).then((job) => {
+        if (job.status === "done") {
+            btn.innerText = "Этап завершён";
+            return;
+        }
+        if (job.status === "failed") {
+            return Promise.reject(job.message);
+        }
+        btn.innerText = "Завершаем... " + job.progress + "%";
+        return new Promise((resolve) => setTimeout(resolve, 2000)).then(() => pollJob(btn, statusUrl));
+    })
+}
+
 endButtons.forEach((btn) => {
     btn.addEventListener('click', (evt) => {
         btn.innerText = "Завершаем..."
@@ -128,11 +147,12 @@ endButtons.forEach((btn) => {
                 return res.json();
             }
             return Promise.reject(res.status);
-        }).catch((err) => {
-            setTimeout(() => {btn.innerText = "Ошибка..."}, 1500)
+        }).then((job) => pollJob(btn, job.status_url))
+        .catch((err) => {
+            btn.innerText = "Ошибка..."
         })
         .finally((err) => {
-            setTimeout(() => {btn.innerText = "Завершить этап"}, 1500)
+            setTimeout(() => {btn.innerText = "Завершить этап"}, 3000)
         })
     })
-})
\ No newline at end of file
+})
@@ -0,0 +1,22 @@
+from django.utils.functional import SimpleLazyObject
+
+from event_handler.db_controller import get_user_by_django_user
+
+
+class DomainUserMiddleware:
+    """
+    Класс **DomainUserMiddleware**
+
+    Добавляет к запросу request.domain_user - User из user_handler для request.user.
+    Пользователь загружается вместе с персональными данными при первом обращении
+    и не больше одного раза за запрос. Для анонимного пользователя значение - None,
+    поэтому сначала проверяйте request.user.is_authenticated
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.domain_user = SimpleLazyObject(lambda: get_user_by_django_user(request.user))
+        return self.get_response(request)
@@ -1,3 +1,57 @@
+from django.contrib.auth.models import AnonymousUser, User as DjangoUser
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# Create your tests here.
+from creator_handler import db_controller as c_db
+from event_handler.models import StageStaff
+from event_handler.db_controller import get_user_by_django_user
+from user_handler.db_controller import create_user_for_django_user
+from user_handler.models import User
+
+
+def count_queries_to(queries, table: str) -> int:
+    return sum(f'FROM "{table}"' in query['sql'] for query in queries)
+
+
+class RequestUserCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.django_user = DjangoUser.objects.create(username="participant")
+        self.user = create_user_for_django_user(self.django_user)
+        self.event = c_db.make_record_event("Олимпиада", "")
+        self.stage = c_db.make_record_stage("Финал", self.event)
+        self.django_user = DjangoUser.objects.get(id=self.django_user.id)
+
+    def test_domain_user_is_resolved_once(self):
+        with self.assertNumQueries(1):
+            user = get_user_by_django_user(self.django_user)
+            self.assertEqual(get_user_by_django_user(self.django_user), user)
+            str(user.personal_data)
+            str(user)
+
+    def test_anonymous_user(self):
+        self.assertIsNone(get_user_by_django_user(AnonymousUser()))
+        self.assertFalse(c_db.user_have_access(AnonymousUser(), self.event.id))
+
+    def test_user_is_created_on_demand(self):
+        django_user = DjangoUser.objects.create(username="newcomer")
+        user = get_user_by_django_user(django_user)
+        self.assertEqual(User.objects.get(user=django_user), user)
+
+    def test_access_is_memoized(self):
+        c_db.create_staff(self.user, self.stage, StageStaff.Roles.PROVIDER, StageStaff.Status.ACCEPTED)
+        self.assertTrue(c_db.user_have_access(self.django_user, self.event.id, c_db.SettingsSet.EDIT_VENUES))
+        with self.assertNumQueries(0):
+            self.assertTrue(c_db.user_have_access(self.django_user, str(self.event.id),
+                                                  c_db.SettingsSet.EDIT_VENUES))
+
+    def test_registration_page_loads_user_once(self):
+        self.stage.settings.can_register = True
+        self.stage.settings.save()
+        self.client.force_login(self.django_user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/stage_registration/{self.stage.id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count_queries_to(queries, "user_handler_user"), 1)